@@ -0,0 +1,114 @@
+"""Benchmark: write-path cost of AUDIT_LOG.record() vs. an inline audit INSERT.
+
+Needs a database with the audit_events migration applied. Run from the
+backend directory:
+
+    DATABASE_URL=postgresql://... python benchmarks/bench_audit_writer.py
+
+Concurrent "handlers" each record EVENTS audit events. "inline" writes every
+event with its own INSERT, as a handler auditing synchronously would; "queued"
+hands them to the batched writer. Latencies are per event as seen by the
+handler; throughput includes the final flush.
+"""
+
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+import uuid
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sqlalchemy import text  # noqa: E402
+
+import server  # noqa: E402
+
+INSERT_ONE = text("""
+    INSERT INTO audit_events (occurred_at, actor_id, action, table_name, row_id, company_id, before, after)
+    VALUES (now(), NULL, :action, :table_name, :row_id, CAST(:company_id AS uuid), NULL, CAST(:after AS jsonb))
+""")
+
+
+def percentile(samples: list, pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))]
+
+
+def sample_image(i: int) -> dict:
+    return {
+        "id": str(uuid.uuid4()),
+        "policy_number": f"BENCH-{i:07d}",
+        "status": "ACTIVE",
+        "premium_amount": 1250.0,
+        "sum_insured": 500000.0,
+    }
+
+
+async def inline_handler(events: int, company_id: str, latencies: list) -> None:
+    for i in range(events):
+        image = sample_image(i)
+        started = time.perf_counter()
+        async with server.db() as session:
+            await session.execute(
+                INSERT_ONE,
+                {
+                    "action": "CREATE",
+                    "table_name": "bench",
+                    "row_id": image["id"],
+                    "company_id": company_id,
+                    "after": server.audit_json(image),
+                },
+            )
+            await session.commit()
+        latencies.append((time.perf_counter() - started) * 1e6)
+
+
+async def queued_handler(events: int, company_id: str, latencies: list) -> None:
+    for i in range(events):
+        image = sample_image(i)
+        started = time.perf_counter()
+        await server.AUDIT_LOG.record(
+            server.AuditAction.CREATE, "bench", image["id"], company_id=company_id, after=image
+        )
+        latencies.append((time.perf_counter() - started) * 1e6)
+        # Handlers do other work between writes
+        await asyncio.sleep(0)
+
+
+async def run(label: str, handler, handlers: int, events: int) -> None:
+    company_id = str(uuid.uuid4())
+    latencies: list = []
+    started = time.perf_counter()
+    await asyncio.gather(*(handler(events, company_id, latencies) for _ in range(handlers)))
+    if handler is queued_handler:
+        await server.AUDIT_LOG.stop()
+    elapsed = time.perf_counter() - started
+    print(
+        f"{label:<8} events={len(latencies):<7} "
+        f"p50={statistics.median(latencies):9.1f} us  "
+        f"p99={percentile(latencies, 99):9.1f} us  "
+        f"throughput={len(latencies) / elapsed:10,.0f}/s"
+    )
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--handlers", type=int, default=32)
+    parser.add_argument("--events", type=int, default=200, help="events per handler")
+    args = parser.parse_args()
+
+    await run("inline", inline_handler, args.handlers, args.events)
+    server.AUDIT_LOG.start()
+    await run("queued", queued_handler, args.handlers, args.events)
+    print("writer:", server.AUDIT_LOG.status())
+
+    async with server.db() as session:
+        await session.execute(text("DELETE FROM audit_events WHERE table_name = 'bench'"))
+        await session.commit()
+    await server.engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
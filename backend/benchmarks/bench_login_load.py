@@ -0,0 +1,110 @@
+"""Load benchmark: /api/health latency while /api/auth/login is hammered.
+
+Start the API first (e.g. `uvicorn server:app --port 8001`), then run:
+
+    python benchmarks/bench_login_load.py --base-url http://localhost:8001
+
+A baseline phase probes /api/health alone, then a load phase does the same
+while LOGIN_THREADS clients log in back to back. With password hashing on
+the worker pool, health p99 should stay close to the baseline and excess
+logins should come back as fast 503s rather than growing latency.
+"""
+
+import argparse
+import statistics
+import threading
+import time
+import uuid
+from collections import Counter
+
+import requests
+
+
+def percentile(samples: list, pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))]
+
+
+def probe_health(base_url: str, duration: float, interval: float) -> list:
+    latencies = []
+    session = requests.Session()
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        session.get(f"{base_url}/api/health", timeout=30)
+        latencies.append((time.perf_counter() - started) * 1000)
+        time.sleep(interval)
+    return latencies
+
+
+def hammer_logins(
+    base_url: str, email: str, password: str, stop: threading.Event, statuses: Counter
+) -> None:
+    session = requests.Session()
+    while not stop.is_set():
+        response = session.post(
+            f"{base_url}/api/auth/login",
+            data={"email": email, "password": password},
+            timeout=60,
+        )
+        statuses[response.status_code] += 1
+
+
+def report(label: str, latencies: list) -> None:
+    print(
+        f"{label:<10} n={len(latencies):<5} "
+        f"p50={statistics.median(latencies):7.1f} ms  "
+        f"p99={percentile(latencies, 99):7.1f} ms  "
+        f"max={max(latencies):7.1f} ms"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--base-url", default="http://localhost:8001")
+    parser.add_argument("--company-id", default=str(uuid.uuid4()))
+    parser.add_argument("--login-threads", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=15.0)
+    parser.add_argument("--interval", type=float, default=0.02)
+    args = parser.parse_args()
+
+    email = f"bench-{uuid.uuid4().hex[:8]}@example.com"
+    password = "bench-password"
+    requests.post(
+        f"{args.base_url}/api/auth/register",
+        json={
+            "company_id": args.company_id,
+            "name": "Load Bench",
+            "email": email,
+            "role": "AGENT",
+            "password": password,
+        },
+        timeout=30,
+    ).raise_for_status()
+
+    report("baseline", probe_health(args.base_url, args.duration / 3, args.interval))
+
+    stop = threading.Event()
+    statuses: Counter = Counter()
+    workers = [
+        threading.Thread(
+            target=hammer_logins,
+            args=(args.base_url, email, password, stop, statuses),
+            daemon=True,
+        )
+        for _ in range(args.login_threads)
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        report("under load", probe_health(args.base_url, args.duration, args.interval))
+    finally:
+        stop.set()
+        for worker in workers:
+            worker.join()
+
+    print("login responses:", dict(statuses))
+
+
+if __name__ == "__main__":
+    main()
@@ -7,25 +7,54 @@ from fastapi import (
     Form,
     Depends,
     Query,
+    Request,
+    Response,
 )
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from starlette.datastructures import MutableHeaders
+from python_multipart.multipart import MultipartParser, parse_options_header
 from dotenv import load_dotenv
 from motor.motor_asyncio import AsyncIOMotorClient
 import os
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import text, DateTime, Column, func, bindparam
+from sqlalchemy import text, DateTime, Column, func, bindparam, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import DBAPIError
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict
+from pydantic import BaseModel, Field, ConfigDict, TypeAdapter, ValidationError
 from typing import List, Optional, Dict, Any, Union
 from uuid import uuid4
 from datetime import datetime, date, timezone, timedelta
 from enum import Enum
 import bcrypt
+import jwt
+import secrets
 from decimal import Decimal
 from contextlib import asynccontextmanager
 import uuid
+import orjson
+import numpy as np
+import pandas as pd
+import base64
+import json
+import csv
+import io
+import time
+import math
+import hashlib
+import random
+import asyncio
+import asyncpg
+import re
+import sys
+from collections import defaultdict, deque, OrderedDict
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
 
 # Load environment variables
 ROOT_DIR = Path(__file__).parent
@@ -39,10 +68,44 @@ DATABASE_URL = os.getenv("DATABASE_URL").replace(
     "postgresql://", "postgresql+asyncpg://"
 )
 
-# Disable prepared statement caching to avoid InvalidCachedStatementError
-engine = create_async_engine(
-    DATABASE_URL, echo=True, execution_options={"prepared_statement_cache_size": 0}
-)
+# asyncpg prepared statement cache (per connection). Statements invalidated by
+# schema changes are recovered by QueryRegistry.execute below.
+PREPARED_STATEMENT_CACHE_SIZE = int(os.getenv("PREPARED_STATEMENT_CACHE_SIZE", "500"))
+
+# Connection pool sizing. Each worker holds up to DB_POOL_SIZE + DB_MAX_OVERFLOW
+# connections; recycle below any server/proxy idle timeout.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT_SECONDS", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE_SECONDS", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "false").lower() == "true"
+
+
+
+def create_db_engine(url: str):
+    return create_async_engine(
+        make_url(url).update_query_dict(
+            {"prepared_statement_cache_size": str(PREPARED_STATEMENT_CACHE_SIZE)}
+        ),
+        echo=os.getenv("SQL_ECHO", "false").lower() == "true",
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+    )
+
+
+engine = create_db_engine(DATABASE_URL)
+
+# Optional read replicas (comma separated). GET handlers read through
+# read_db(), which routes to them; see "Read replica routing" below.
+DATABASE_REPLICA_URLS = [
+    url.strip().replace("postgresql://", "postgresql+asyncpg://")
+    for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",")
+    if url.strip()
+]
+replica_engines = [create_db_engine(url) for url in DATABASE_REPLICA_URLS]
 
 async_session = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
 db = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
@@ -107,6 +170,28 @@ class InvoiceStatus(str, Enum):
     PAID = "PAID"
 
 
+class InvoiceRunStatus(str, Enum):
+    PENDING = "PENDING"
+    RUNNING = "RUNNING"
+    COMPLETED = "COMPLETED"
+    FAILED = "FAILED"
+
+
+class AuditAction(str, Enum):
+    CREATE = "CREATE"
+    UPDATE = "UPDATE"
+    DELETE = "DELETE"
+
+
+class ExportFormat(str, Enum):
+    NDJSON = "ndjson"
+    CSV = "csv"
+
+
+class ExpandOption(str, Enum):
+    DETAIL = "detail"
+
+
 # Helper functions
 def prepare_for_mongo(data: dict) -> dict:
     """Prepare data for MongoDB storage by converting non-serializable types"""
@@ -156,6 +241,734 @@ def parse_from_mongo(item: dict) -> dict:
     return item
 
 
+# Keyset pagination
+MAX_PAGE_SIZE = 1000
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(created_at: Union[datetime, str], row_id: Any) -> str:
+    """Encode the (created_at, id) position of the last row into an opaque cursor"""
+    if isinstance(created_at, datetime):
+        created_at = created_at.isoformat()
+    payload = json.dumps([created_at, str(row_id)])
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """Decode an opaque cursor back into its (created_at, id) position"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, row_id = json.loads(base64.urlsafe_b64decode(padded))
+        return datetime.fromisoformat(created_at), row_id
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def apply_keyset_pagination(
+    query: str,
+    params: dict,
+    limit: Optional[int],
+    cursor: Optional[str],
+    default_order: str = "",
+) -> str:
+    """Append keyset conditions, ordering and LIMIT to a `WHERE 1=1 ...` query.
+
+    Without a limit the query keeps its unpaginated behaviour and
+    `default_order`. With a limit, rows are ordered on (created_at, id) and
+    one extra row is fetched so the caller can tell whether a next page exists.
+    """
+    if limit is None:
+        return f"{query} {default_order}"
+
+    if cursor:
+        cursor_created_at, cursor_id = decode_cursor(cursor)
+        query += " AND (created_at, id) < (:cursor_created_at, :cursor_id)"
+        params["cursor_created_at"] = cursor_created_at
+        params["cursor_id"] = cursor_id
+
+    params["page_limit"] = limit + 1
+    return f"{query} ORDER BY created_at DESC, id DESC LIMIT :page_limit"
+
+
+def paginate_rows(rows: list, limit: Optional[int], response: Response) -> list:
+    """Trim the look-ahead row and expose the next cursor as a response header"""
+    if limit is None or len(rows) <= limit:
+        return rows
+
+    rows = rows[:limit]
+    last = rows[-1]._mapping
+    response.headers[NEXT_CURSOR_HEADER] = encode_cursor(last["created_at"], last["id"])
+    return rows
+
+
+# Shared row serialization
+# With FAST_ROW_RESPONSES enabled, list endpoints return pre-encoded JSON and
+# skip FastAPI's response_model re-validation of rows that came straight from
+# our own tables.
+FAST_ROW_RESPONSES = os.getenv("FAST_ROW_RESPONSES", "false").lower() == "true"
+PG_TIMESTAMP_COLUMNS = ("created_at", "updated_at")
+
+
+def normalize_pg_timestamp(value: str) -> str:
+    """Turn a PostgreSQL timestamp string ("2025-11-04 07:40:51.405604+00") into ISO 8601"""
+    value = value.replace(" ", "T")
+    if value.endswith("+00"):
+        value += ":00"
+    return value
+
+
+def orjson_default(value: Any) -> Any:
+    if isinstance(value, Decimal):
+        return float(value)
+    # asyncpg's UUID subclasses uuid.UUID, which orjson only encodes exactly
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    raise TypeError
+
+
+class RowSerializer:
+    """Column-aware row converter, built once per result shape.
+
+    Converters are picked per column from the first non-null value seen, so
+    the per-row work is a zip plus conversions for the few columns that need
+    them. `to_json` leaves what it can (datetimes, dates, stdlib UUIDs) to
+    orjson, which encodes them natively.
+    """
+
+    def __init__(self, keys: tuple):
+        self.keys = keys
+        self.dict_converters: Dict[int, Any] = {}
+        self.json_converters: Dict[int, Any] = {}
+        self.unresolved = set(range(len(keys)))
+
+    def resolve(self, rows: list) -> None:
+        for row in rows:
+            if not self.unresolved:
+                return
+            for index in list(self.unresolved):
+                value = row[index]
+                if value is None:
+                    continue
+                self.unresolved.discard(index)
+                if isinstance(value, uuid.UUID):
+                    self.dict_converters[index] = str
+                    # orjson only encodes the exact uuid.UUID type natively,
+                    # not asyncpg's UUID subclass
+                    if type(value) is not uuid.UUID:
+                        self.json_converters[index] = str
+                elif isinstance(value, datetime):
+                    self.dict_converters[index] = datetime.isoformat
+                elif isinstance(value, str) and self.keys[index] in PG_TIMESTAMP_COLUMNS:
+                    self.dict_converters[index] = normalize_pg_timestamp
+                    self.json_converters[index] = normalize_pg_timestamp
+
+    def convert(self, rows: list, converters: Dict[int, Any]) -> List[dict]:
+        keys = self.keys
+        if not converters:
+            return [dict(zip(keys, row)) for row in rows]
+
+        items = list(converters.items())
+        records = []
+        for row in rows:
+            values = list(row)
+            for index, converter in items:
+                if values[index] is not None:
+                    values[index] = converter(values[index])
+            records.append(dict(zip(keys, values)))
+        return records
+
+    def to_dicts(self, rows: list) -> List[dict]:
+        self.resolve(rows)
+        return self.convert(rows, self.dict_converters)
+
+    def to_json(self, rows: list) -> bytes:
+        self.resolve(rows)
+        return orjson.dumps(self.convert(rows, self.json_converters), default=orjson_default)
+
+
+_row_serializers: Dict[tuple, RowSerializer] = {}
+
+
+def row_serializer(keys) -> RowSerializer:
+    keys = tuple(keys)
+    serializer = _row_serializers.get(keys)
+    if serializer is None:
+        serializer = _row_serializers[keys] = RowSerializer(keys)
+    return serializer
+
+
+def rows_response(rows: list, response: Response):
+    """Serialize list-endpoint rows, as plain dicts or as pre-encoded JSON"""
+    if FAST_ROW_RESPONSES:
+        # Returning a Response bypasses response_model validation, so carry
+        # over headers (e.g. the pagination cursor) already set on `response`
+        body = row_serializer(rows[0]._fields).to_json(rows) if rows else b"[]"
+        return Response(body, media_type="application/json", headers=dict(response.headers))
+
+    if not rows:
+        return []
+    return row_serializer(rows[0]._fields).to_dicts(rows)
+
+
+# Company-group scoping (company_closure is maintained under "Company groups")
+def company_scope(include_descendants: bool, column: str = "company_id") -> str:
+    """SQL condition matching :company_id, or its whole group"""
+    if include_descendants:
+        return (
+            f"{column} IN (SELECT descendant_id FROM company_closure "
+            "WHERE ancestor_id = CAST(:company_id AS uuid))"
+        )
+    return f"{column} = CAST(:company_id AS uuid)"
+
+
+def scoped_tables(tables: tuple, include_descendants: bool) -> tuple:
+    """ETag tables for a company-scoped list; groups change with the company tree"""
+    return tables + ("companies",) if include_descendants else tables
+
+
+# Streaming exports
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "1000"))
+
+
+def export_value(value: Any) -> Any:
+    """Convert a DB value into something both json and csv can write"""
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, Enum):
+        return value.value
+    return value
+
+
+async def stream_rows(query: str, params: dict, fmt: ExportFormat):
+    """Stream rows from a server-side cursor, encoding one chunk at a time"""
+    async with read_db() as session:
+        result = await session.stream(
+            text(query), params, execution_options={"yield_per": EXPORT_CHUNK_SIZE}
+        )
+        keys = list(result.keys())
+
+        if fmt == ExportFormat.CSV:
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(keys)
+            yield buffer.getvalue()
+
+        async for partition in result.partitions(EXPORT_CHUNK_SIZE):
+            buffer = io.StringIO()
+            if fmt == ExportFormat.CSV:
+                writer = csv.writer(buffer)
+                for row in partition:
+                    writer.writerow(
+                        ["" if v is None else export_value(v) for v in row]
+                    )
+            else:
+                for row in partition:
+                    buffer.write(
+                        json.dumps(dict(zip(keys, (export_value(v) for v in row))))
+                    )
+                    buffer.write("\n")
+            yield buffer.getvalue()
+
+
+def export_response(
+    query: str, params: dict, fmt: ExportFormat, filename: str
+) -> StreamingResponse:
+    media_type = "text/csv" if fmt == ExportFormat.CSV else "application/x-ndjson"
+    return StreamingResponse(
+        stream_rows(query, params, fmt),
+        media_type=media_type,
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}.{fmt.value}"'
+        },
+    )
+
+
+def entity_export_query(
+    table: str,
+    company_id: Optional[str],
+    status: Optional[EntityStatus],
+    include_descendants: bool = False,
+) -> tuple:
+    """Build the filtered export query shared by the entity subtype tables"""
+    query = f"SELECT * FROM {table} WHERE 1=1"
+    params = {}
+
+    if company_id:
+        query += f" AND {company_scope(include_descendants)}"
+        params["company_id"] = str(company_id)
+
+    if status:
+        query += " AND status = :status"
+        params["status"] = status.value if isinstance(status, Enum) else status
+
+    return query, params
+
+
+# Dashboard snapshot cache, keyed by (company_id, include_descendants);
+# company_id None = all companies
+DASHBOARD_STATS_TTL = float(os.getenv("DASHBOARD_STATS_TTL_SECONDS", "30"))
+_dashboard_stats_cache: Dict[tuple, tuple] = {}
+
+
+def invalidate_dashboard_stats() -> None:
+    """Drop every cached dashboard snapshot after a write to the counted tables"""
+    _dashboard_stats_cache.clear()
+
+
+def dashboard_window_start(now: datetime) -> datetime:
+    """Start of the 30-day endorsement window: midnight UTC, so it moves once a day"""
+    return now.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=30)
+
+
+# Conditional GET
+# A statement trigger (see SCHEMA_MIGRATIONS) queues a row in table_changes
+# on every write, from any worker or job. Once the write has committed,
+# fold_table_changes() turns queued rows into bumps of table_versions: right
+# before a write request's response goes out (TableVersionMiddleware), and
+# every TABLE_VERSION_FOLD_INTERVAL_SECONDS for writes made outside requests.
+# Writers therefore never contend on a shared version row, and a version only
+# moves after the data it covers is visible. ETags hash those versions with
+# the request URL, so they change exactly when a response can, and checking
+# one costs a primary-key lookup instead of the row query.
+TABLE_VERSION_FOLD_INTERVAL_SECONDS = float(
+    os.getenv("TABLE_VERSION_FOLD_INTERVAL_SECONDS", "1")
+)
+VERSIONED_TABLES = (
+    "companies",
+    "entities",
+    "employees",
+    "students",
+    "vessels",
+    "vehicles",
+    "policies",
+    "endorsements",
+)
+
+
+# SKIP LOCKED: concurrent folds split the queue instead of waiting on each
+# other, and table_versions rows are locked in name order
+FOLD_TABLE_CHANGES = text("""
+    WITH folded AS (
+        DELETE FROM table_changes
+        WHERE id IN (SELECT id FROM table_changes FOR UPDATE SKIP LOCKED)
+        RETURNING table_name
+    )
+    INSERT INTO table_versions (table_name, version, changed_at)
+    SELECT table_name, count(*), now() FROM folded
+    GROUP BY table_name
+    ORDER BY table_name
+    ON CONFLICT (table_name) DO UPDATE
+    SET version = table_versions.version + EXCLUDED.version, changed_at = now()
+""")
+
+
+async def fold_table_changes() -> None:
+    """Publish committed writes to table_versions, in a short transaction of its own"""
+    async with db() as session:
+        await session.execute(FOLD_TABLE_CHANGES)
+        await session.commit()
+
+
+async def table_version_fold_loop() -> None:
+    while True:
+        try:
+            await fold_table_changes()
+        except Exception:
+            logging.getLogger(__name__).exception("Folding table changes failed")
+        await asyncio.sleep(TABLE_VERSION_FOLD_INTERVAL_SECONDS)
+
+
+class TableVersionMiddleware:
+    """Bump table versions for a write request before its response is sent.
+
+    Only requests that issued a write statement pay for the fold, so logins,
+    rejected requests and other read-only POSTs add no round trip.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] in ("GET", "HEAD", "OPTIONS"):
+            await self.app(scope, receive, send)
+            return
+
+        async def send_after_fold(message):
+            # The handler has committed by now, so the client's next
+            # conditional GET already sees the new versions
+            stats = request_query_stats.get()
+            wrote = stats is None or stats["wrote"]
+            if message["type"] == "http.response.start" and wrote:
+                try:
+                    await fold_table_changes()
+                except Exception:
+                    logging.getLogger(__name__).exception("Folding table changes failed")
+            await send(message)
+
+        await self.app(scope, receive, send_after_fold)
+
+
+async def table_versions(session: AsyncSession, tables: tuple) -> Dict[str, int]:
+    result = await QUERIES.execute(session, "table_versions.lookup", {"tables": list(tables)})
+    versions = dict.fromkeys(tables, 0)
+    versions.update({row.table_name: row.version for row in result.fetchall()})
+    return versions
+
+
+def build_etag(request: Request, versions: Dict[str, int], *extra) -> str:
+    key = "|".join(
+        [
+            request.url.path,
+            str(sorted(request.query_params.multi_items())),
+            *(f"{table}:{version}" for table, version in sorted(versions.items())),
+            *map(str, extra),
+        ]
+    )
+    return f'"{hashlib.blake2b(key.encode(), digest_size=12).hexdigest()}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return etag in {tag.strip().removeprefix("W/") for tag in header.split(",")}
+
+
+async def check_not_modified(
+    session: AsyncSession,
+    request: Request,
+    response: Response,
+    tables: tuple,
+    *extra,
+    versions: Optional[Dict[str, int]] = None,
+) -> Optional[Response]:
+    """Set the ETag on `response`; return a 304 if the client already has it.
+
+    Pass `versions` when the caller has already read them for `tables`.
+    """
+    if versions is None:
+        versions = await table_versions(session, tables)
+    etag = build_etag(request, versions, *extra)
+    # no-cache: browsers may store the response but must revalidate it
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+    # End the lookup's transaction so the row query opens its own and can still
+    # recover from invalidated cached statements (see QueryRegistry.execute)
+    await session.commit()
+    return None
+
+
+# Read-through response cache
+# Encoded GET responses for slowly changing reference data (companies,
+# entities, single-record lookups). Entries are keyed by URL plus the current
+# generation of each namespace they depend on, and writes bump those
+# generations, so invalidation is precise and a load racing a write can never
+# store stale data under the new generation. Loads read the primary: a replica
+# that has not replayed the write yet would fill the new generation with the
+# old data for a whole TTL. The default backend is an LRU
+# local to the worker, where TTL bounds staleness from other workers' writes;
+# RESPONSE_CACHE_BACKEND=redis shares entries and invalidations (needs the
+# `redis` package).
+RESPONSE_CACHE_BACKEND = os.getenv("RESPONSE_CACHE_BACKEND", "memory").lower()
+RESPONSE_CACHE_URL = os.getenv("RESPONSE_CACHE_URL", "redis://localhost:6379/0")
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "60"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "4096"))
+RESPONSE_CACHE_PREFIX = "policyzen:cache:"
+
+
+class MemoryCacheBackend:
+    """LRU with a per-entry TTL, local to this worker"""
+
+    name = "memory"
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: OrderedDict = OrderedDict()
+        # namespace -> (generation, bumped_at)
+        self.generations: Dict[str, tuple] = {}
+        self.evictions = 0
+        self.expirations = 0
+
+    async def generations_for(self, namespaces: tuple) -> list:
+        return [self.generations.get(ns, (0, 0))[0] for ns in namespaces]
+
+    async def bump(self, namespaces: tuple) -> None:
+        now = time.monotonic()
+        for ns in namespaces:
+            self.generations[ns] = (self.generations.get(ns, (0, 0))[0] + 1, now)
+        if len(self.generations) > self.max_entries:
+            # Any entry stored before a bump older than the TTL has expired,
+            # so such namespaces can safely start again from generation 0
+            self.generations = {
+                ns: state for ns, state in self.generations.items() if now - state[1] < self.ttl
+            }
+
+    async def get(self, key: str) -> Optional[tuple]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self.entries[key]
+            self.expirations += 1
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: tuple) -> None:
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    async def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+    async def close(self) -> None:
+        pass
+
+
+class RedisCacheBackend:
+    """Entries and generations in Redis, shared by every worker"""
+
+    name = "redis"
+
+    def __init__(self, url: str, ttl: float):
+        import redis.asyncio as redis
+
+        self.client = redis.from_url(url)
+        self.ttl = ttl
+
+    async def generations_for(self, namespaces: tuple) -> list:
+        values = await self.client.mget([f"{RESPONSE_CACHE_PREFIX}gen:{ns}" for ns in namespaces])
+        return [int(value or 0) for value in values]
+
+    async def bump(self, namespaces: tuple) -> None:
+        async with self.client.pipeline(transaction=False) as pipe:
+            for ns in namespaces:
+                key = f"{RESPONSE_CACHE_PREFIX}gen:{ns}"
+                pipe.incr(key)
+                # Same reasoning as the memory backend: once the TTL has passed
+                # since the last bump, restarting at 0 cannot revive an entry
+                pipe.expire(key, math.ceil(self.ttl) + 1)
+            await pipe.execute()
+
+    async def get(self, key: str) -> Optional[tuple]:
+        raw = await self.client.get(RESPONSE_CACHE_PREFIX + key)
+        if raw is None:
+            return None
+        entry = orjson.loads(raw)
+        return entry["body"].encode("utf-8"), entry["headers"]
+
+    async def set(self, key: str, value: tuple) -> None:
+        body, headers = value
+        await self.client.set(
+            RESPONSE_CACHE_PREFIX + key,
+            orjson.dumps({"body": body.decode("utf-8"), "headers": headers}),
+            px=int(self.ttl * 1000),
+        )
+
+    async def stats(self) -> dict:
+        info = await self.client.info("stats")
+        return {
+            "evictions": info.get("evicted_keys"),
+            "expirations": info.get("expired_keys"),
+        }
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+
+class ResponseCache:
+    """Read-through cache of encoded JSON responses.
+
+    Cache failures never fail a request: they count as errors and the
+    response is loaded from the database as if the cache were empty.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.counters = dict.fromkeys(("hits", "misses", "errors", "invalidations"), 0)
+
+    async def fetch(self, request: Request, namespaces: tuple, load) -> Response:
+        """Serve from cache, or await `load()` for a (body, headers) entry and store it.
+
+        `load` may also return a Response (e.g. a 304), which is passed through.
+        """
+        key = entry = None
+        if self.backend is not None:
+            try:
+                generations = await self.backend.generations_for(namespaces)
+                key = "|".join(
+                    [
+                        request.url.path,
+                        str(sorted(request.query_params.multi_items())),
+                        *(f"{ns}={gen}" for ns, gen in zip(namespaces, generations)),
+                    ]
+                )
+                entry = await self.backend.get(key)
+            except Exception as e:
+                self.counters["errors"] += 1
+                logging.getLogger(__name__).warning("Response cache read failed: %s", e)
+
+        if entry is None:
+            self.counters["misses"] += 1
+            entry = await load()
+            if isinstance(entry, Response):
+                return entry
+            if key is not None:
+                try:
+                    await self.backend.set(key, entry)
+                except Exception as e:
+                    self.counters["errors"] += 1
+                    logging.getLogger(__name__).warning("Response cache write failed: %s", e)
+        else:
+            self.counters["hits"] += 1
+
+        body, headers = entry
+        etag = headers.get("etag")
+        if etag and etag_matches(request, etag):
+            return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+        return Response(body, media_type="application/json", headers=headers)
+
+    def session(self) -> AsyncSession:
+        """Session for loads that fill the cache; only uncached loads may use a replica"""
+        return db() if self.backend is not None else read_db()
+
+    async def invalidate(self, *namespaces: str) -> None:
+        if self.backend is None or not namespaces:
+            return
+        self.counters["invalidations"] += 1
+        try:
+            await self.backend.bump(namespaces)
+        except Exception as e:
+            self.counters["errors"] += 1
+            logging.getLogger(__name__).warning("Response cache invalidation failed: %s", e)
+
+    async def stats(self) -> dict:
+        stats = {"backend": self.backend.name if self.backend else None, **self.counters}
+        lookups = self.counters["hits"] + self.counters["misses"]
+        stats["hit_ratio"] = self.counters["hits"] / lookups if lookups else None
+        if self.backend is not None:
+            try:
+                stats.update(await self.backend.stats())
+            except Exception as e:
+                stats["backend_error"] = str(e)
+        return stats
+
+
+def create_cache_backend():
+    if RESPONSE_CACHE_BACKEND == "redis":
+        return RedisCacheBackend(RESPONSE_CACHE_URL, RESPONSE_CACHE_TTL)
+    if RESPONSE_CACHE_BACKEND == "memory":
+        return MemoryCacheBackend(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL)
+    # "none" (or anything else) disables caching
+    return None
+
+
+RESPONSE_CACHE = ResponseCache(create_cache_backend())
+
+
+# response model -> TypeAdapter for a list of it
+_cache_entry_adapters: Dict[Any, TypeAdapter] = {}
+
+
+def cache_entry(rows: list, response: Response, model, one: bool = False) -> tuple:
+    """Encode rows (or the single row, with `one`) with the headers set so far.
+
+    Cached bodies bypass response_model, so they are encoded through `model`
+    here; with FAST_ROW_RESPONSES the rows are encoded directly, as in
+    rows_response.
+    """
+    if FAST_ROW_RESPONSES:
+        body = row_serializer(rows[0]._fields).to_json(rows) if rows else b"[]"
+    else:
+        adapter = _cache_entry_adapters.get(model)
+        if adapter is None:
+            adapter = _cache_entry_adapters[model] = TypeAdapter(List[model])
+        records = row_serializer(rows[0]._fields).to_dicts(rows) if rows else []
+        body = adapter.dump_json(adapter.validate_python(records))
+    return (body[1:-1] if one else body), dict(response.headers)
+
+
+async def invalidate_entity_cache(table: str, entity_id: Optional[str], company_id: Any) -> None:
+    """Drop cached entity lists for the company and the record's own lookup"""
+    namespaces = ["entities"]
+    if company_id:
+        namespaces.append(f"entities:{company_id}")
+    if entity_id:
+        namespaces.append(f"{table}:{entity_id}")
+    await RESPONSE_CACHE.invalidate(*namespaces)
+
+
+# Entity detail expansion
+# `?expand=detail` resolves the polymorphic entity pointers server-side with
+# one `id = ANY(:ids)` query per entity type, instead of one request per row.
+ENTITY_TABLES = {
+    EntityType.EMPLOYEE.value: "employees",
+    EntityType.STUDENT.value: "students",
+    EntityType.SHIP.value: "vessels",
+    EntityType.VEHICLE.value: "vehicles",
+}
+
+
+def row_dicts(result) -> List[dict]:
+    rows = result.fetchall()
+    return row_serializer(result.keys()).to_dicts(rows) if rows else []
+
+
+async def attach_entity_details(session: AsyncSession, entities: List[dict]) -> None:
+    """Set `detail` on each entity to its employee/student/vessel/vehicle record"""
+    ids_by_type = defaultdict(set)
+    for entity in entities:
+        ids_by_type[entity["type"]].add(entity["entity_id"])
+
+    details = {}
+    for entity_type, ids in ids_by_type.items():
+        table = ENTITY_TABLES.get(entity_type)
+        if table is None:
+            continue
+        result = await QUERIES.execute(session, f"{table}.by_ids", {"ids": list(ids)})
+        for record in row_dicts(result):
+            details[(entity_type, record["id"])] = record
+
+    for entity in entities:
+        entity["detail"] = details.get((entity["type"], entity["entity_id"]))
+
+
+async def attach_policy_entities(session: AsyncSession, policies: List[dict]) -> None:
+    """Set `entity` on each policy, with its detail record attached"""
+    ids = list({policy["entity_id"] for policy in policies if policy["entity_id"]})
+    entities = []
+    if ids:
+        result = await QUERIES.execute(session, "entities.by_ids", {"ids": ids})
+        entities = row_dicts(result)
+        await attach_entity_details(session, entities)
+
+    by_id = {entity["id"]: entity for entity in entities}
+    for policy in policies:
+        policy["entity"] = by_id.get(policy["entity_id"])
+
+
+def expanded_body(records: List[dict]) -> bytes:
+    return orjson.dumps(records, default=orjson_default)
+
+
 # Pydantic Models
 class CompanyBase(BaseModel):
     name: str
@@ -220,111 +1033,3809 @@ class Student(StudentBase):
     updated_at: datetime = Column(DateTime(timezone=True), onupdate=func.now())
 
 
-class VesselBase(BaseModel):
-    company_id: str
-    vessel_name: str
-    imo_number: str
-    status: EntityStatus = EntityStatus.ACTIVE
-    vessel_type: Optional[str] = None
-    flag: Optional[str] = None
+class VesselBase(BaseModel):
+    company_id: str
+    vessel_name: str
+    imo_number: str
+    status: EntityStatus = EntityStatus.ACTIVE
+    vessel_type: Optional[str] = None
+    flag: Optional[str] = None
+
+
+class Vessel(VesselBase):
+    model_config = ConfigDict(extra="ignore")
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    created_at: datetime = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at: datetime = Column(DateTime(timezone=True), onupdate=func.now())
+
+
+class VehicleBase(BaseModel):
+    company_id: str
+    registration_number: str
+    make: str
+    model: str
+    year: int
+    status: EntityStatus = EntityStatus.ACTIVE
+
+
+class Vehicle(VehicleBase):
+    model_config = ConfigDict(extra="ignore")
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    created_at: datetime = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at: datetime = Column(DateTime(timezone=True), onupdate=func.now())
+
+
+class EntityBase(BaseModel):
+    company_id: str
+    type: EntityType
+    entity_id: str  # Reference to specific entity (employee, student, etc.)
+    description: Optional[str] = None
+
+
+class Entity(EntityBase):
+    model_config = ConfigDict(extra="ignore")
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+
+class InsurancePolicyBase(BaseModel):
+    entity_id: str
+    policy_number: str
+    insurance_type: InsuranceType
+    provider: str
+    start_date: date
+    end_date: date
+    sum_insured: float
+    premium_amount: float
+    status: PolicyStatus = PolicyStatus.ACTIVE
+    created_by: str
+
+
+class InsurancePolicy(InsurancePolicyBase):
+    model_config = ConfigDict(extra="ignore")
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+
+class EndorsementChange(BaseModel):
+    # A policy field, or "entities" for ADDED/REMOVED covered entities
+    field: str
+    change_type: EndorsementChangeType
+    # Recorded from the policy state on the effective date; REMOVED takes
+    # the entity id here
+    old_value: Any = None
+    new_value: Any = None
+
+
+class PolicyEndorsementBase(BaseModel):
+    policy_id: str
+    endorsement_number: str
+    description: str
+    effective_date: date
+    created_by: str
+    # Change to written premium, earned from effective_date to the policy end
+    premium_adjustment: float = 0
+    changes: List[EndorsementChange] = []
+
+
+class PolicyEndorsement(PolicyEndorsementBase):
+    model_config = ConfigDict(extra="ignore")
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+
+class DocumentBase(BaseModel):
+    policy_id: Optional[str] = None
+    endorsement_id: Optional[str] = None
+    uploaded_by: str
+    file_name: str
+    file_path: str
+    file_type: str
+    document_type: DocumentType
+
+
+class Document(DocumentBase):
+    model_config = ConfigDict(extra="ignore")
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    uploaded_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    content_hash: Optional[str] = None
+    size_bytes: Optional[int] = None
+
+
+class Invoice(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str
+    invoice_number: str
+    run_id: Optional[str] = None
+    policy_id: str
+    company_id: Optional[str] = None
+    period_start: date
+    period_end: date
+    # Instalments instalment_from..instalment_to of `instalments` in the term
+    instalment_from: int
+    instalment_to: int
+    instalments: int
+    amount: float
+    invoice_date: date
+    due_date: date
+    status: InvoiceStatus = InvoiceStatus.DRAFT
+    created_at: datetime
+    updated_at: datetime
+
+
+class InvoiceRunRequest(BaseModel):
+    # Whole calendar months: period_end defaults to the end of period_start's month
+    period_start: date
+    period_end: Optional[date] = None
+    company_id: Optional[str] = None
+    include_descendants: bool = False
+    invoice_date: Optional[date] = None
+    due_days: int = Field(30, ge=0, le=365)
+
+
+# Bulk import report models
+class BulkRowResult(BaseModel):
+    row: int
+    status: str
+    id: Optional[str] = None
+    errors: List[str] = []
+
+
+class BulkImportReport(BaseModel):
+    total: int = 0
+    created: int = 0
+    failed: int = 0
+    results: List[BulkRowResult] = []
+
+
+# Authenticated caller, decoded from an access token
+class Principal(BaseModel):
+    user_id: str
+    role: UserRole
+    company_id: str
+    jti: str
+    expires_at: float
+
+
+# Bulk policy operation models
+class PolicyBulkFilter(BaseModel):
+    provider: Optional[str] = None
+    insurance_type: Optional[InsuranceType] = None
+    end_date_from: Optional[date] = None
+    end_date_to: Optional[date] = None
+
+
+class PolicyBulkSelection(BaseModel):
+    # Either explicit ids or a filter, never both
+    policy_ids: Optional[List[str]] = None
+    filter: Optional[PolicyBulkFilter] = None
+
+
+class PolicyBulkStatusUpdate(PolicyBulkSelection):
+    status: PolicyStatus
+
+
+class PolicyRenewalRequest(PolicyBulkSelection):
+    created_by: str
+    premium_adjustment_percent: float = 0.0
+    # Defaults to the day after each policy's current end_date
+    start_date: Optional[date] = None
+
+
+class PolicyBulkFailure(BaseModel):
+    policy_id: str
+    error: str
+
+
+class PolicyBulkResult(BaseModel):
+    matched: int = 0
+    succeeded: int = 0
+    failures: List[PolicyBulkFailure] = []
+    # Original policy id -> renewed policy id (renewals only)
+    renewed: Dict[str, str] = {}
+
+
+# Dashboard stats model
+class DashboardStats(BaseModel):
+    total_policies: int = 0
+    active_policies: int = 0
+    expired_policies: int = 0
+    total_premium: float = 0.0
+    total_entities: int = 0
+    recent_endorsements: int = 0
+
+
+# SQL instrumentation
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv("SLOW_QUERY_THRESHOLD_MS", "200"))
+SLOW_QUERY_EXPLAIN_SAMPLE_RATE = float(os.getenv("SLOW_QUERY_EXPLAIN_SAMPLE_RATE", "0"))
+QUERY_METRICS_WINDOW = int(os.getenv("QUERY_METRICS_WINDOW", "500"))
+
+slow_query_logger = logging.getLogger(f"{__name__}.slow_queries")
+
+# Per-request accumulator, set by QueryInstrumentationMiddleware
+request_query_stats: ContextVar[Optional[dict]] = ContextVar(
+    "request_query_stats", default=None
+)
+_background_tasks = set()
+
+
+HTTP_METHODS = frozenset({"GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"})
+UNMATCHED_ENDPOINT = "<unmatched>"
+
+
+def endpoint_label(scope: Optional[dict]) -> Optional[str]:
+    """Label a request by its route template, e.g. "GET /api/policies/{policy_id}"
+
+    Unrouted paths and unknown methods share one label, so scanners cannot grow
+    the per-endpoint metrics without bound.
+    """
+    if scope is None:
+        return None
+    route = scope.get("route")
+    if route is None or scope["method"] not in HTTP_METHODS:
+        return UNMATCHED_ENDPOINT
+    return f"{scope['method']} {route.path}"
+
+
+class QueryMetrics:
+    """Per-statement totals and a rolling per-endpoint window of requests"""
+
+    def __init__(self, window: int):
+        self.statements: Dict[str, Dict[str, Any]] = {}
+        self.requests: Dict[str, deque] = defaultdict(lambda: deque(maxlen=window))
+
+    def record_statement(
+        self, statement: str, endpoint: Optional[str], elapsed_ms: float, rows: int
+    ) -> None:
+        stats = self.statements.get(statement)
+        if stats is None:
+            stats = self.statements[statement] = {
+                "calls": 0,
+                "total_ms": 0.0,
+                "max_ms": 0.0,
+                "rows": 0,
+                "endpoints": set(),
+            }
+        stats["calls"] += 1
+        stats["total_ms"] += elapsed_ms
+        stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+        stats["rows"] += max(rows, 0)
+        if endpoint:
+            stats["endpoints"].add(endpoint)
+
+    def record_request(self, endpoint: str, queries: int, db_ms: float) -> None:
+        self.requests[endpoint].append((queries, db_ms))
+
+    def summary(self) -> dict:
+        endpoints = {}
+        for endpoint, window in self.requests.items():
+            db_times = sorted(db_ms for _, db_ms in window)
+            endpoints[endpoint] = {
+                "requests": len(window),
+                "avg_queries": sum(q for q, _ in window) / len(window),
+                "avg_db_ms": sum(db_times) / len(db_times),
+                "p95_db_ms": db_times[int(0.95 * (len(db_times) - 1))],
+                "max_db_ms": db_times[-1],
+            }
+
+        statements = [
+            {
+                "statement": statement,
+                "calls": stats["calls"],
+                "avg_ms": stats["total_ms"] / stats["calls"],
+                "max_ms": stats["max_ms"],
+                "rows": stats["rows"],
+                "endpoints": sorted(stats["endpoints"]),
+            }
+            for statement, stats in self.statements.items()
+        ]
+        statements.sort(key=lambda s: s["avg_ms"] * s["calls"], reverse=True)
+        return {"endpoints": endpoints, "statements": statements}
+
+
+QUERY_METRICS = QueryMetrics(QUERY_METRICS_WINDOW)
+
+
+class QueryInstrumentationMiddleware:
+    """Attribute SQL statements to the request that issued them"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = {"scope": scope, "queries": 0, "db_ms": 0.0, "wrote": False}
+        token = request_query_stats.set(stats)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            request_query_stats.reset(token)
+            QUERY_METRICS.record_request(
+                endpoint_label(scope), stats["queries"], stats["db_ms"]
+            )
+
+
+async def capture_explain(statement: str, parameters: Any, endpoint: Optional[str]) -> None:
+    """Log EXPLAIN (ANALYZE, BUFFERS) for a sampled slow SELECT on its own connection"""
+    try:
+        async with engine.connect() as conn:
+            result = await conn.exec_driver_sql(
+                f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {statement}",
+                parameters,
+                execution_options={"skip_instrumentation": True},
+            )
+            plan = result.scalar()
+            await conn.rollback()
+        slow_query_logger.warning(
+            json.dumps({"event": "slow_query_plan", "endpoint": endpoint, "plan": plan}, default=str)
+        )
+    except Exception as e:
+        slow_query_logger.warning("EXPLAIN capture failed: %s", e)
+
+
+# Statements that may change rows (not SELECT ... FOR UPDATE)
+WRITE_STATEMENT = re.compile(
+    r"\b(INSERT\s+INTO|UPDATE\s+\w+\s+SET|DELETE\s+FROM|TRUNCATE)\b", re.IGNORECASE
+)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._query_started = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context.execution_options.get("skip_instrumentation"):
+        return
+
+    elapsed_ms = (time.perf_counter() - context._query_started) * 1000
+    rows = cursor.rowcount
+    stats = request_query_stats.get()
+    endpoint = endpoint_label(stats["scope"]) if stats else None
+    if stats:
+        stats["queries"] += 1
+        stats["db_ms"] += elapsed_ms
+        if not stats["wrote"] and WRITE_STATEMENT.search(statement):
+            stats["wrote"] = True
+
+    QUERY_METRICS.record_statement(statement, endpoint, elapsed_ms, rows)
+
+    if elapsed_ms < SLOW_QUERY_THRESHOLD_MS:
+        return
+
+    slow_query_logger.warning(
+        json.dumps(
+            {
+                "event": "slow_query",
+                "endpoint": endpoint,
+                "duration_ms": round(elapsed_ms, 2),
+                "rows": rows,
+                "statement": " ".join(statement.split()),
+            }
+        )
+    )
+    if (
+        SLOW_QUERY_EXPLAIN_SAMPLE_RATE
+        and not executemany
+        and statement.lstrip().upper().startswith("SELECT")
+        and random.random() < SLOW_QUERY_EXPLAIN_SAMPLE_RATE
+    ):
+        task = asyncio.get_running_loop().create_task(
+            capture_explain(statement, parameters, endpoint)
+        )
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+
+
+for _engine in (engine, *replica_engines):
+    event.listen(_engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(_engine.sync_engine, "after_cursor_execute", after_cursor_execute)
+
+
+# Read replica routing
+# read_db() hands out sessions on healthy replicas round-robin and falls back
+# to the primary when none is healthy (or none is configured). A background
+# check probes each replica's reachability and replay lag. After a successful
+# write the client gets a short-lived cookie/header; requests carrying it read
+# from the primary so they see their own writes.
+REPLICA_HEALTH_CHECK_INTERVAL = float(os.getenv("REPLICA_HEALTH_CHECK_INTERVAL_SECONDS", "5"))
+REPLICA_HEALTH_CHECK_TIMEOUT = float(os.getenv("REPLICA_HEALTH_CHECK_TIMEOUT_SECONDS", "2"))
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", "10"))
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", "5"))
+READ_PRIMARY_COOKIE = "read_primary_until"
+READ_PRIMARY_HEADER = "X-Read-Primary-Until"
+
+# Replay lag in seconds; 0 when fully replayed, NULL on a primary
+REPLICA_LAG_SQL = text("""
+    SELECT CASE
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END
+""").execution_options(skip_instrumentation=True)
+
+# Set per request by ReadYourWritesMiddleware
+read_from_primary: ContextVar[bool] = ContextVar("read_from_primary", default=False)
+
+
+class ReplicaRouter:
+    """Round-robin read sessions over healthy replicas, failing over to the primary"""
+
+    def __init__(self, engines: list):
+        self.replicas = []
+        for replica_engine in engines:
+            replica = {
+                "engine": replica_engine,
+                "session": sessionmaker(
+                    replica_engine, class_=AsyncSession, expire_on_commit=False
+                ),
+                "healthy": True,
+                "lag_seconds": None,
+                "error": None,
+                "checked_at": None,
+            }
+            # Stop routing to a replica as soon as it drops connections; the
+            # health check brings it back
+            event.listen(
+                replica_engine.sync_engine,
+                "handle_error",
+                lambda context, replica=replica: self.mark_down(replica, context),
+            )
+            self.replicas.append(replica)
+        self._next = 0
+        self.stats = dict.fromkeys(("replica", "primary", "read_your_writes", "failovers"), 0)
+
+    def session(self) -> AsyncSession:
+        if read_from_primary.get():
+            self.stats["read_your_writes"] += 1
+            return db()
+        for _ in range(len(self.replicas)):
+            replica = self.replicas[self._next]
+            self._next = (self._next + 1) % len(self.replicas)
+            if replica["healthy"]:
+                self.stats["replica"] += 1
+                return replica["session"]()
+        if self.replicas:
+            self.stats["failovers"] += 1
+        self.stats["primary"] += 1
+        return db()
+
+    def mark_down(self, replica: dict, context) -> None:
+        if context.is_disconnect:
+            replica["healthy"] = False
+            replica["error"] = str(context.original_exception)
+
+    async def check(self, replica: dict) -> None:
+        async def probe():
+            async with replica["engine"].connect() as conn:
+                return (await conn.execute(REPLICA_LAG_SQL)).scalar()
+
+        try:
+            lag = await asyncio.wait_for(probe(), REPLICA_HEALTH_CHECK_TIMEOUT)
+            replica["lag_seconds"] = float(lag or 0)
+            replica["healthy"] = replica["lag_seconds"] <= REPLICA_MAX_LAG_SECONDS
+            replica["error"] = None if replica["healthy"] else "Replication lag too high"
+        except Exception as e:
+            replica["healthy"] = False
+            replica["error"] = str(e) or type(e).__name__
+        replica["checked_at"] = datetime.now(timezone.utc).isoformat()
+
+    async def check_all(self) -> None:
+        await asyncio.gather(*(self.check(replica) for replica in self.replicas))
+
+    async def health_loop(self) -> None:
+        while True:
+            await asyncio.sleep(REPLICA_HEALTH_CHECK_INTERVAL)
+            await self.check_all()
+
+    def status(self) -> list:
+        return [
+            {
+                "url": replica["engine"].url.render_as_string(hide_password=True),
+                **{k: replica[k] for k in ("healthy", "lag_seconds", "error", "checked_at")},
+                "pool": pool_status(replica["engine"]),
+            }
+            for replica in self.replicas
+        ]
+
+
+READ_REPLICAS = ReplicaRouter(replica_engines)
+
+
+def read_db() -> AsyncSession:
+    """Session for read-only handlers: a healthy replica, else the primary"""
+    return READ_REPLICAS.session()
+
+
+class ReadYourWritesMiddleware:
+    """Pin a client's reads to the primary for a few seconds after it writes"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not READ_REPLICAS.replicas:
+            await self.app(scope, receive, send)
+            return
+
+        request = Request(scope)
+        pinned_until = request.headers.get(READ_PRIMARY_HEADER) or request.cookies.get(
+            READ_PRIMARY_COOKIE
+        )
+        try:
+            pinned = float(pinned_until or 0) > time.time()
+        except ValueError:
+            pinned = False
+        is_write = scope["method"] not in ("GET", "HEAD", "OPTIONS")
+
+        async def send_with_pin(message):
+            if is_write and message["type"] == "http.response.start" and message["status"] < 400:
+                until = f"{time.time() + READ_YOUR_WRITES_SECONDS:.3f}"
+                headers = MutableHeaders(scope=message)
+                headers.append(READ_PRIMARY_HEADER, until)
+                headers.append(
+                    "set-cookie",
+                    f"{READ_PRIMARY_COOKIE}={until}; Max-Age={math.ceil(READ_YOUR_WRITES_SECONDS)}; "
+                    "Path=/; HttpOnly; SameSite=Lax",
+                )
+            await send(message)
+
+        token = read_from_primary.set(pinned)
+        try:
+            await self.app(scope, receive, send_with_pin)
+        finally:
+            read_from_primary.reset(token)
+
+
+# Named query registry
+class QueryRegistry:
+    """Hot statements built once with stable SQL text.
+
+    Stable text lets asyncpg reuse its per-connection prepared statements.
+    `execute` keeps per-statement counts of executions, first-time prepares
+    and plan-cache hits (tracked per pooled connection, so a hit means the
+    statement had already been prepared on that connection), and recovers
+    from statements invalidated by schema changes by re-preparing them.
+    """
+
+    def __init__(self):
+        self.statements: Dict[str, Any] = {}
+        self.variants: Dict[str, Any] = {}
+        self.stats: Dict[str, Dict[str, int]] = {}
+
+    def register(self, name: str, sql: str) -> None:
+        self.statements[name] = text(sql)
+        self.stats[name] = dict.fromkeys(
+            ("executions", "prepares", "cache_hits", "recoveries"), 0
+        )
+
+    def statement(self, name: str, sql: Optional[str]):
+        if sql is None:
+            return self.statements[name]
+        # Dynamically filtered lists: one statement per distinct SQL text
+        if sql not in self.variants:
+            self.variants[sql] = text(sql)
+            self.stats.setdefault(
+                name,
+                dict.fromkeys(("executions", "prepares", "cache_hits", "recoveries"), 0),
+            )
+        return self.variants[sql]
+
+    async def execute(
+        self,
+        session: AsyncSession,
+        name: str,
+        params: Optional[dict] = None,
+        sql: Optional[str] = None,
+    ):
+        statement = self.statement(name, sql)
+        stats = self.stats[name]
+        opened_transaction = not session.in_transaction()
+
+        connection = await session.connection()
+        prepared = connection.info.setdefault("prepared_statements", set())
+        key = statement.text
+        stats["executions"] += 1
+        if key in prepared:
+            stats["cache_hits"] += 1
+        else:
+            stats["prepares"] += 1
+            prepared.add(key)
+
+        try:
+            return await session.execute(statement, params or {})
+        except DBAPIError as e:
+            # The asyncpg dialect has already dropped its cached statements;
+            # retrying re-prepares against the new schema. Only safe when this
+            # statement opened the transaction, as the rollback discards it.
+            invalidated = type(e.orig).__name__ == "InvalidCachedStatementError"
+            if not invalidated or not opened_transaction:
+                raise
+            await session.rollback()
+            stats["recoveries"] += 1
+            connection = await session.connection()
+            connection.info["prepared_statements"] = {key}
+            return await session.execute(statement, params or {})
+
+
+def dashboard_stats_sql(scoped: bool, include_descendants: bool = False) -> str:
+    policy_scope = entity_scope = endorsement_scope = ""
+    if scoped:
+        condition = company_scope(include_descendants)
+        policy_scope = entity_scope = f"WHERE {condition}"
+        endorsement_scope = f"""
+            AND policy_id IN (
+                SELECT id FROM policies WHERE {condition}
+            )
+        """
+
+    # One round trip, one pass over policies
+    return f"""
+        SELECT p.total_policies, p.active_policies, p.expired_policies,
+               p.total_premium, e.total_entities, n.recent_endorsements
+        FROM (
+            SELECT COUNT(*) AS total_policies,
+                   COUNT(*) FILTER (WHERE status = 'ACTIVE') AS active_policies,
+                   COUNT(*) FILTER (WHERE status = 'EXPIRED') AS expired_policies,
+                   COALESCE(SUM(premium_amount) FILTER (WHERE status = 'ACTIVE'), 0)
+                       AS total_premium
+            FROM policies {policy_scope}
+        ) p,
+        (SELECT COUNT(*) AS total_entities FROM entities {entity_scope}) e,
+        (
+            SELECT COUNT(*) AS recent_endorsements FROM endorsements
+            WHERE created_at >= :since {endorsement_scope}
+        ) n
+    """
+
+
+QUERIES = QueryRegistry()
+
+# Lookups by id
+for _table in ("companies", "employees", "students", "vessels", "vehicles", "policies"):
+    QUERIES.register(f"{_table}.by_id", f"SELECT * FROM {_table} WHERE id = :id")
+QUERIES.register("users.by_email", "SELECT * FROM users WHERE email = :email")
+for _table in ("entities", "employees", "students", "vessels", "vehicles"):
+    QUERIES.register(
+        f"{_table}.by_ids", f"SELECT * FROM {_table} WHERE id = ANY(CAST(:ids AS uuid[]))"
+    )
+QUERIES.register("policies.number_by_id", "SELECT policy_number FROM policies WHERE id = :id")
+QUERIES.register(
+    "documents.content",
+    "SELECT file_name, file_type, content_hash, size_bytes FROM documents WHERE id = :id",
+)
+
+# Duplicate checks
+QUERIES.register("users.email_exists", "SELECT 1 FROM users WHERE email = :email")
+QUERIES.register(
+    "employees.code_exists",
+    """
+    SELECT 1 FROM employees
+    WHERE employee_code = :employee_code
+    AND company_id = CAST(:company_id AS uuid)
+    """,
+)
+QUERIES.register(
+    "students.student_id_exists",
+    "SELECT 1 FROM students WHERE student_id = :student_id AND company_id = :company_id",
+)
+QUERIES.register("vessels.imo_exists", "SELECT 1 FROM vessels WHERE imo_number = :imo_number")
+QUERIES.register(
+    "vehicles.registration_exists",
+    "SELECT 1 FROM vehicles WHERE registration_number = :registration_number",
+)
+QUERIES.register(
+    "policies.number_exists_for_entity",
+    "SELECT 1 FROM policies WHERE policy_number = :policy_number AND entity_id = :entity_id",
+)
+QUERIES.register("policies.number_exists", "SELECT 1 FROM policies WHERE policy_number = :num")
+QUERIES.register(
+    "endorsements.number_exists",
+    "SELECT 1 FROM endorsements WHERE endorsement_number = :endorsement_number",
+)
+
+QUERIES.register(
+    "table_versions.lookup",
+    "SELECT table_name, version FROM table_versions WHERE table_name = ANY(:tables)",
+)
+
+# Filtered lists and dashboard aggregates
+QUERIES.register("companies.list", "SELECT * FROM companies")
+QUERIES.register(
+    "policies.expiring",
+    """
+    SELECT * FROM policies
+    WHERE status = 'ACTIVE'
+      AND end_date >= :today
+      AND end_date <= :until
+    ORDER BY end_date ASC
+    """,
+)
+QUERIES.register("dashboard.stats", dashboard_stats_sql(scoped=False))
+QUERIES.register("dashboard.stats_by_company", dashboard_stats_sql(scoped=True))
+QUERIES.register(
+    "dashboard.stats_by_company_group",
+    dashboard_stats_sql(scoped=True, include_descendants=True),
+)
+
+# Search: leading-wildcard ILIKE served by the pg_trgm GIN indexes in
+# SCHEMA_MIGRATIONS, ranked by trigram similarity to the search term
+SEARCH_RESULT_LIMIT = 10
+SEARCH_COLUMNS = {
+    "policies": ("policy_number", "provider"),
+    "employees": ("name", "employee_code"),
+    "students": ("name", "student_id"),
+    "vessels": ("vessel_name", "imo_number"),
+    "vehicles": ("registration_number", "make", "model"),
+    "endorsements": ("endorsement_number", "description"),
+}
+for _table, _columns in SEARCH_COLUMNS.items():
+    _match = " OR ".join(f"{c} ILIKE :pattern" for c in _columns)
+    _rank = ", ".join(f"similarity({c}, :term)" for c in _columns)
+    QUERIES.register(
+        f"search.{_table}",
+        f"""
+        SELECT * FROM {_table}
+        WHERE {_match}
+        ORDER BY GREATEST({_rank}) DESC
+        LIMIT {SEARCH_RESULT_LIMIT}
+        """,
+    )
+
+
+# Schema migrations
+# Applied in order as a deploy step (`python server.py migrate`) under an
+# advisory lock, by a role allowed to CREATE EXTENSION. Statements run in
+# autocommit so indexes can be built CONCURRENTLY without blocking writes.
+# APPLY_SCHEMA_MIGRATIONS=true also applies them at startup, where every other
+# worker waits on the lock until the index builds finish.
+APPLY_SCHEMA_MIGRATIONS = os.getenv("APPLY_SCHEMA_MIGRATIONS", "false").lower() == "true"
+SCHEMA_MIGRATION_LOCK_KEY = 7_310_001
+# A failed CONCURRENTLY build leaves an INVALID index that IF NOT EXISTS would
+# accept, so these are checked and rebuilt
+CONCURRENT_INDEX = re.compile(
+    r"CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)", re.IGNORECASE
+)
+
+SCHEMA_MIGRATIONS = [
+    (
+        "0001_search_trigram_indexes",
+        ["CREATE EXTENSION IF NOT EXISTS pg_trgm"]
+        + [
+            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_{table}_{column}_trgm "
+            f"ON {table} USING gin ({column} gin_trgm_ops)"
+            for table, columns in SEARCH_COLUMNS.items()
+            for column in columns
+        ],
+    ),
+    (
+        "0002_table_versions",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS table_versions (
+                table_name TEXT PRIMARY KEY,
+                version BIGINT NOT NULL DEFAULT 0,
+                changed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+            """,
+            """
+            CREATE OR REPLACE FUNCTION bump_table_version() RETURNS trigger
+            LANGUAGE plpgsql AS $$
+            BEGIN
+                INSERT INTO table_versions (table_name, version, changed_at)
+                VALUES (TG_TABLE_NAME, 1, now())
+                ON CONFLICT (table_name) DO UPDATE
+                SET version = table_versions.version + 1, changed_at = now();
+                RETURN NULL;
+            END
+            $$
+            """,
+        ]
+        + [
+            statement
+            for table in VERSIONED_TABLES
+            for statement in (
+                f"DROP TRIGGER IF EXISTS {table}_bump_version ON {table}",
+                # Per statement, not per row: a bulk insert bumps the version once
+                f"""
+                CREATE TRIGGER {table}_bump_version
+                AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+                FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version()
+                """,
+            )
+        ],
+    ),
+    (
+        "0003_company_closure",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS company_closure (
+                ancestor_id UUID NOT NULL,
+                descendant_id UUID NOT NULL,
+                depth INT NOT NULL,
+                PRIMARY KEY (ancestor_id, descendant_id)
+            )
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_company_closure_descendant
+            ON company_closure (descendant_id)
+            """,
+            # Backfill from parent_company_id (depth cap guards against cycles)
+            """
+            INSERT INTO company_closure (ancestor_id, descendant_id, depth)
+            WITH RECURSIVE tree AS (
+                SELECT id AS ancestor_id, id AS descendant_id, 0 AS depth FROM companies
+                UNION ALL
+                SELECT tree.ancestor_id, c.id, tree.depth + 1
+                FROM tree
+                JOIN companies c ON c.parent_company_id = tree.descendant_id
+                WHERE tree.depth < 64
+            )
+            SELECT ancestor_id, descendant_id, MIN(depth) FROM tree
+            GROUP BY ancestor_id, descendant_id
+            ON CONFLICT DO NOTHING
+            """,
+        ],
+    ),
+    (
+        "0004_endorsement_premium_adjustment",
+        [
+            """
+            ALTER TABLE endorsements
+            ADD COLUMN IF NOT EXISTS premium_adjustment NUMERIC(14, 2) NOT NULL DEFAULT 0
+            """,
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_endorsements_policy_effective
+            ON endorsements (policy_id, effective_date)
+            """,
+        ],
+    ),
+    (
+        "0005_document_blobs",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS document_blobs (
+                sha256 TEXT PRIMARY KEY,
+                size_bytes BIGINT NOT NULL,
+                storage_key TEXT NOT NULL,
+                content_type TEXT,
+                ref_count INT NOT NULL DEFAULT 0,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+            """,
+            "ALTER TABLE documents ADD COLUMN IF NOT EXISTS content_hash TEXT",
+            "ALTER TABLE documents ADD COLUMN IF NOT EXISTS size_bytes BIGINT",
+            """
+            CREATE INDEX IF NOT EXISTS idx_document_blobs_unreferenced
+            ON document_blobs (sha256) WHERE ref_count <= 0
+            """,
+            # Per row, so bulk deletes (e.g. delete_policy) keep counts right
+            """
+            CREATE OR REPLACE FUNCTION count_document_blob_refs() RETURNS trigger
+            LANGUAGE plpgsql AS $$
+            BEGIN
+                IF TG_OP = 'INSERT' AND NEW.content_hash IS NOT NULL THEN
+                    UPDATE document_blobs SET ref_count = ref_count + 1
+                    WHERE sha256 = NEW.content_hash;
+                ELSIF TG_OP = 'DELETE' AND OLD.content_hash IS NOT NULL THEN
+                    UPDATE document_blobs SET ref_count = ref_count - 1
+                    WHERE sha256 = OLD.content_hash;
+                END IF;
+                RETURN NULL;
+            END
+            $$
+            """,
+            "DROP TRIGGER IF EXISTS documents_count_blob_refs ON documents",
+            """
+            CREATE TRIGGER documents_count_blob_refs
+            AFTER INSERT OR DELETE ON documents
+            FOR EACH ROW EXECUTE FUNCTION count_document_blob_refs()
+            """,
+        ],
+    ),
+    (
+        "0006_invoicing",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS invoice_runs (
+                id UUID PRIMARY KEY,
+                scope TEXT NOT NULL,
+                company_id UUID,
+                include_descendants BOOLEAN NOT NULL DEFAULT false,
+                period_start DATE NOT NULL,
+                period_end DATE NOT NULL,
+                invoice_date DATE NOT NULL,
+                due_date DATE NOT NULL,
+                status TEXT NOT NULL DEFAULT 'PENDING',
+                last_policy_id UUID,
+                policies_processed INT NOT NULL DEFAULT 0,
+                invoices_created INT NOT NULL DEFAULT 0,
+                total_amount NUMERIC(16, 2) NOT NULL DEFAULT 0,
+                busy_ms DOUBLE PRECISION NOT NULL DEFAULT 0,
+                last_error TEXT,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                started_at TIMESTAMPTZ,
+                finished_at TIMESTAMPTZ,
+                UNIQUE (scope, period_start, period_end)
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS invoices (
+                id UUID PRIMARY KEY,
+                invoice_number TEXT NOT NULL,
+                run_id UUID,
+                policy_id UUID NOT NULL,
+                company_id UUID,
+                period_start DATE NOT NULL,
+                period_end DATE NOT NULL,
+                instalment_from INT NOT NULL,
+                instalment_to INT NOT NULL,
+                instalments INT NOT NULL,
+                amount NUMERIC(14, 2) NOT NULL,
+                invoice_date DATE NOT NULL,
+                due_date DATE NOT NULL,
+                status TEXT NOT NULL DEFAULT 'DRAFT',
+                created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                UNIQUE (policy_id, period_start)
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_invoices_run ON invoices (run_id)",
+            "CREATE INDEX IF NOT EXISTS idx_invoices_company ON invoices (company_id)",
+            "CREATE INDEX IF NOT EXISTS idx_invoices_number ON invoices (invoice_number)",
+            # Tables created after 0002 install their own version trigger
+            "DROP TRIGGER IF EXISTS invoices_bump_version ON invoices",
+            """
+            CREATE TRIGGER invoices_bump_version
+            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON invoices
+            FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version()
+            """,
+        ],
+    ),
+    (
+        "0007_endorsement_changes",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS endorsement_changes (
+                id BIGSERIAL PRIMARY KEY,
+                endorsement_id UUID NOT NULL,
+                policy_id UUID NOT NULL,
+                effective_date DATE NOT NULL,
+                field TEXT NOT NULL,
+                change_type TEXT NOT NULL,
+                old_value JSONB,
+                new_value JSONB,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_endorsement_changes_replay
+            ON endorsement_changes (policy_id, effective_date, id)
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS policy_snapshots (
+                policy_id UUID NOT NULL,
+                effective_date DATE NOT NULL,
+                change_id BIGINT NOT NULL,
+                state JSONB NOT NULL,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                PRIMARY KEY (policy_id, effective_date, change_id)
+            )
+            """,
+        ],
+    ),
+    (
+        "0008_audit_events",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS audit_events (
+                id BIGSERIAL PRIMARY KEY,
+                occurred_at TIMESTAMPTZ NOT NULL,
+                actor_id TEXT,
+                action TEXT NOT NULL,
+                table_name TEXT NOT NULL,
+                row_id TEXT,
+                company_id UUID,
+                before JSONB,
+                after JSONB
+            )
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_audit_events_row
+            ON audit_events (table_name, row_id, occurred_at)
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_audit_events_company
+            ON audit_events (company_id, occurred_at)
+            """,
+        ],
+    ),
+    (
+        # Change feed notifications: one per statement and company, carrying
+        # up to 20 row ids. Delivered on commit, dropped on rollback.
+        "0009_change_notifications",
+        [
+            """
+            CREATE OR REPLACE FUNCTION notify_policy_changes() RETURNS trigger
+            LANGUAGE plpgsql AS $$
+            BEGIN
+                IF TG_OP = 'INSERT' THEN
+                    PERFORM pg_notify('policyzen_changes', json_build_object(
+                        'event', 'policy.created',
+                        'company_id', company_id,
+                        'count', count(*),
+                        'ids', (array_agg(id))[1:20]
+                    )::text)
+                    FROM new_rows GROUP BY company_id;
+                ELSIF TG_OP = 'UPDATE' THEN
+                    PERFORM pg_notify('policyzen_changes', json_build_object(
+                        'event', 'policy.status_changed',
+                        'company_id', n.company_id,
+                        'status', n.status,
+                        'count', count(*),
+                        'ids', (array_agg(n.id))[1:20]
+                    )::text)
+                    FROM new_rows n JOIN old_rows o ON o.id = n.id
+                    WHERE n.status IS DISTINCT FROM o.status
+                    GROUP BY n.company_id, n.status;
+                    -- Premium changes move the dashboard totals too
+                    PERFORM pg_notify('policyzen_changes', json_build_object(
+                        'event', 'policy.updated',
+                        'company_id', n.company_id,
+                        'count', count(*),
+                        'ids', (array_agg(n.id))[1:20]
+                    )::text)
+                    FROM new_rows n JOIN old_rows o ON o.id = n.id
+                    WHERE n.status IS NOT DISTINCT FROM o.status
+                      AND n.premium_amount IS DISTINCT FROM o.premium_amount
+                    GROUP BY n.company_id;
+                ELSE
+                    PERFORM pg_notify('policyzen_changes', json_build_object(
+                        'event', 'policy.deleted',
+                        'company_id', company_id,
+                        'count', count(*),
+                        'ids', (array_agg(id))[1:20]
+                    )::text)
+                    FROM old_rows GROUP BY company_id;
+                END IF;
+                RETURN NULL;
+            END
+            $$
+            """,
+            """
+            CREATE OR REPLACE FUNCTION notify_entity_changes() RETURNS trigger
+            LANGUAGE plpgsql AS $$
+            BEGIN
+                IF TG_OP = 'INSERT' THEN
+                    PERFORM pg_notify('policyzen_changes', json_build_object(
+                        'event', 'entity.added',
+                        'company_id', company_id,
+                        'type', type,
+                        'count', count(*),
+                        'ids', (array_agg(id))[1:20]
+                    )::text)
+                    FROM new_rows GROUP BY company_id, type;
+                ELSE
+                    PERFORM pg_notify('policyzen_changes', json_build_object(
+                        'event', 'entity.removed',
+                        'company_id', company_id,
+                        'type', type,
+                        'count', count(*),
+                        'ids', (array_agg(id))[1:20]
+                    )::text)
+                    FROM old_rows GROUP BY company_id, type;
+                END IF;
+                RETURN NULL;
+            END
+            $$
+            """,
+            """
+            CREATE OR REPLACE FUNCTION notify_endorsement_changes() RETURNS trigger
+            LANGUAGE plpgsql AS $$
+            BEGIN
+                PERFORM pg_notify('policyzen_changes', json_build_object(
+                    'event', 'endorsement.created',
+                    'company_id', p.company_id,
+                    'count', count(*),
+                    'ids', (array_agg(n.id))[1:20],
+                    'policy_ids', (array_agg(n.policy_id))[1:20]
+                )::text)
+                FROM new_rows n LEFT JOIN policies p ON p.id = n.policy_id
+                GROUP BY p.company_id;
+                RETURN NULL;
+            END
+            $$
+            """,
+            # Transition tables allow one event per trigger
+            "DROP TRIGGER IF EXISTS policies_notify_insert ON policies",
+            """
+            CREATE TRIGGER policies_notify_insert AFTER INSERT ON policies
+            REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION notify_policy_changes()
+            """,
+            "DROP TRIGGER IF EXISTS policies_notify_update ON policies",
+            """
+            CREATE TRIGGER policies_notify_update AFTER UPDATE ON policies
+            REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION notify_policy_changes()
+            """,
+            "DROP TRIGGER IF EXISTS policies_notify_delete ON policies",
+            """
+            CREATE TRIGGER policies_notify_delete AFTER DELETE ON policies
+            REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION notify_policy_changes()
+            """,
+            "DROP TRIGGER IF EXISTS entities_notify_insert ON entities",
+            """
+            CREATE TRIGGER entities_notify_insert AFTER INSERT ON entities
+            REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION notify_entity_changes()
+            """,
+            "DROP TRIGGER IF EXISTS entities_notify_delete ON entities",
+            """
+            CREATE TRIGGER entities_notify_delete AFTER DELETE ON entities
+            REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION notify_entity_changes()
+            """,
+            "DROP TRIGGER IF EXISTS endorsements_notify_insert ON endorsements",
+            """
+            CREATE TRIGGER endorsements_notify_insert AFTER INSERT ON endorsements
+            REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION notify_endorsement_changes()
+            """,
+        ],
+    ),
+    (
+        # Writers only append to table_changes; fold_table_changes() bumps
+        # table_versions after commit. Updating the shared version row inside
+        # the writer's transaction serialized writers per table and deadlocked
+        # writers that touch two tables in opposite orders.
+        "0010_table_change_queue",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS table_changes (
+                id BIGSERIAL PRIMARY KEY,
+                table_name TEXT NOT NULL
+            )
+            """,
+            """
+            CREATE OR REPLACE FUNCTION bump_table_version() RETURNS trigger
+            LANGUAGE plpgsql AS $$
+            BEGIN
+                INSERT INTO table_changes (table_name) VALUES (TG_TABLE_NAME);
+                RETURN NULL;
+            END
+            $$
+            """,
+        ],
+    ),
+    (
+        # Instalments are claimed one row each, so runs over overlapping
+        # periods (Jan-Mar, then Feb) cannot bill the same instalment twice.
+        # UNIQUE (policy_id, period_start) only caught runs sharing a start.
+        "0011_invoice_instalments",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS invoice_instalments (
+                policy_id UUID NOT NULL,
+                instalment INT NOT NULL,
+                invoice_id UUID NOT NULL,
+                PRIMARY KEY (policy_id, instalment)
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_invoice_instalments_invoice ON invoice_instalments (invoice_id)",
+            """
+            INSERT INTO invoice_instalments (policy_id, instalment, invoice_id)
+            SELECT policy_id, generate_series(instalment_from, instalment_to), id
+            FROM invoices
+            ON CONFLICT (policy_id, instalment) DO NOTHING
+            """,
+            "ALTER TABLE invoices DROP CONSTRAINT IF EXISTS invoices_policy_id_period_start_key",
+        ],
+    ),
+    (
+        # Deltas are written to the live policies row once in effect. Direct
+        # edits through PUT /policies/{id} are logged too, with no endorsement.
+        # Deltas logged before this are taken as already reflected in the row.
+        "0012_policy_change_application",
+        [
+            "ALTER TABLE endorsement_changes ALTER COLUMN endorsement_id DROP NOT NULL",
+            "ALTER TABLE endorsement_changes ADD COLUMN IF NOT EXISTS applied_at TIMESTAMPTZ",
+            "UPDATE endorsement_changes SET applied_at = now() WHERE applied_at IS NULL",
+            """
+            CREATE INDEX IF NOT EXISTS idx_endorsement_changes_pending
+            ON endorsement_changes (effective_date) WHERE applied_at IS NULL
+            """,
+        ],
+    ),
+    (
+        "0013_revoked_tokens",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS revoked_tokens (
+                jti TEXT PRIMARY KEY,
+                expires_at TIMESTAMPTZ NOT NULL
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_revoked_tokens_expires ON revoked_tokens (expires_at)",
+        ],
+    ),
+]
+
+
+async def drop_invalid_index(conn, name: str) -> None:
+    result = await conn.execute(
+        text("SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"),
+        {"name": name},
+    )
+    if result.scalar():
+        logging.getLogger(__name__).warning("Rebuilding invalid index %s", name)
+        await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+
+
+async def check_schema_migrations() -> None:
+    """Refuse to start against a database missing any of SCHEMA_MIGRATIONS"""
+    async with engine.connect() as conn:
+        result = await conn.execute(
+            text("SELECT to_regclass('schema_migrations') IS NOT NULL")
+        )
+        applied = set()
+        if result.scalar():
+            result = await conn.execute(text("SELECT name FROM schema_migrations"))
+            applied = {row[0] for row in result.fetchall()}
+    missing = [name for name, _ in SCHEMA_MIGRATIONS if name not in applied]
+    if missing:
+        raise RuntimeError(
+            f"Schema migrations not applied: {', '.join(missing)}. "
+            "Run `python server.py migrate` before starting the API "
+            "(or set APPLY_SCHEMA_MIGRATIONS=true)."
+        )
+
+
+async def apply_schema_migrations() -> None:
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.execute(
+            text("SELECT pg_advisory_lock(:key)"), {"key": SCHEMA_MIGRATION_LOCK_KEY}
+        )
+        try:
+            await conn.execute(
+                text("""
+                    CREATE TABLE IF NOT EXISTS schema_migrations (
+                        name TEXT PRIMARY KEY,
+                        applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                    )
+                """)
+            )
+            result = await conn.execute(text("SELECT name FROM schema_migrations"))
+            applied = {row[0] for row in result.fetchall()}
+
+            for name, statements in SCHEMA_MIGRATIONS:
+                if name in applied:
+                    continue
+                for statement in statements:
+                    index = CONCURRENT_INDEX.search(statement)
+                    if index:
+                        await drop_invalid_index(conn, index.group(1))
+                    await conn.execute(text(statement))
+                await conn.execute(
+                    text("INSERT INTO schema_migrations (name) VALUES (:name)"),
+                    {"name": name},
+                )
+                logging.getLogger(__name__).info("Applied schema migration %s", name)
+        finally:
+            await conn.execute(
+                text("SELECT pg_advisory_unlock(:key)"), {"key": SCHEMA_MIGRATION_LOCK_KEY}
+            )
+
+
+# Connection pool warm-up and readiness
+# At startup DB_POOL_WARMUP_CONNECTIONS connections are opened together and
+# each runs the hot statements once, so the first requests after a deploy
+# neither pay for connection setup nor for preparing statements.
+DB_POOL_WARMUP_CONNECTIONS = int(
+    os.getenv("DB_POOL_WARMUP_CONNECTIONS", str(DB_POOL_SIZE))
+)
+DB_READY_TIMEOUT = float(os.getenv("DB_READY_TIMEOUT_SECONDS", "2"))
+
+# Registered statement -> parameters that match nothing but still get planned
+_NO_ID = "00000000-0000-0000-0000-000000000000"
+WARMUP_QUERIES = {
+    **{
+        f"{table}.by_id": {"id": _NO_ID}
+        for table in ("companies", "employees", "students", "vessels", "vehicles", "policies")
+    },
+    "users.by_email": {"email": ""},
+    "dashboard.stats": {"since": datetime(1970, 1, 1, tzinfo=timezone.utc)},
+    "dashboard.stats_by_company": {
+        "company_id": _NO_ID,
+        "since": datetime(1970, 1, 1, tzinfo=timezone.utc),
+    },
+}
+
+
+async def warm_up_pool(session_factory=db) -> None:
+    count = min(DB_POOL_WARMUP_CONNECTIONS, DB_POOL_SIZE + DB_MAX_OVERFLOW)
+    if count <= 0:
+        return
+    logger = logging.getLogger(__name__)
+    started = time.perf_counter()
+    warmed = 0
+    all_warmed = asyncio.Event()
+
+    async def warm_connection():
+        nonlocal warmed
+        try:
+            async with session_factory() as session:
+                for name, params in WARMUP_QUERIES.items():
+                    try:
+                        await QUERIES.execute(session, name, params)
+                    except Exception as e:
+                        logger.warning("Warm-up query %s failed: %s", name, e)
+                        await session.rollback()
+                # Hold the connection until every task has one, so the pool
+                # ends up with `count` distinct connections
+                warmed += 1
+                if warmed == count:
+                    all_warmed.set()
+                await all_warmed.wait()
+        except Exception as e:
+            logger.warning("Connection warm-up failed: %s", e)
+            warmed += 1
+            if warmed == count:
+                all_warmed.set()
+
+    await asyncio.gather(*(warm_connection() for _ in range(count)))
+    logger.info(
+        "Warmed %d pooled connections in %.1f ms",
+        count,
+        (time.perf_counter() - started) * 1000,
+    )
+
+
+def pool_status(pool_engine=None) -> dict:
+    pool = (pool_engine or engine).pool
+    checked_out = pool.checkedout()
+    return {
+        "size": pool.size(),
+        "max_overflow": DB_MAX_OVERFLOW,
+        "checked_out": checked_out,
+        "idle": pool.checkedin(),
+        # Negative until the base pool has been filled
+        "overflow": max(pool.overflow(), 0),
+        "saturated": checked_out >= pool.size() + DB_MAX_OVERFLOW,
+    }
+
+
+# Policy expiry job
+POLICY_EXPIRY_ENABLED = os.getenv("POLICY_EXPIRY_ENABLED", "true").lower() == "true"
+POLICY_EXPIRY_INTERVAL_SECONDS = float(os.getenv("POLICY_EXPIRY_INTERVAL_SECONDS", "300"))
+# Rows updated per transaction, so no batch holds row locks on policies for long
+POLICY_EXPIRY_BATCH_SIZE = int(os.getenv("POLICY_EXPIRY_BATCH_SIZE", "1000"))
+POLICY_EXPIRY_LOCK_KEY = 7_310_002
+
+EXPIRE_POLICIES_BATCH = text("""
+    UPDATE policies SET status = 'EXPIRED', updated_at = now()
+    WHERE id IN (
+        SELECT id FROM policies
+        WHERE status = 'ACTIVE' AND end_date < :today
+        LIMIT :batch_size
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, company_id
+""")
+
+policy_expiry_status: Dict[str, Any] = {
+    "running": False,
+    "runs": 0,
+    "skipped_runs": 0,
+    "total_expired": 0,
+    "current_run": None,
+    "last_run": None,
+    "last_error": None,
+}
+
+
+async def run_policy_expiry() -> Optional[dict]:
+    """Expire overdue ACTIVE policies in batches; returns None if another worker holds the lock"""
+    async with engine.connect() as conn:
+        # Autocommit: every batch UPDATE is its own short transaction
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        locked = await conn.execute(
+            text("SELECT pg_try_advisory_lock(:key)"), {"key": POLICY_EXPIRY_LOCK_KEY}
+        )
+        if not locked.scalar():
+            policy_expiry_status["skipped_runs"] += 1
+            return None
+
+        run = {
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "batches": 0,
+            "expired": 0,
+            "max_batch_ms": 0.0,
+        }
+        policy_expiry_status.update(running=True, current_run=run)
+        started = time.perf_counter()
+        try:
+            today = date.today()
+            while True:
+                batch_started = time.perf_counter()
+                result = await conn.execute(
+                    EXPIRE_POLICIES_BATCH,
+                    {"today": today, "batch_size": POLICY_EXPIRY_BATCH_SIZE},
+                )
+                expired = result.fetchall()
+                expired_ids = [str(row.id) for row in expired]
+                if not expired_ids:
+                    break
+                for row in expired:
+                    await AUDIT_LOG.record(
+                        AuditAction.UPDATE,
+                        "policies",
+                        row.id,
+                        company_id=row.company_id,
+                        before={"status": PolicyStatus.ACTIVE.value},
+                        after={"status": PolicyStatus.EXPIRED.value},
+                    )
+                run["batches"] += 1
+                run["expired"] += len(expired_ids)
+                batch_ms = round((time.perf_counter() - batch_started) * 1000, 2)
+                run["max_batch_ms"] = max(run["max_batch_ms"], batch_ms)
+                await RESPONSE_CACHE.invalidate(
+                    *(f"policies:{policy_id}" for policy_id in expired_ids)
+                )
+                if len(expired_ids) < POLICY_EXPIRY_BATCH_SIZE:
+                    break
+        finally:
+            await conn.execute(
+                text("SELECT pg_advisory_unlock(:key)"), {"key": POLICY_EXPIRY_LOCK_KEY}
+            )
+            run["duration_ms"] = round((time.perf_counter() - started) * 1000, 2)
+            run["finished_at"] = datetime.now(timezone.utc).isoformat()
+            policy_expiry_status["runs"] += 1
+            policy_expiry_status["total_expired"] += run["expired"]
+            policy_expiry_status.update(running=False, current_run=None, last_run=run)
+
+    if run["expired"]:
+        invalidate_dashboard_stats()
+    return run
+
+
+async def policy_expiry_loop() -> None:
+    while True:
+        try:
+            await run_due_policy_changes()
+            await run_policy_expiry()
+            policy_expiry_status["last_error"] = None
+        except Exception as e:
+            logging.getLogger(__name__).exception("Policy expiry run failed")
+            policy_expiry_status["last_error"] = str(e)
+        await asyncio.sleep(POLICY_EXPIRY_INTERVAL_SECONDS)
+
+
+# Invoicing
+# A run invoices every ACTIVE policy in its scope for one billing period of
+# whole calendar months. Premium is split into monthly instalments over the
+# policy term (the last one absorbs rounding), and a period bills the
+# instalments falling in its months. Each chunk of policies is one
+# transaction: a multi-row INSERT ... SELECT plus the run's progress cursor,
+# so a crashed run resumes after its last committed policy. Each billed
+# instalment is claimed in invoice_instalments, keyed by (policy_id,
+# instalment), so overlapping runs never double-bill.
+INVOICE_RUN_CHUNK_SIZE = int(os.getenv("INVOICE_RUN_CHUNK_SIZE", "2000"))
+INVOICE_RUN_LOCK_KEY = 7_310_004
+NIL_UUID = "00000000-0000-0000-0000-000000000000"
+
+UPDATE_INVOICE_RUN_PROGRESS = text("""
+    UPDATE invoice_runs SET
+        last_policy_id = :last_policy_id,
+        policies_processed = policies_processed + :policies,
+        invoices_created = invoices_created + :invoices,
+        total_amount = total_amount + :amount,
+        busy_ms = busy_ms + :busy_ms
+    WHERE id = :id
+""")
+
+# run id -> task, for runs executing in this worker
+invoice_run_tasks: Dict[str, asyncio.Task] = {}
+
+
+def invoice_scope(company_id: Optional[str], include_descendants: bool) -> str:
+    """Idempotency key for a run's policy selection"""
+    if not company_id:
+        return "*"
+    return f"{company_id}/*" if include_descendants else company_id
+
+
+def invoice_batch_sql(company_id: Optional[str], include_descendants: bool) -> str:
+    scope = ""
+    if company_id:
+        scope = "AND " + company_scope(include_descendants, column="p.company_id")
+    return f"""
+        WITH batch AS (
+            SELECT
+                p.id,
+                p.company_id,
+                p.policy_number,
+                COALESCE(p.premium_amount, 0) AS premium_amount,
+                CAST(EXTRACT(YEAR FROM p.start_date) * 12 + EXTRACT(MONTH FROM p.start_date)
+                     AS int) AS start_month,
+                -- Months in the term, a part month counting as one
+                GREATEST(1, CAST(
+                    EXTRACT(YEAR FROM age(p.end_date, p.start_date)) * 12
+                    + EXTRACT(MONTH FROM age(p.end_date, p.start_date))
+                    + CASE WHEN EXTRACT(DAY FROM age(p.end_date, p.start_date)) > 0 THEN 1 ELSE 0 END
+                    AS int)) AS instalments
+            FROM policies p
+            WHERE p.status = 'ACTIVE'
+              AND p.start_date <= :period_end AND p.end_date >= :period_start
+              AND p.id > CAST(:after AS uuid) {scope}
+            ORDER BY p.id
+            LIMIT :chunk_size
+        ),
+        due AS (
+            SELECT
+                batch.*,
+                GREATEST(1, :first_month - start_month + 1) AS instalment_from,
+                LEAST(instalments, :last_month - start_month + 1) AS instalment_to,
+                ROUND(premium_amount / instalments, 2) AS instalment_amount,
+                gen_random_uuid() AS invoice_id
+            FROM batch
+        ),
+        -- One row per instalment; those another run already billed are skipped
+        claimed AS (
+            INSERT INTO invoice_instalments (policy_id, instalment, invoice_id)
+            SELECT due.id, n, due.invoice_id
+            FROM due, generate_series(due.instalment_from, due.instalment_to) AS n
+            ON CONFLICT (policy_id, instalment) DO NOTHING
+            RETURNING instalment, invoice_id
+        ),
+        inserted AS (
+            INSERT INTO invoices (
+                id, invoice_number, run_id, policy_id, company_id, period_start, period_end,
+                instalment_from, instalment_to, instalments, amount, invoice_date, due_date,
+                status, created_at, updated_at
+            )
+            SELECT
+                due.invoice_id, 'INV-' || :period_label || '-' || due.policy_number,
+                CAST(:run_id AS uuid), due.id, due.company_id, :period_start, :period_end,
+                MIN(claimed.instalment), MAX(claimed.instalment), due.instalments,
+                SUM(due.instalment_amount
+                    + CASE WHEN claimed.instalment = due.instalments
+                           THEN due.premium_amount - due.instalment_amount * due.instalments
+                           ELSE 0 END),
+                :invoice_date, :due_date, 'DRAFT', now(), now()
+            FROM claimed
+            JOIN due ON due.invoice_id = claimed.invoice_id
+            GROUP BY due.invoice_id, due.policy_number, due.id, due.company_id,
+                     due.instalments, due.instalment_amount, due.premium_amount
+            RETURNING amount
+        )
+        SELECT
+            (SELECT CAST(id AS text) FROM batch ORDER BY id DESC LIMIT 1) AS last_policy_id,
+            (SELECT COUNT(*) FROM batch) AS policies,
+            COUNT(*) AS invoices,
+            COALESCE(SUM(amount), 0) AS amount
+        FROM inserted
+    """
+
+
+def invoice_run_report(row) -> dict:
+    run = dict(row._mapping)
+    busy_seconds = run["busy_ms"] / 1000
+    run["policies_per_second"] = (
+        round(run["policies_processed"] / busy_seconds, 1) if busy_seconds else None
+    )
+    run["running_here"] = str(run["id"]) in invoice_run_tasks
+    return run
+
+
+async def run_invoicing(run_id: str) -> Optional[dict]:
+    """Invoice a run from its saved cursor; returns None if it is already complete"""
+    async with engine.connect() as conn:
+        # Autocommit: run bookkeeping stays visible while chunks commit separately
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        # Locked per run: other runs proceed concurrently (instalment claims
+        # keep them from double-billing), and a second start of this run waits
+        # for the first and then finds it COMPLETED or resumes its cursor.
+        await conn.execute(
+            text("SELECT pg_advisory_lock(:key, hashtext(:run_id))"),
+            {"key": INVOICE_RUN_LOCK_KEY, "run_id": run_id},
+        )
+
+        try:
+            result = await conn.execute(
+                text("""
+                    UPDATE invoice_runs
+                    SET status = 'RUNNING', started_at = COALESCE(started_at, now()),
+                        last_error = NULL
+                    WHERE id = :id AND status <> 'COMPLETED'
+                    RETURNING *
+                """),
+                {"id": run_id},
+            )
+            run = result.first()
+            if run is None:
+                return None
+
+            company_id = str(run.company_id) if run.company_id else None
+            batch_sql = invoice_batch_sql(company_id, run.include_descendants)
+            params = {
+                "run_id": run_id,
+                "company_id": company_id,
+                "period_start": run.period_start,
+                "period_end": run.period_end,
+                "first_month": run.period_start.year * 12 + run.period_start.month,
+                "last_month": run.period_end.year * 12 + run.period_end.month,
+                "period_label": run.period_start.strftime("%Y%m"),
+                "invoice_date": run.invoice_date,
+                "due_date": run.due_date,
+                "chunk_size": INVOICE_RUN_CHUNK_SIZE,
+                "after": str(run.last_policy_id or NIL_UUID),
+            }
+            if not company_id:
+                del params["company_id"]
+
+            while True:
+                chunk_started = time.perf_counter()
+                async with db() as session:
+                    result = await QUERIES.execute(session, "invoices.batch", params, sql=batch_sql)
+                    batch = result.first()
+                    if not batch.policies:
+                        break
+                    await session.execute(
+                        UPDATE_INVOICE_RUN_PROGRESS,
+                        {
+                            "id": run_id,
+                            "last_policy_id": batch.last_policy_id,
+                            "policies": batch.policies,
+                            "invoices": batch.invoices,
+                            "amount": batch.amount,
+                            "busy_ms": (time.perf_counter() - chunk_started) * 1000,
+                        },
+                    )
+                    await session.commit()
+                params["after"] = batch.last_policy_id
+                if batch.policies < INVOICE_RUN_CHUNK_SIZE:
+                    break
+
+            result = await conn.execute(
+                text("""
+                    UPDATE invoice_runs SET status = 'COMPLETED', finished_at = now()
+                    WHERE id = :id RETURNING *
+                """),
+                {"id": run_id},
+            )
+            return invoice_run_report(result.first())
+        except Exception as e:
+            await conn.execute(
+                text("UPDATE invoice_runs SET status = 'FAILED', last_error = :error WHERE id = :id"),
+                {"id": run_id, "error": str(e) or type(e).__name__},
+            )
+            raise
+        finally:
+            await conn.execute(
+                text("SELECT pg_advisory_unlock(:key, hashtext(:run_id))"),
+                {"key": INVOICE_RUN_LOCK_KEY, "run_id": run_id},
+            )
+
+
+async def invoice_run_job(run_id: str) -> None:
+    try:
+        await run_invoicing(run_id)
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        logging.getLogger(__name__).exception("Invoice run %s failed", run_id)
+    finally:
+        invoice_run_tasks.pop(run_id, None)
+
+
+# Password hashing pool
+# bcrypt releases the GIL while hashing, so a small thread pool keeps the
+# 100-250 ms of CPU per call off the event loop. Past BCRYPT_MAX_PENDING
+# queued or running jobs we shed load with 503 instead of queueing forever.
+BCRYPT_WORKERS = int(os.getenv("BCRYPT_WORKERS", str(min(4, os.cpu_count() or 1))))
+BCRYPT_MAX_PENDING = int(os.getenv("BCRYPT_MAX_PENDING", str(BCRYPT_WORKERS * 8)))
+BCRYPT_RETRY_AFTER_SECONDS = os.getenv("BCRYPT_RETRY_AFTER_SECONDS", "1")
+
+password_pool = ThreadPoolExecutor(max_workers=BCRYPT_WORKERS, thread_name_prefix="bcrypt")
+_password_jobs_pending = 0
+
+
+async def run_password_job(fn, *args):
+    global _password_jobs_pending
+    if _password_jobs_pending >= BCRYPT_MAX_PENDING:
+        raise HTTPException(
+            status_code=503,
+            detail="Authentication is busy, please retry",
+            headers={"Retry-After": BCRYPT_RETRY_AFTER_SECONDS},
+        )
+
+    _password_jobs_pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(password_pool, fn, *args)
+    finally:
+        _password_jobs_pending -= 1
+
+
+def _hash_password(password: str) -> str:
+    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
+
+
+def _check_password(password: str, password_hash: str) -> bool:
+    return bcrypt.checkpw(password.encode("utf-8"), password_hash.encode("utf-8"))
+
+
+async def hash_password(password: str) -> str:
+    return await run_password_job(_hash_password, password)
+
+
+async def verify_password(password: str, password_hash: str) -> bool:
+    return await run_password_job(_check_password, password, password_hash)
+
+
+# Access tokens
+JWT_SECRET = os.getenv("JWT_SECRET")
+if not JWT_SECRET:
+    # Tokens signed with a per-process secret do not survive restarts and are
+    # not accepted by other workers, so set JWT_SECRET in any real deployment
+    JWT_SECRET = secrets.token_urlsafe(32)
+    logging.getLogger(__name__).warning("JWT_SECRET is not set; using a random secret")
+JWT_ALGORITHM = "HS256"
+ACCESS_TOKEN_TTL_MINUTES = int(os.getenv("ACCESS_TOKEN_TTL_MINUTES", "60"))
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", "10000"))
+# Revocations are stored in revoked_tokens and take effect in the revoking
+# worker at once; other workers reload the unexpired ones at this interval
+REVOKED_TOKEN_SYNC_SECONDS = float(os.getenv("REVOKED_TOKEN_SYNC_SECONDS", "2"))
+
+bearer_scheme = HTTPBearer(auto_error=False)
+# Decoded principals by raw token, least recently used first
+_principal_cache: "OrderedDict[str, Principal]" = OrderedDict()
+# Revoked token ids, mapped to their expiry so the list can be pruned
+_revoked_tokens: Dict[str, float] = {}
+
+
+def create_access_token(user: dict) -> str:
+    now = datetime.now(timezone.utc)
+    claims = {
+        "sub": str(user["id"]),
+        "role": user["role"],
+        "company_id": str(user["company_id"]),
+        "jti": uuid.uuid4().hex,
+        "iat": now,
+        "exp": now + timedelta(minutes=ACCESS_TOKEN_TTL_MINUTES),
+    }
+    return jwt.encode(claims, JWT_SECRET, algorithm=JWT_ALGORITHM)
+
+
+def prune_revoked_tokens() -> None:
+    now = time.time()
+    for jti in [jti for jti, expires_at in _revoked_tokens.items() if expires_at < now]:
+        del _revoked_tokens[jti]
+
+
+async def revoke_principal(principal: Principal) -> None:
+    async with db() as session:
+        await session.execute(text("DELETE FROM revoked_tokens WHERE expires_at < now()"))
+        await session.execute(
+            text("""
+                INSERT INTO revoked_tokens (jti, expires_at) VALUES (:jti, :expires_at)
+                ON CONFLICT (jti) DO NOTHING
+            """),
+            {
+                "jti": principal.jti,
+                "expires_at": datetime.fromtimestamp(principal.expires_at, timezone.utc),
+            },
+        )
+        await session.commit()
+    prune_revoked_tokens()
+    _revoked_tokens[principal.jti] = principal.expires_at
+
+
+async def sync_revoked_tokens() -> None:
+    """Pick up revocations made by other workers"""
+    async with db() as session:
+        result = await session.execute(
+            text("""
+                SELECT jti, EXTRACT(EPOCH FROM expires_at) AS expires_at
+                FROM revoked_tokens WHERE expires_at > now()
+            """)
+        )
+        rows = result.fetchall()
+    # Revocations are never lifted, so merging cannot drop one made here meanwhile
+    _revoked_tokens.update((row.jti, float(row.expires_at)) for row in rows)
+    prune_revoked_tokens()
+
+
+async def revoked_token_sync_loop() -> None:
+    while True:
+        try:
+            await sync_revoked_tokens()
+        except Exception:
+            logging.getLogger(__name__).exception("Syncing revoked tokens failed")
+        await asyncio.sleep(REVOKED_TOKEN_SYNC_SECONDS)
+
+
+def decode_principal(token: str) -> Principal:
+    """Resolve a token to its principal: LRU hit, else verify the signature once"""
+    credentials_error = HTTPException(
+        status_code=401,
+        detail="Invalid or expired token",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+
+    principal = _principal_cache.get(token)
+    if principal is not None:
+        _principal_cache.move_to_end(token)
+    else:
+        try:
+            claims = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+            principal = Principal(
+                user_id=claims["sub"],
+                role=claims["role"],
+                company_id=claims["company_id"],
+                jti=claims["jti"],
+                expires_at=claims["exp"],
+            )
+        except (jwt.InvalidTokenError, KeyError, ValidationError):
+            raise credentials_error
+        _principal_cache[token] = principal
+        if len(_principal_cache) > PRINCIPAL_CACHE_SIZE:
+            _principal_cache.popitem(last=False)
+
+    if principal.expires_at < time.time():
+        _principal_cache.pop(token, None)
+        raise credentials_error
+    if principal.jti in _revoked_tokens:
+        raise credentials_error
+    return principal
+
+
+async def get_current_principal(
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(bearer_scheme),
+) -> Principal:
+    if credentials is None:
+        raise HTTPException(
+            status_code=401,
+            detail="Not authenticated",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return decode_principal(credentials.credentials)
+
+
+async def require_admin(principal: Principal = Depends(get_current_principal)) -> Principal:
+    if principal.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Admin role required")
+    return principal
+
+
+# Audit log
+# Write handlers hand each change (actor, table, row id, before/after images)
+# to AUDIT_LOG.record() and move on: events wait in a bounded in-process queue
+# and a background task writes them to audit_events with one multi-row INSERT
+# every AUDIT_FLUSH_INTERVAL_MS, or as soon as AUDIT_BATCH_SIZE are queued.
+# Before images come from the handlers' own UPDATE/DELETE ... RETURNING, so
+# auditing adds no round trips to a request. When the queue is full, record()
+# waits for the writer to make room instead of dropping events; shutdown
+# drains whatever is still queued.
+AUDIT_LOG_ENABLED = os.getenv("AUDIT_LOG_ENABLED", "true").lower() == "true"
+AUDIT_QUEUE_SIZE = int(os.getenv("AUDIT_QUEUE_SIZE", "10000"))
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", "500"))
+AUDIT_FLUSH_INTERVAL_MS = float(os.getenv("AUDIT_FLUSH_INTERVAL_MS", "200"))
+AUDIT_FLUSH_RETRIES = int(os.getenv("AUDIT_FLUSH_RETRIES", "3"))
+
+# Set per request by AuditActorMiddleware: the caller's user id, if any
+audit_actor: ContextVar[Optional[str]] = ContextVar("audit_actor", default=None)
+
+INSERT_AUDIT_EVENTS = text("""
+    INSERT INTO audit_events (occurred_at, actor_id, action, table_name, row_id, company_id, before, after)
+    SELECT * FROM unnest(
+        CAST(:occurred_at AS timestamptz[]),
+        CAST(:actor_id AS text[]),
+        CAST(:action AS text[]),
+        CAST(:table_name AS text[]),
+        CAST(:row_id AS text[]),
+        CAST(:company_id AS uuid[]),
+        CAST(:before AS jsonb[]),
+        CAST(:after AS jsonb[])
+    )
+""")
+
+
+def audit_default(value: Any) -> Any:
+    # An odd value in a row image must not fail the whole batch
+    try:
+        return orjson_default(value)
+    except TypeError:
+        return str(value)
+
+
+def audit_json(image: Optional[dict]) -> Optional[str]:
+    return None if image is None else orjson.dumps(dict(image), default=audit_default).decode()
+
+
+class AuditLogWriter:
+    """Bounded queue of audit events and the task that batches them into audit_events"""
+
+    def __init__(self, maxsize: int, batch_size: int, flush_interval: float, window: int = 1000):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.wake = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.closing = False
+        # Time spent in record() by the last `window` calls, in nanoseconds
+        self.enqueue_ns: deque = deque(maxlen=window)
+        self.stats: Dict[str, Any] = {
+            "recorded": 0,
+            "written": 0,
+            "batches": 0,
+            "blocked": 0,
+            "dropped": 0,
+            "failed": 0,
+            "last_flush_ms": None,
+            "last_error": None,
+        }
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    async def record(
+        self,
+        action: AuditAction,
+        table: str,
+        row_id: Any,
+        company_id: Any = None,
+        before: Optional[dict] = None,
+        after: Optional[dict] = None,
+    ) -> None:
+        if not AUDIT_LOG_ENABLED:
+            return
+        started = time.perf_counter_ns()
+        event = (
+            datetime.now(timezone.utc),
+            audit_actor.get(),
+            action.value,
+            table,
+            None if row_id is None else str(row_id),
+            None if company_id is None else str(company_id),
+            before,
+            after,
+        )
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            if not self.running:
+                # Nothing would ever make room
+                self.stats["dropped"] += 1
+                return
+            # ✅ Backpressure: wait for the writer rather than lose the event
+            self.stats["blocked"] += 1
+            self.wake.set()
+            await self.queue.put(event)
+        self.stats["recorded"] += 1
+        if self.queue.qsize() >= self.batch_size:
+            self.wake.set()
+        self.enqueue_ns.append(time.perf_counter_ns() - started)
+
+    def start(self) -> None:
+        # Queue and event bind to the loop they first wait on, so make fresh
+        # ones for this loop and carry over anything recorded before startup
+        pending, self.queue = self.queue, asyncio.Queue(maxsize=self.queue.maxsize)
+        while not pending.empty():
+            self.queue.put_nowait(pending.get_nowait())
+        self.wake = asyncio.Event()
+        self.closing = False
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        """Write out everything still queued, then stop the writer task"""
+        if self.task is None:
+            return
+        self.closing = True
+        self.wake.set()
+        await asyncio.gather(self.task, return_exceptions=True)
+        self.task = None
+
+    async def run(self) -> None:
+        while not (self.closing and self.queue.empty()):
+            if not self.closing and self.queue.qsize() < self.batch_size:
+                try:
+                    await asyncio.wait_for(self.wake.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self.wake.clear()
+            batch = []
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            if batch:
+                await self.flush(batch)
+
+    async def flush(self, batch: list) -> None:
+        occurred_at, actor_id, action, table_name, row_id, company_id, before, after = zip(*batch)
+        params = {
+            "occurred_at": list(occurred_at),
+            "actor_id": list(actor_id),
+            "action": list(action),
+            "table_name": list(table_name),
+            "row_id": list(row_id),
+            "company_id": list(company_id),
+            "before": [audit_json(value) for value in before],
+            "after": [audit_json(value) for value in after],
+        }
+        started = time.perf_counter()
+        for attempt in range(AUDIT_FLUSH_RETRIES + 1):
+            try:
+                async with db() as session:
+                    await session.execute(INSERT_AUDIT_EVENTS, params)
+                    await session.commit()
+                break
+            except Exception as e:
+                self.stats["last_error"] = str(e)
+                if attempt == AUDIT_FLUSH_RETRIES:
+                    self.stats["failed"] += len(batch)
+                    logging.getLogger(__name__).exception(
+                        "Dropped %d audit events after %d attempts", len(batch), attempt + 1
+                    )
+                    return
+                await asyncio.sleep(0.1 * 2**attempt)
+        self.stats["written"] += len(batch)
+        self.stats["batches"] += 1
+        self.stats["last_flush_ms"] = round((time.perf_counter() - started) * 1000, 2)
+
+    def status(self) -> dict:
+        samples = sorted(self.enqueue_ns)
+        enqueue_us = None
+        if samples:
+            enqueue_us = {
+                "p50": round(samples[len(samples) // 2] / 1000, 2),
+                "p99": round(samples[int(0.99 * (len(samples) - 1))] / 1000, 2),
+                "max": round(samples[-1] / 1000, 2),
+            }
+        return {
+            "running": self.running,
+            "queue_depth": self.queue.qsize(),
+            "queue_size": self.queue.maxsize,
+            "enqueue_us": enqueue_us,
+            **self.stats,
+        }
+
+
+AUDIT_LOG = AuditLogWriter(AUDIT_QUEUE_SIZE, AUDIT_BATCH_SIZE, AUDIT_FLUSH_INTERVAL_MS / 1000)
+
+
+class AuditActorMiddleware:
+    """Attribute audit events recorded during a write request to its caller"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] in ("GET", "HEAD", "OPTIONS"):
+            await self.app(scope, receive, send)
+            return
+
+        actor = None
+        scheme, _, credentials = Request(scope).headers.get("authorization", "").partition(" ")
+        if scheme.lower() == "bearer" and credentials:
+            try:
+                actor = decode_principal(credentials).user_id
+            except HTTPException:
+                pass  # unauthenticated writes are audited without an actor
+
+        token = audit_actor.set(actor)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            audit_actor.reset(token)
+
+
+# Change feed
+# GET /api/events streams compact change notifications as Server-Sent Events.
+# Statement triggers (see SCHEMA_MIGRATIONS) pg_notify one message per
+# statement and company, and each worker holds a single LISTEN connection
+# that fans them out in-process: a frame is encoded once and pushed onto the
+# bounded queue of every subscriber it matches. A subscriber that falls
+# behind loses frames and is told to resync, rather than buffering without
+# limit. Dashboard deltas are recomputed at most once per debounce window per
+# subscribed company, however many clients are connected.
+EVENTS_ENABLED = os.getenv("EVENTS_ENABLED", "true").lower() == "true"
+# LISTEN needs a session of its own: point this at the database directly
+# when DATABASE_URL goes through a transaction-pooling proxy
+EVENTS_DATABASE_URL = os.getenv("EVENTS_DATABASE_URL") or os.getenv("DATABASE_URL")
+EVENTS_SUBSCRIBER_BUFFER = int(os.getenv("EVENTS_SUBSCRIBER_BUFFER", "100"))
+EVENTS_MAX_SUBSCRIBERS = int(os.getenv("EVENTS_MAX_SUBSCRIBERS", "10000"))
+EVENTS_HEARTBEAT_SECONDS = float(os.getenv("EVENTS_HEARTBEAT_SECONDS", "15"))
+EVENTS_RECONNECT_SECONDS = float(os.getenv("EVENTS_RECONNECT_SECONDS", "2"))
+EVENTS_DASHBOARD_DEBOUNCE_MS = float(os.getenv("EVENTS_DASHBOARD_DEBOUNCE_MS", "1000"))
+# The channel the notify_*_changes() trigger functions publish on
+CHANGE_FEED_CHANNEL = "policyzen_changes"
+
+RESYNC_FRAME = b"event: resync\ndata: {}\n\n"
+
+
+def sse_frame(event: str, data: bytes) -> bytes:
+    return b"event: " + event.encode() + b"\ndata: " + data + b"\n\n"
+
+
+class ChangeSubscriber:
+    """One connected client: its company filter and bounded frame buffer"""
+
+    __slots__ = ("company_id", "queue", "overflowed")
+
+    def __init__(self, company_id: Optional[str], buffer_size: int):
+        self.company_id = company_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=buffer_size)
+        self.overflowed = False
+
+    def push(self, frame: bytes) -> bool:
+        try:
+            self.queue.put_nowait(frame)
+            return True
+        except asyncio.QueueFull:
+            self.overflowed = True
+            return False
+
+
+class ChangeFeed:
+    """The worker's LISTEN connection and the subscribers it fans out to"""
+
+    def __init__(self, dsn: Optional[str], buffer_size: int, debounce: float):
+        self.dsn = dsn
+        self.buffer_size = buffer_size
+        self.debounce = debounce
+        # company_id -> subscribers; None holds the unfiltered ones
+        self.subscribers: Dict[Optional[str], set] = defaultdict(set)
+        self.subscriber_count = 0
+        # Latest dashboard stats per subscribed company (None = all companies)
+        self.dashboards: Dict[Optional[str], dict] = {}
+        self.dirty: set = set()
+        self.dirty_event = asyncio.Event()
+        self.stats: Dict[str, Any] = {
+            "connected": False,
+            "reconnects": 0,
+            "notifications": 0,
+            "dropped_frames": 0,
+            "dashboard_refreshes": 0,
+            "last_error": None,
+        }
+
+    def start(self) -> List[asyncio.Task]:
+        self.dirty_event = asyncio.Event()
+        return [
+            asyncio.create_task(self.listen()),
+            asyncio.create_task(self.refresh_dashboards()),
+        ]
+
+    def subscribe(self, company_id: Optional[str]) -> ChangeSubscriber:
+        subscriber = ChangeSubscriber(company_id, self.buffer_size)
+        self.subscribers[company_id].add(subscriber)
+        self.subscriber_count += 1
+        dashboard = self.dashboards.get(company_id)
+        if dashboard is not None:
+            subscriber.push(self.dashboard_frame(company_id, dashboard))
+        else:
+            # First subscriber for this scope: one shared load for everyone
+            self.mark_dirty(company_id)
+        return subscriber
+
+    def unsubscribe(self, subscriber: ChangeSubscriber) -> None:
+        subscribers = self.subscribers.get(subscriber.company_id)
+        if subscribers is None or subscriber not in subscribers:
+            return
+        subscribers.discard(subscriber)
+        self.subscriber_count -= 1
+        if not subscribers:
+            # Nobody keeps this dashboard fresh any more
+            del self.subscribers[subscriber.company_id]
+            self.dashboards.pop(subscriber.company_id, None)
+
+    def publish(self, frame: bytes, company_id: Optional[str]) -> None:
+        for key in {company_id, None}:
+            for subscriber in self.subscribers.get(key, ()):
+                if not subscriber.push(frame):
+                    self.stats["dropped_frames"] += 1
+
+    def broadcast(self, frame: bytes) -> None:
+        for subscribers in self.subscribers.values():
+            for subscriber in subscribers:
+                if not subscriber.push(frame):
+                    self.stats["dropped_frames"] += 1
+
+    def mark_dirty(self, company_id: Optional[str]) -> None:
+        self.dirty.add(company_id)
+        self.dirty_event.set()
+
+    def on_notify(self, connection, pid: int, channel: str, payload: str) -> None:
+        self.stats["notifications"] += 1
+        try:
+            message = orjson.loads(payload)
+        except orjson.JSONDecodeError:
+            return
+        company_id = message.get("company_id")
+        # The trigger's JSON goes out as is; no per-subscriber encoding
+        self.publish(sse_frame(message["event"], payload.encode()), company_id)
+        self.mark_dirty(company_id)
+
+    async def listen(self) -> None:
+        while True:
+            conn = None
+            try:
+                conn = await asyncpg.connect(self.dsn)
+                lost = asyncio.Event()
+                conn.add_termination_listener(lambda _: lost.set())
+                await conn.add_listener(CHANGE_FEED_CHANNEL, self.on_notify)
+                if self.stats["reconnects"]:
+                    # Whatever was notified while we were away is gone
+                    self.broadcast(RESYNC_FRAME)
+                self.stats["connected"] = True
+                while not lost.is_set():
+                    try:
+                        await asyncio.wait_for(lost.wait(), EVENTS_HEARTBEAT_SECONDS)
+                    except asyncio.TimeoutError:
+                        # An idle LISTEN connection never notices a dead peer
+                        await conn.execute("SELECT 1")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.stats["last_error"] = str(e) or type(e).__name__
+                logging.getLogger(__name__).warning("Change feed listener failed: %s", e)
+            finally:
+                self.stats["connected"] = False
+                if conn is not None:
+                    conn.terminate()
+            self.stats["reconnects"] += 1
+            await asyncio.sleep(EVENTS_RECONNECT_SECONDS)
+
+    async def refresh_dashboards(self) -> None:
+        while True:
+            await self.dirty_event.wait()
+            # Trailing debounce: a burst of writes costs one refresh
+            await asyncio.sleep(self.debounce)
+            self.dirty_event.clear()
+            dirty, self.dirty = self.dirty, set()
+            keys = {key for key in dirty if key in self.subscribers}
+            if None in self.subscribers:
+                keys.add(None)
+            for key in keys:
+                try:
+                    await self.refresh_dashboard(key)
+                except Exception as e:
+                    self.stats["last_error"] = str(e) or type(e).__name__
+                    logging.getLogger(__name__).warning("Dashboard refresh failed: %s", e)
+
+    async def refresh_dashboard(self, company_id: Optional[str]) -> None:
+        params = {"since": dashboard_window_start(datetime.now(timezone.utc))}
+        name = "dashboard.stats"
+        if company_id is not None:
+            name = "dashboard.stats_by_company"
+            params["company_id"] = company_id
+        # The primary: a replica may not have replayed the notified commit yet
+        async with db() as session:
+            result = await QUERIES.execute(session, name, params)
+            row = result.first()
+        self.stats["dashboard_refreshes"] += 1
+        if company_id not in self.subscribers:
+            return
+
+        stats = DashboardStats(**dict(row._mapping)).model_dump()
+        previous = self.dashboards.get(company_id) or {}
+        self.dashboards[company_id] = stats
+        # Changed fields only, with their new values
+        delta = {field: value for field, value in stats.items() if previous.get(field) != value}
+        if delta:
+            frame = self.dashboard_frame(company_id, delta)
+            for subscriber in self.subscribers[company_id]:
+                if not subscriber.push(frame):
+                    self.stats["dropped_frames"] += 1
+
+    @staticmethod
+    def dashboard_frame(company_id: Optional[str], stats: dict) -> bytes:
+        return sse_frame("dashboard", orjson.dumps({"company_id": company_id, "stats": stats}))
+
+    async def stream(self, company_id: Optional[str]):
+        # Subscribing inside the generator ties cleanup to its finally block
+        subscriber = self.subscribe(company_id)
+        try:
+            yield f"retry: {int(EVENTS_RECONNECT_SECONDS * 1000)}\n\n".encode()
+            while True:
+                try:
+                    frame = await asyncio.wait_for(
+                        subscriber.queue.get(), EVENTS_HEARTBEAT_SECONDS
+                    )
+                except asyncio.TimeoutError:
+                    yield b": keepalive\n\n"
+                    continue
+                yield frame
+                if subscriber.overflowed and subscriber.queue.empty():
+                    # Frames were dropped: the client should refetch
+                    subscriber.overflowed = False
+                    yield RESYNC_FRAME
+        finally:
+            self.unsubscribe(subscriber)
+
+    def status(self) -> dict:
+        return {
+            "subscribers": self.subscriber_count,
+            "scopes": len(self.subscribers),
+            **self.stats,
+        }
+
+
+CHANGE_FEED = ChangeFeed(
+    EVENTS_DATABASE_URL, EVENTS_SUBSCRIBER_BUFFER, EVENTS_DASHBOARD_DEBOUNCE_MS / 1000
+)
+
+
+# Company groups
+# company_closure holds one row per (ancestor, descendant) pair, including
+# each company with itself at depth 0, so "the whole group under X" is one
+# indexed lookup. create/update/delete_company maintain it incrementally in
+# the same transaction; hierarchy changes are serialized by an advisory lock.
+COMPANY_TREE_LOCK_KEY = 7_310_003
+
+LOCK_COMPANY_TREE = text("SELECT pg_advisory_xact_lock(:key)")
+
+# Give `id`'s subtree every ancestor of `parent_id` (and the parent itself)
+ATTACH_COMPANY_SUBTREE = text("""
+    INSERT INTO company_closure (ancestor_id, descendant_id, depth)
+    SELECT above.ancestor_id, below.descendant_id, above.depth + below.depth + 1
+    FROM company_closure above
+    CROSS JOIN company_closure below
+    WHERE above.descendant_id = CAST(:parent_id AS uuid)
+      AND below.ancestor_id = CAST(:id AS uuid)
+""")
+
+# Cut `id`'s subtree loose from everything above `id`
+DETACH_COMPANY_SUBTREE = text("""
+    DELETE FROM company_closure
+    WHERE descendant_id IN (
+        SELECT descendant_id FROM company_closure WHERE ancestor_id = CAST(:id AS uuid)
+    )
+    AND ancestor_id IN (
+        SELECT ancestor_id FROM company_closure
+        WHERE descendant_id = CAST(:id AS uuid) AND ancestor_id <> CAST(:id AS uuid)
+    )
+""")
+
+
+async def link_company(session: AsyncSession, company_id: str, parent_id: Optional[str]) -> None:
+    await session.execute(LOCK_COMPANY_TREE, {"key": COMPANY_TREE_LOCK_KEY})
+    await session.execute(
+        text("""
+            INSERT INTO company_closure (ancestor_id, descendant_id, depth)
+            VALUES (CAST(:id AS uuid), CAST(:id AS uuid), 0)
+            ON CONFLICT DO NOTHING
+        """),
+        {"id": company_id},
+    )
+    if parent_id:
+        await session.execute(ATTACH_COMPANY_SUBTREE, {"id": company_id, "parent_id": parent_id})
+
+
+async def move_company(session: AsyncSession, company_id: str, parent_id: Optional[str]) -> None:
+    """Re-parent a company's subtree; raises 400 if that would create a cycle"""
+    await session.execute(LOCK_COMPANY_TREE, {"key": COMPANY_TREE_LOCK_KEY})
+    if parent_id:
+        result = await session.execute(
+            text("""
+                SELECT 1 FROM company_closure
+                WHERE ancestor_id = CAST(:id AS uuid)
+                  AND descendant_id = CAST(:parent_id AS uuid)
+            """),
+            {"id": company_id, "parent_id": parent_id},
+        )
+        if result.first():
+            raise HTTPException(
+                status_code=400, detail="A company cannot be moved under its own subsidiary"
+            )
+
+    await session.execute(DETACH_COMPANY_SUBTREE, {"id": company_id})
+    if parent_id:
+        await session.execute(ATTACH_COMPANY_SUBTREE, {"id": company_id, "parent_id": parent_id})
+
+
+async def unlink_company(session: AsyncSession, company_id: str) -> List[str]:
+    """Drop a deleted company from the tree; its subsidiaries become top-level groups.
+
+    Returns the ids of the detached subsidiaries.
+    """
+    await session.execute(LOCK_COMPANY_TREE, {"key": COMPANY_TREE_LOCK_KEY})
+    result = await session.execute(
+        text("""
+            UPDATE companies SET parent_company_id = NULL, updated_at = now()
+            WHERE parent_company_id = CAST(:id AS uuid)
+            RETURNING id
+        """),
+        {"id": company_id},
+    )
+    subsidiaries = [str(row.id) for row in result.fetchall()]
+    await session.execute(
+        text("""
+            DELETE FROM company_closure
+            WHERE descendant_id IN (
+                SELECT descendant_id FROM company_closure WHERE ancestor_id = CAST(:id AS uuid)
+            )
+            AND ancestor_id IN (
+                SELECT ancestor_id FROM company_closure WHERE descendant_id = CAST(:id AS uuid)
+            )
+        """),
+        {"id": company_id},
+    )
+    return subsidiaries
+
+
+# Bulk policy operations
+def policy_selection_sql(selection: PolicyBulkSelection, params: dict, alias: str = "") -> tuple:
+    """Build the WHERE clause for a bulk selection; returns (sql, invalid id failures)"""
+    prefix = f"{alias}." if alias else ""
+    if (selection.policy_ids is None) == (selection.filter is None):
+        raise HTTPException(
+            status_code=400, detail="Provide either policy_ids or filter"
+        )
+
+    if selection.policy_ids is not None:
+        valid, failures = [], []
+        for policy_id in selection.policy_ids:
+            try:
+                valid.append(str(uuid.UUID(policy_id)))
+            except ValueError:
+                failures.append(PolicyBulkFailure(policy_id=policy_id, error="Invalid policy id"))
+        params["ids"] = valid
+        return f"{prefix}id = ANY(CAST(:ids AS uuid[]))", failures
+
+    criteria = selection.filter
+    conditions = []
+    if criteria.provider:
+        conditions.append(f"{prefix}provider = :provider")
+        params["provider"] = criteria.provider
+    if criteria.insurance_type:
+        conditions.append(f"{prefix}insurance_type = :insurance_type")
+        params["insurance_type"] = criteria.insurance_type.value
+    if criteria.end_date_from:
+        conditions.append(f"{prefix}end_date >= :end_date_from")
+        params["end_date_from"] = criteria.end_date_from
+    if criteria.end_date_to:
+        conditions.append(f"{prefix}end_date <= :end_date_to")
+        params["end_date_to"] = criteria.end_date_to
+    if not conditions:
+        # Refuse to touch the whole book by accident
+        raise HTTPException(status_code=400, detail="Filter needs at least one criterion")
+    return " AND ".join(conditions), []
+
+
+def missing_policy_failures(selection: PolicyBulkSelection, params: dict, found: set) -> list:
+    if selection.policy_ids is None:
+        return []
+    return [
+        PolicyBulkFailure(policy_id=policy_id, error="Policy not found")
+        for policy_id in params["ids"]
+        if policy_id not in found
+    ]
+
+
+# Bulk imports
+BULK_INSERT_CHUNK_SIZE = int(os.getenv("BULK_INSERT_CHUNK_SIZE", "5000"))
+
+# Per subtype: validation model, natural key, whether the key is unique per
+# company or globally, the Postgres type of every inserted column (used to
+# cast the unnest() arrays) and how the matching entities row is described.
+BULK_IMPORT_SPECS = {
+    "employees": {
+        "model": EmployeeBase,
+        "key": "employee_code",
+        "per_company": True,
+        "entity_type": EntityType.EMPLOYEE,
+        "columns": {
+            "id": "uuid",
+            "company_id": "uuid",
+            "employee_code": "text",
+            "name": "text",
+            "status": "text",
+            "department": "text",
+            "position": "text",
+        },
+        "describe": lambda item: f"Employee: {item.name}",
+        "duplicate_detail": "Employee code already exists",
+    },
+    "students": {
+        "model": StudentBase,
+        "key": "student_id",
+        "per_company": True,
+        "entity_type": EntityType.STUDENT,
+        "columns": {
+            "id": "uuid",
+            "company_id": "uuid",
+            "student_id": "text",
+            "name": "text",
+            "status": "text",
+            "course": "text",
+            "year_of_study": "integer",
+        },
+        "describe": lambda item: f"Student: {item.name}",
+        "duplicate_detail": "Student ID already exists",
+    },
+    "vehicles": {
+        "model": VehicleBase,
+        "key": "registration_number",
+        "per_company": False,
+        "entity_type": EntityType.VEHICLE,
+        "columns": {
+            "id": "uuid",
+            "company_id": "uuid",
+            "registration_number": "text",
+            "make": "text",
+            "model": "text",
+            "year": "integer",
+            "status": "text",
+        },
+        "describe": lambda item: f"Vehicle: {item.make} {item.model}",
+        "duplicate_detail": "Registration number already exists",
+    },
+    "vessels": {
+        "model": VesselBase,
+        "key": "imo_number",
+        "per_company": False,
+        "entity_type": EntityType.SHIP,
+        "columns": {
+            "id": "uuid",
+            "company_id": "uuid",
+            "vessel_name": "text",
+            "imo_number": "text",
+            "status": "text",
+            "vessel_type": "text",
+            "flag": "text",
+        },
+        "describe": lambda item: f"Vessel: {item.vessel_name}",
+        "duplicate_detail": "IMO number already exists",
+    },
+}
+
+
+async def read_bulk_rows(request: Request) -> List[dict]:
+    """Read a bulk payload sent as a JSON array, a CSV body or a CSV file upload"""
+    content_type = request.headers.get("content-type", "")
+
+    if content_type.startswith("multipart/form-data"):
+        form = await request.form()
+        upload = form.get("file")
+        if upload is None or isinstance(upload, str):
+            raise HTTPException(status_code=400, detail="Missing CSV file")
+        raw = await upload.read()
+    elif content_type.startswith("text/csv"):
+        raw = await request.body()
+    else:
+        try:
+            payload = await request.json()
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid JSON body")
+        if not isinstance(payload, list):
+            raise HTTPException(status_code=400, detail="Expected a JSON array")
+        return payload
+
+    try:
+        text_body = raw.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="CSV must be UTF-8 encoded")
+    reader = csv.DictReader(io.StringIO(text_body))
+    # Blank CSV cells mean "not provided" so model defaults still apply
+    return [{k: v for k, v in row.items() if v not in ("", None)} for row in reader]
+
+
+async def bulk_import(table: str, rows: List[Any], atomic: bool) -> BulkImportReport:
+    """Validate, dedupe and insert a batch of subtype rows plus their entities"""
+    spec = BULK_IMPORT_SPECS[table]
+    key = spec["key"]
+    report = BulkImportReport(total=len(rows))
+    results: List[BulkRowResult] = []
+    valid = []  # (row index, validated model)
+    seen = set()
+
+    # ✅ Validate everything up front
+    for index, raw in enumerate(rows):
+        try:
+            item = spec["model"].model_validate(raw)
+        except ValidationError as e:
+            errors = [
+                f"{'.'.join(map(str, err['loc'])) or 'row'}: {err['msg']}"
+                for err in e.errors()
+            ]
+            results.append(BulkRowResult(row=index, status="error", errors=errors))
+            continue
+
+        try:
+            uuid.UUID(str(item.company_id))
+        except ValueError:
+            results.append(
+                BulkRowResult(row=index, status="error", errors=["company_id: Invalid UUID"])
+            )
+            continue
+
+        natural_key = (
+            (str(item.company_id), getattr(item, key))
+            if spec["per_company"]
+            else getattr(item, key)
+        )
+        if natural_key in seen:
+            results.append(
+                BulkRowResult(
+                    row=index, status="error", errors=[f"Duplicate {key} in upload"]
+                )
+            )
+            continue
+        seen.add(natural_key)
+        valid.append((index, item))
+
+    async with db() as session:
+        # ✅ One set-based duplicate check against existing rows
+        if valid:
+            if spec["per_company"]:
+                result = await session.execute(
+                    text(f"""
+                        SELECT t.company_id, t.{key} FROM {table} t
+                        JOIN unnest(CAST(:company_ids AS uuid[]), CAST(:keys AS text[]))
+                            AS k(company_id, natural_key)
+                        ON t.company_id = k.company_id AND t.{key} = k.natural_key
+                    """),
+                    {
+                        "company_ids": [str(item.company_id) for _, item in valid],
+                        "keys": [getattr(item, key) for _, item in valid],
+                    },
+                )
+                existing = {(str(r[0]), r[1]) for r in result.fetchall()}
+            else:
+                result = await session.execute(
+                    text(f"SELECT {key} FROM {table} WHERE {key} = ANY(CAST(:keys AS text[]))"),
+                    {"keys": [getattr(item, key) for _, item in valid]},
+                )
+                existing = {r[0] for r in result.fetchall()}
+
+            remaining = []
+            for index, item in valid:
+                natural_key = (
+                    (str(item.company_id), getattr(item, key))
+                    if spec["per_company"]
+                    else getattr(item, key)
+                )
+                if natural_key in existing:
+                    results.append(
+                        BulkRowResult(
+                            row=index, status="error", errors=[spec["duplicate_detail"]]
+                        )
+                    )
+                else:
+                    remaining.append((index, item))
+            valid = remaining
+
+        report.failed = len(results)
+        if atomic and report.failed:
+            results.extend(BulkRowResult(row=index, status="skipped") for index, _ in valid)
+            report.results = sorted(results, key=lambda r: r.row)
+            return report
+
+        columns = spec["columns"]
+        column_list = ", ".join(columns)
+        unnest_args = ", ".join(f"CAST(:{c} AS {t}[])" for c, t in columns.items())
+        insert_rows = text(f"""
+            INSERT INTO {table} ({column_list}, created_at, updated_at)
+            SELECT u.*, :now, :now FROM unnest({unnest_args}) AS u
+        """).bindparams(bindparam("now", type_=DateTime(timezone=True)))
+        insert_entities = text("""
+            INSERT INTO entities (
+                id, company_id, type, entity_id, description, created_at, updated_at
+            )
+            SELECT u.id, u.company_id, :type, u.entity_id, u.description, :now, :now
+            FROM unnest(
+                CAST(:ids AS uuid[]),
+                CAST(:company_ids AS uuid[]),
+                CAST(:entity_ids AS uuid[]),
+                CAST(:descriptions AS text[])
+            ) AS u(id, company_id, entity_id, description)
+        """).bindparams(bindparam("now", type_=DateTime(timezone=True)))
+
+        now = datetime.now(timezone.utc)
+        try:
+            # ✅ Multi-row inserts, chunked, all inside one transaction
+            created = []
+            for start in range(0, len(valid), BULK_INSERT_CHUNK_SIZE):
+                chunk = valid[start:start + BULK_INSERT_CHUNK_SIZE]
+                records = []
+                for index, item in chunk:
+                    record = item.model_dump(mode="json")
+                    record["id"] = str(uuid4())
+                    records.append(record)
+                    created.append(record)
+                    results.append(BulkRowResult(row=index, status="created", id=record["id"]))
+
+                await session.execute(
+                    insert_rows,
+                    {
+                        "now": now,
+                        **{c: [record.get(c) for record in records] for c in columns},
+                    },
+                )
+                await session.execute(
+                    insert_entities,
+                    {
+                        "now": now,
+                        "type": spec["entity_type"].value,
+                        "ids": [str(uuid4()) for _ in records],
+                        "company_ids": [record["company_id"] for record in records],
+                        "entity_ids": [record["id"] for record in records],
+                        "descriptions": [spec["describe"](item) for _, item in chunk],
+                    },
+                )
+            await session.commit()
+            invalidate_dashboard_stats()
+            await RESPONSE_CACHE.invalidate(
+                "entities", *{f"entities:{item.company_id}" for _, item in valid}
+            )
+        except Exception:
+            await session.rollback()
+            logging.getLogger(__name__).exception("Bulk import into %s failed", table)
+            raise HTTPException(status_code=500, detail=f"Failed to import {table}")
+
+    for record in created:
+        await AUDIT_LOG.record(
+            AuditAction.CREATE, table, record["id"], company_id=record["company_id"], after=record
+        )
+    report.created = len(valid)
+    report.results = sorted(results, key=lambda r: r.row)
+    return report
+
+
+# Portfolio analytics
+# Policy columns come back from Postgres as one row of arrays (array_agg), so
+# a large book is decoded straight into columns instead of row objects, and
+# every aggregate below is a vectorized NumPy/pandas operation. The compute
+# runs in a worker thread to keep the event loop free.
+PORTFOLIO_PERCENTILES = (50, 75, 90, 95, 99)
+# Lower edges of the sum-insured (loss exposure) bands
+PORTFOLIO_EXPOSURE_BANDS = tuple(
+    float(edge)
+    for edge in os.getenv(
+        "PORTFOLIO_EXPOSURE_BANDS", "0,100000,500000,1000000,5000000,10000000"
+    ).split(",")
+)
+PORTFOLIO_CACHE_SIZE = int(os.getenv("PORTFOLIO_CACHE_SIZE", "256"))
+
+# (company_id, include_descendants, status, bins) -> (etag, encoded result)
+_portfolio_cache: OrderedDict = OrderedDict()
+
+
+def portfolio_columns_sql(company_id: Optional[str], include_descendants: bool, status) -> str:
+    conditions = ["1=1"]
+    if company_id:
+        conditions.append(company_scope(include_descendants))
+    if status:
+        conditions.append("status = :status")
+    # NaN for missing amounts so they drop out of sums, means and percentiles
+    return f"""
+        SELECT
+            COUNT(*) AS policies,
+            array_agg(insurance_type) AS insurance_type,
+            array_agg(provider) AS provider,
+            array_agg(
+                CAST(EXTRACT(YEAR FROM start_date) * 12 + EXTRACT(MONTH FROM start_date) - 1
+                     AS int)
+            ) AS start_month,
+            array_agg(COALESCE(CAST(sum_insured AS float8), 'NaN')) AS sum_insured,
+            array_agg(COALESCE(CAST(premium_amount AS float8), 'NaN')) AS premium_amount
+        FROM policies
+        WHERE {" AND ".join(conditions)}
+    """
+
+
+def grouped_aggregates(
+    codes: np.ndarray, labels, premium: np.ndarray, sum_insured: np.ndarray
+) -> List[dict]:
+    """Per-group counts, sums and means in one np.bincount pass per column"""
+    size = len(labels)
+    present = codes >= 0  # factorize marks missing keys with -1
+    codes = codes[present]
+    premium = premium[present]
+    sum_insured = sum_insured[present]
+
+    policies = np.bincount(codes, minlength=size)
+    columns = {"policies": policies}
+    for name, values in (("premium", premium), ("sum_insured", sum_insured)):
+        known = ~np.isnan(values)
+        total = np.bincount(codes, weights=np.where(known, values, 0.0), minlength=size)
+        counted = np.bincount(codes, weights=known, minlength=size)
+        columns[f"total_{name}"] = total
+        with np.errstate(invalid="ignore", divide="ignore"):
+            columns[f"average_{name}"] = np.where(counted > 0, total / counted, np.nan)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        columns["premium_rate"] = columns["total_premium"] / columns["total_sum_insured"]
+
+    return [
+        {"group": label, **{name: values[i] for name, values in columns.items()}}
+        for i, label in enumerate(labels)
+        if policies[i]
+    ]
+
+
+def distribution(values: np.ndarray, bins: int) -> dict:
+    values = values[~np.isnan(values)]
+    if not len(values):
+        return {"percentiles": {}, "histogram": {"edges": [], "counts": []}}
+    counts, edges = np.histogram(values, bins=bins)
+    return {
+        "percentiles": dict(
+            zip((f"p{p}" for p in PORTFOLIO_PERCENTILES), np.percentile(values, PORTFOLIO_PERCENTILES))
+        ),
+        "histogram": {"edges": edges, "counts": counts},
+    }
+
+
+def compute_portfolio(columns: dict, bins: int) -> dict:
+    """Aggregate policy columns (as returned by portfolio_columns_sql)"""
+    sum_insured = np.asarray(columns["sum_insured"] or [], dtype=np.float64)
+    premium = np.asarray(columns["premium_amount"] or [], dtype=np.float64)
+
+    groups = {}
+    for key in ("insurance_type", "provider"):
+        codes, labels = pd.factorize(
+            np.asarray(columns[key] or [], dtype=object), sort=True
+        )
+        groups[key] = (codes, list(labels))
+
+    # Months arrive as year * 12 + month - 1; label them "YYYY-MM"
+    months = np.asarray(columns["start_month"] or [], dtype=np.float64)
+    known = ~np.isnan(months)
+    month_codes = np.full(len(months), -1, dtype=np.int64)
+    first_month = int(months[known].min()) if known.any() else 0
+    month_codes[known] = months[known].astype(np.int64) - first_month
+    span = int(month_codes.max()) + 1 if known.any() else 0
+    groups["start_month"] = (
+        month_codes,
+        [
+            f"{month // 12:04d}-{month % 12 + 1:02d}"
+            for month in range(first_month, first_month + span)
+        ],
+    )
+
+    edges = np.array(PORTFOLIO_EXPOSURE_BANDS + (np.inf,))
+    band_codes = np.searchsorted(edges, sum_insured, side="right") - 1
+    band_codes[np.isnan(sum_insured) | (band_codes >= len(edges) - 1)] = -1
+    groups["exposure_band"] = (
+        band_codes,
+        [
+            f"{low:,.0f}+" if np.isinf(high) else f"{low:,.0f}-{high:,.0f}"
+            for low, high in zip(edges[:-1], edges[1:])
+        ],
+    )
+
+    return {
+        "policies": len(premium),
+        "total_premium": np.nansum(premium),
+        "total_sum_insured": np.nansum(sum_insured),
+        **{
+            f"by_{key}": grouped_aggregates(codes, labels, premium, sum_insured)
+            for key, (codes, labels) in groups.items()
+        },
+        "premium_amount": distribution(premium, bins),
+        "sum_insured": distribution(sum_insured, bins),
+    }
+
+
+# Earned / unearned premium
+# Premium is earned pro rata by day over start_date..end_date, both inclusive.
+# An endorsement's premium_adjustment is earned pro rata from its effective
+# date to end_date. Dates arrive as day numbers so all the date arithmetic is
+# vectorized; a snapshot per as-of date is cached until policies or
+# endorsements change.
+EARNED_PREMIUM_CACHE_SIZE = int(os.getenv("EARNED_PREMIUM_CACHE_SIZE", "32"))
+EARNED_PREMIUM_FIELDS = (
+    "policy_id",
+    "policy_number",
+    "insurance_type",
+    "provider",
+    "start_date",
+    "end_date",
+    "premium_amount",
+    "endorsement_adjustment",
+    "written_premium",
+    "earned_premium",
+    "unearned_premium",
+)
+EARNED_PREMIUM_TOTALS = (
+    "premium_amount",
+    "endorsement_adjustment",
+    "written_premium",
+    "earned_premium",
+    "unearned_premium",
+)
+
+# (as_of, company_id, include_descendants) -> (table versions, snapshot)
+_earned_premium_cache: OrderedDict = OrderedDict()
+
+
+def earned_premium_sql(company_id: Optional[str], include_descendants: bool) -> tuple:
+    """Columnar policy and endorsement queries for policies in force on :as_of"""
+    conditions = [
+        "p.start_date <= :as_of",
+        "p.end_date >= :as_of",
+        # Dates decide what was in force on :as_of; the expiry job marks
+        # policies EXPIRED after the fact, so those still count
+        "p.status IN ('ACTIVE', 'EXPIRED')",
+    ]
+    if company_id:
+        conditions.append(company_scope(include_descendants, column="p.company_id"))
+    where = " AND ".join(conditions)
+    policies = f"""
+        SELECT
+            array_agg(CAST(p.id AS text)) AS policy_id,
+            array_agg(p.policy_number) AS policy_number,
+            array_agg(p.insurance_type) AS insurance_type,
+            array_agg(p.provider) AS provider,
+            array_agg(p.start_date - DATE '1970-01-01') AS start_day,
+            array_agg(p.end_date - DATE '1970-01-01') AS end_day,
+            array_agg(COALESCE(CAST(p.premium_amount AS float8), 0)) AS premium_amount
+        FROM policies p
+        WHERE {where}
+    """
+    endorsements = f"""
+        SELECT
+            array_agg(CAST(e.policy_id AS text)) AS policy_id,
+            array_agg(e.effective_date - DATE '1970-01-01') AS effective_day,
+            array_agg(CAST(e.premium_adjustment AS float8)) AS premium_adjustment
+        FROM endorsements e
+        JOIN policies p ON p.id = e.policy_id
+        WHERE e.premium_adjustment <> 0 AND e.effective_date <= :as_of AND {where}
+    """
+    return policies, endorsements
+
+
+def group_totals(keys: list, columns: dict, key: str) -> List[dict]:
+    codes, labels = pd.factorize(np.asarray(keys, dtype=object), sort=True)
+    size = len(labels)
+    sums = {
+        name: np.round(np.bincount(codes, weights=columns[name], minlength=size), 2)
+        for name in EARNED_PREMIUM_TOTALS
+    }
+    counts = np.bincount(codes, minlength=size)
+    return [
+        {key: label, "policies": counts[i], **{name: sums[name][i] for name in sums}}
+        for i, label in enumerate(labels)
+    ]
+
+
+def compute_earned_premium(policies: dict, endorsements: dict, as_of: date) -> dict:
+    """Earned/unearned premium per policy plus totals, from columnar rows"""
+    as_of_day = (as_of - date(1970, 1, 1)).days
+    ids = policies["policy_id"] or []
+    start = np.asarray(policies["start_day"] or [], dtype=np.int64)
+    end = np.asarray(policies["end_day"] or [], dtype=np.int64)
+    premium = np.asarray(policies["premium_amount"] or [], dtype=np.float64)
+
+    # Days in force so far over days in the term
+    term_days = np.maximum(end - start + 1, 1)
+    elapsed = np.clip(as_of_day - start + 1, 0, term_days)
+    earned = premium * elapsed / term_days
+
+    adjustment = np.zeros(len(ids))
+    adjustment_earned = np.zeros(len(ids))
+    if endorsements["policy_id"]:
+        index = pd.Index(ids).get_indexer(endorsements["policy_id"])
+        known = index >= 0
+        index = index[known]
+        amount = np.asarray(endorsements["premium_adjustment"], dtype=np.float64)[known]
+        # Effective dates before the term start earn over the whole term
+        effective = np.maximum(
+            np.asarray(endorsements["effective_day"], dtype=np.int64)[known], start[index]
+        )
+        remaining_days = np.maximum(end[index] - effective + 1, 1)
+        remaining_elapsed = np.clip(as_of_day - effective + 1, 0, remaining_days)
+        adjustment = np.bincount(index, weights=amount, minlength=len(ids))
+        adjustment_earned = np.bincount(
+            index, weights=amount * remaining_elapsed / remaining_days, minlength=len(ids)
+        )
+
+    written = premium + adjustment
+    earned = np.round(earned + adjustment_earned, 2)
+    columns = {
+        "premium_amount": premium,
+        "endorsement_adjustment": np.round(adjustment, 2),
+        "written_premium": np.round(written, 2),
+        "earned_premium": earned,
+        "unearned_premium": np.round(written - earned, 2),
+    }
+    return {
+        "as_of": as_of,
+        "policies": len(ids),
+        "totals": {name: np.round(values.sum(), 2) for name, values in columns.items()},
+        "by_insurance_type": group_totals(
+            policies["insurance_type"] or [], columns, "insurance_type"
+        ),
+        "by_provider": group_totals(policies["provider"] or [], columns, "provider"),
+        "rows": {
+            "policy_id": ids,
+            "policy_number": policies["policy_number"] or [],
+            "insurance_type": policies["insurance_type"] or [],
+            "provider": policies["provider"] or [],
+            "start_date": start.astype("datetime64[D]"),
+            "end_date": end.astype("datetime64[D]"),
+            **columns,
+        },
+    }
+
+
+async def earned_premium_snapshot(
+    request: Request,
+    response: Response,
+    as_of: Optional[date],
+    company_id: Optional[str],
+    include_descendants: bool,
+) -> Union[dict, Response]:
+    """The cached snapshot for the request, or a 304 Response"""
+    as_of = as_of or datetime.now(timezone.utc).date()
+    params = {"as_of": as_of}
+    if company_id:
+        params["company_id"] = company_id
+    tables = scoped_tables(("policies", "endorsements"), include_descendants)
+    cache_key = (as_of, company_id, include_descendants)
+
+    async with read_db() as session:
+        versions = await table_versions(session, tables)
+        # as_of defaults to today, so it is not always part of the URL
+        not_modified = await check_not_modified(
+            session, request, response, tables, as_of, versions=versions
+        )
+        if not_modified:
+            return not_modified
+
+        # Validated by the data it was built from, not the request's ETag
+        # (which also covers the path and format), so both endpoints and
+        # every format share one snapshot
+        data_version = tuple(sorted(versions.items()))
+        cached = _earned_premium_cache.get(cache_key)
+        if cached and cached[0] == data_version:
+            _earned_premium_cache.move_to_end(cache_key)
+            return cached[1]
+
+        policies_sql, endorsements_sql = earned_premium_sql(company_id, include_descendants)
+        policies = await QUERIES.execute(
+            session, "finance.earned_premium_policies", params, sql=policies_sql
+        )
+        policies = dict(policies.first()._mapping)
+        endorsements = await QUERIES.execute(
+            session, "finance.earned_premium_endorsements", params, sql=endorsements_sql
+        )
+        endorsements = dict(endorsements.first()._mapping)
+
+    snapshot = await asyncio.to_thread(compute_earned_premium, policies, endorsements, as_of)
+    _earned_premium_cache[cache_key] = (data_version, snapshot)
+    if len(_earned_premium_cache) > EARNED_PREMIUM_CACHE_SIZE:
+        _earned_premium_cache.popitem(last=False)
+    return snapshot
+
+
+def stream_earned_premium(snapshot: dict, fmt: ExportFormat):
+    """Encode per-policy rows from a snapshot one chunk at a time"""
+    rows = snapshot["rows"]
+    if fmt == ExportFormat.CSV:
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow(EARNED_PREMIUM_FIELDS)
+        yield buffer.getvalue()
+
+    for offset in range(0, snapshot["policies"], EXPORT_CHUNK_SIZE):
+        chunk = [
+            rows[name][offset : offset + EXPORT_CHUNK_SIZE].tolist()
+            if isinstance(rows[name], np.ndarray)
+            else rows[name][offset : offset + EXPORT_CHUNK_SIZE]
+            for name in EARNED_PREMIUM_FIELDS
+        ]
+        if fmt == ExportFormat.CSV:
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows(zip(*chunk))
+            yield buffer.getvalue()
+        else:
+            yield b"".join(
+                orjson.dumps(dict(zip(EARNED_PREMIUM_FIELDS, values)), option=orjson.OPT_APPEND_NEWLINE)
+                for values in zip(*chunk)
+            )
+
+
+# Document storage
+# Uploads are parsed straight off the request stream: the file part goes to a
+# temp file in chunks while its SHA-256 is computed, so scanned policy packs
+# are never held in memory. Content is stored once per hash in document_blobs
+# and reference counted by a trigger on documents; collect_document_blobs()
+# removes blobs nothing references any more. Local disk is the default
+# backend; DOCUMENT_STORAGE_BACKEND=s3 uses an S3-compatible bucket (needs
+# `boto3`).
+DOCUMENT_STORAGE_BACKEND = os.getenv("DOCUMENT_STORAGE_BACKEND", "local").lower()
+DOCUMENT_STORAGE_PATH = Path(os.getenv("DOCUMENT_STORAGE_PATH", str(ROOT_DIR / "uploads")))
+DOCUMENT_S3_BUCKET = os.getenv("DOCUMENT_S3_BUCKET", "")
+DOCUMENT_S3_PREFIX = os.getenv("DOCUMENT_S3_PREFIX", "documents/")
+DOCUMENT_S3_ENDPOINT_URL = os.getenv("DOCUMENT_S3_ENDPOINT_URL") or None
+DOCUMENT_MAX_UPLOAD_BYTES = int(os.getenv("DOCUMENT_MAX_UPLOAD_BYTES", str(512 * 1024 * 1024)))
+DOCUMENT_CHUNK_SIZE = int(os.getenv("DOCUMENT_CHUNK_SIZE", str(1024 * 1024)))
+DOCUMENT_MAX_FIELD_BYTES = 64 * 1024
+
+
+class LocalDocumentStore:
+    """Blobs as files under DOCUMENT_STORAGE_PATH, fanned out by hash prefix"""
+
+    name = "local"
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.temp_dir = root / "tmp"
+
+    def path(self, key: str) -> Optional[Path]:
+        return self.root / key[:2] / key[2:4] / key
 
+    def locator(self, key: str) -> str:
+        return str(self.path(key).relative_to(self.root))
 
-class Vessel(VesselBase):
-    model_config = ConfigDict(extra="ignore")
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    created_at: datetime = Column(DateTime(timezone=True), server_default=func.now())
-    updated_at: datetime = Column(DateTime(timezone=True), onupdate=func.now())
+    async def put(self, source: Path, key: str, content_type: str) -> None:
+        target = self.path(key)
 
+        def move():
+            target.parent.mkdir(parents=True, exist_ok=True)
+            # Same filesystem as temp_dir, so this is an atomic rename
+            os.replace(source, target)
 
-class VehicleBase(BaseModel):
-    company_id: str
-    registration_number: str
-    make: str
-    model: str
-    year: int
-    status: EntityStatus = EntityStatus.ACTIVE
+        await asyncio.to_thread(move)
 
+    async def delete(self, key: str) -> None:
+        await asyncio.to_thread(self.path(key).unlink, missing_ok=True)
 
-class Vehicle(VehicleBase):
-    model_config = ConfigDict(extra="ignore")
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    created_at: datetime = Column(DateTime(timezone=True), server_default=func.now())
-    updated_at: datetime = Column(DateTime(timezone=True), onupdate=func.now())
+    async def read(self, key: str, start: int, end: int):
+        """Yield bytes start..end (inclusive), one chunk at a time"""
+        fd = await asyncio.to_thread(os.open, self.path(key), os.O_RDONLY)
+        try:
+            offset = start
+            while offset <= end:
+                chunk = await asyncio.to_thread(
+                    os.pread, fd, min(DOCUMENT_CHUNK_SIZE, end - offset + 1), offset
+                )
+                if not chunk:
+                    break
+                offset += len(chunk)
+                yield chunk
+        finally:
+            os.close(fd)
 
 
-class EntityBase(BaseModel):
-    company_id: str
-    type: EntityType
-    entity_id: str  # Reference to specific entity (employee, student, etc.)
-    description: Optional[str] = None
+class S3DocumentStore:
+    """Blobs as objects in an S3-compatible bucket"""
 
+    name = "s3"
 
-class Entity(EntityBase):
-    model_config = ConfigDict(extra="ignore")
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
-    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    def __init__(self, bucket: str, prefix: str, endpoint_url: Optional[str], temp_dir: Path):
+        import boto3
 
+        self.client = boto3.client("s3", endpoint_url=endpoint_url)
+        self.bucket = bucket
+        self.prefix = prefix
+        self.temp_dir = temp_dir
 
-class InsurancePolicyBase(BaseModel):
-    entity_id: str
-    policy_number: str
-    insurance_type: InsuranceType
-    provider: str
-    start_date: date
-    end_date: date
-    sum_insured: float
-    premium_amount: float
-    status: PolicyStatus = PolicyStatus.ACTIVE
-    created_by: str
+    def path(self, key: str) -> Optional[Path]:
+        return None
 
+    def locator(self, key: str) -> str:
+        return f"s3://{self.bucket}/{self.prefix}{key}"
 
-class InsurancePolicy(InsurancePolicyBase):
-    model_config = ConfigDict(extra="ignore")
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
-    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    async def put(self, source: Path, key: str, content_type: str) -> None:
+        # upload_file switches to a multipart upload for large files
+        await asyncio.to_thread(
+            self.client.upload_file,
+            str(source),
+            self.bucket,
+            self.prefix + key,
+            ExtraArgs={"ContentType": content_type},
+        )
+        await asyncio.to_thread(source.unlink, missing_ok=True)
 
+    async def delete(self, key: str) -> None:
+        await asyncio.to_thread(
+            self.client.delete_object, Bucket=self.bucket, Key=self.prefix + key
+        )
 
-class PolicyEndorsementBase(BaseModel):
-    policy_id: str
-    endorsement_number: str
-    description: str
-    effective_date: date
-    created_by: str
+    async def read(self, key: str, start: int, end: int):
+        if end < start:
+            return
+        obj = await asyncio.to_thread(
+            self.client.get_object,
+            Bucket=self.bucket,
+            Key=self.prefix + key,
+            Range=f"bytes={start}-{end}",
+        )
+        body = obj["Body"]
+        try:
+            while chunk := await asyncio.to_thread(body.read, DOCUMENT_CHUNK_SIZE):
+                yield chunk
+        finally:
+            body.close()
+
+
+def create_document_store():
+    if DOCUMENT_STORAGE_BACKEND == "s3":
+        return S3DocumentStore(
+            DOCUMENT_S3_BUCKET,
+            DOCUMENT_S3_PREFIX,
+            DOCUMENT_S3_ENDPOINT_URL,
+            DOCUMENT_STORAGE_PATH / "tmp",
+        )
+    return LocalDocumentStore(DOCUMENT_STORAGE_PATH)
+
+
+DOCUMENT_STORE = create_document_store()
+
+# The upsert locks an existing blob row, so a concurrent
+# collect_document_blobs() cannot remove content a new document is about to
+# reference; xmax = 0 means the row was inserted rather than updated
+UPSERT_DOCUMENT_BLOB = """
+    INSERT INTO document_blobs (sha256, size_bytes, storage_key, content_type)
+    VALUES (:sha256, :size_bytes, :storage_key, :content_type)
+    ON CONFLICT (sha256) DO UPDATE SET sha256 = EXCLUDED.sha256
+    RETURNING (xmax = 0) AS inserted
+"""
+
+COLLECT_DOCUMENT_BLOBS = """
+    SELECT sha256 FROM document_blobs
+    WHERE ref_count <= 0
+    ORDER BY sha256
+    LIMIT :limit
+    FOR UPDATE SKIP LOCKED
+"""
+
+
+async def receive_document_upload(request: Request) -> dict:
+    """Parse a multipart upload off the request stream.
+
+    Returns the form fields as strings plus the single file part's name,
+    content type, size, SHA-256 and temp file. The caller must remove
+    `temp_path` once the content is stored.
+    """
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in options:
+        raise HTTPException(status_code=400, detail="Expected a multipart/form-data body")
+
+    await asyncio.to_thread(DOCUMENT_STORE.temp_dir.mkdir, parents=True, exist_ok=True)
+    temp_path = DOCUMENT_STORE.temp_dir / uuid.uuid4().hex
+    handle = await asyncio.to_thread(open, temp_path, "wb")
+    digest = hashlib.sha256()
+    upload = {"fields": {}, "file_name": None, "content_type": None, "size": 0}
+    part: dict = {}
+    pending: List[bytes] = []
+
+    def on_part_begin():
+        part.clear()
+        part.update(headers={}, header_field=b"", header_value=b"", data=bytearray())
+
+    def on_header_field(data, start, end):
+        part["header_field"] += data[start:end]
+
+    def on_header_value(data, start, end):
+        part["header_value"] += data[start:end]
+
+    def on_header_end():
+        part["headers"][part["header_field"].lower()] = part["header_value"]
+        part["header_field"] = part["header_value"] = b""
+
+    def on_headers_finished():
+        _, params = parse_options_header(part["headers"].get(b"content-disposition", b""))
+        part["name"] = params.get(b"name", b"").decode("utf-8", "replace")
+        part["is_file"] = b"filename" in params
+        if part["is_file"]:
+            if upload["file_name"] is not None:
+                raise HTTPException(status_code=400, detail="Only one file per upload")
+            upload["file_name"] = params[b"filename"].decode("utf-8", "replace")
+            upload["content_type"] = part["headers"].get(
+                b"content-type", b"application/octet-stream"
+            ).decode("latin-1")
+
+    def on_part_data(data, start, end):
+        if part["is_file"]:
+            upload["size"] += end - start
+            if upload["size"] > DOCUMENT_MAX_UPLOAD_BYTES:
+                raise HTTPException(status_code=413, detail="Document too large")
+            pending.append(bytes(data[start:end]))
+        else:
+            part["data"] += data[start:end]
+            if len(part["data"]) > DOCUMENT_MAX_FIELD_BYTES:
+                raise HTTPException(status_code=400, detail=f"Field {part['name']} too large")
+
+    def on_part_end():
+        if not part["is_file"]:
+            upload["fields"][part["name"]] = part["data"].decode("utf-8", "replace")
+
+    def write(data: bytes):
+        # Hash and write off the event loop (hashlib releases the GIL)
+        digest.update(data)
+        handle.write(data)
+
+    parser = MultipartParser(
+        options[b"boundary"],
+        {
+            "on_part_begin": on_part_begin,
+            "on_header_field": on_header_field,
+            "on_header_value": on_header_value,
+            "on_header_end": on_header_end,
+            "on_headers_finished": on_headers_finished,
+            "on_part_data": on_part_data,
+            "on_part_end": on_part_end,
+        },
+    )
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            if sum(map(len, pending)) >= DOCUMENT_CHUNK_SIZE:
+                await asyncio.to_thread(write, b"".join(pending))
+                pending.clear()
+        parser.finalize()
+        if pending:
+            await asyncio.to_thread(write, b"".join(pending))
+        await asyncio.to_thread(handle.close)
+        if upload["file_name"] is None:
+            raise HTTPException(status_code=400, detail="No file in upload")
+    except BaseException:
+        handle.close()
+        temp_path.unlink(missing_ok=True)
+        raise
+
+    upload.update(temp_path=temp_path, sha256=digest.hexdigest())
+    return upload
+
+
+def parse_byte_range(header: Optional[str], size: int) -> Optional[tuple]:
+    """Inclusive (start, end) of a single `bytes=` range; None serves everything"""
+    if not header or not header.startswith("bytes=") or "," in header:
+        # Multi-range requests may be answered with the whole body
+        return None
+    first, _, last = header[len("bytes="):].strip().partition("-")
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+        else:
+            # Suffix range: the last N bytes
+            start, end = size - min(int(last), size), size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        raise HTTPException(
+            status_code=416,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"},
+        )
+    if end < start:
+        return None
+    return start, min(end, size - 1)
+
+
+async def collect_document_blobs(limit: int = 100) -> int:
+    """Remove stored content no document references any more"""
+    try:
+        async with db() as session:
+            result = await session.execute(text(COLLECT_DOCUMENT_BLOBS), {"limit": limit})
+            keys = [row[0] for row in result.fetchall()]
+            # Content goes first, under the row locks, so a failed delete
+            # leaves the row behind for the next run
+            for key in keys:
+                await DOCUMENT_STORE.delete(key)
+            if keys:
+                await session.execute(
+                    text("DELETE FROM document_blobs WHERE sha256 = ANY(:keys)"), {"keys": keys}
+                )
+            await session.commit()
+            return len(keys)
+    except Exception as e:
+        logging.getLogger(__name__).warning("Document blob cleanup failed: %s", e)
+        return 0
+
+
+# Endorsement change log
+# Endorsements carry structured field-level deltas, stored one row each in
+# endorsement_changes. A policy's state on a date is rebuilt from the latest
+# snapshot at or before it plus the changes since, in (effective_date, id)
+# order. The first structured endorsement snapshots the policy as written;
+# after every POLICY_SNAPSHOT_INTERVAL further changes another snapshot is
+# stored, so a rebuild never replays more than about that many changes.
+# Backdated endorsements drop the snapshots they invalidate. Deltas in effect
+# are written to the live policies row in the endorsement's transaction;
+# future-dated ones by the policy expiry loop once their date comes. Direct
+# PUT edits to a policy with history are logged as deltas effective today.
+POLICY_SNAPSHOT_INTERVAL = int(os.getenv("POLICY_SNAPSHOT_INTERVAL", "100"))
+# Snapshot position of the policy as written, before any change
+BASE_SNAPSHOT_DATE = date.min
+# Set-valued field for fleet policies: ADDED/REMOVED entity ids
+COVERED_ENTITIES_FIELD = "entities"
+
+# Scalar fields an endorsement may MODIFY, with validators for new values
+POLICY_CHANGE_FIELDS = {
+    name: TypeAdapter(info.annotation)
+    for name, info in InsurancePolicyBase.model_fields.items()
+    if name not in ("status", "entity_id", "created_by")
+}
+POLICY_STATUS_ADAPTER = TypeAdapter(PolicyStatus)
+
+QUERIES.register(
+    "policy_snapshots.latest",
+    """
+    SELECT state, effective_date, change_id FROM policy_snapshots
+    WHERE policy_id = :policy_id AND effective_date <= :as_of
+    ORDER BY effective_date DESC, change_id DESC
+    LIMIT 1
+    """,
+)
+QUERIES.register(
+    "endorsement_changes.since",
+    """
+    SELECT id, effective_date, field, change_type, old_value, new_value
+    FROM endorsement_changes
+    WHERE policy_id = :policy_id
+      AND effective_date <= :as_of
+      AND (effective_date, id) > (:after_date, :after_id)
+    ORDER BY effective_date, id
+    """,
+)
 
 
-class PolicyEndorsement(PolicyEndorsementBase):
-    model_config = ConfigDict(extra="ignore")
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
-    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+def policy_state(row) -> dict:
+    """JSON-ready policy state from a policies row"""
+    state = orjson.loads(row_serializer(row._fields).to_json([row]))[0]
+    state[COVERED_ENTITIES_FIELD] = [state["entity_id"]] if state.get("entity_id") else []
+    return state
 
 
-class DocumentBase(BaseModel):
-    policy_id: Optional[str] = None
-    endorsement_id: Optional[str] = None
-    uploaded_by: str
-    file_name: str
-    file_path: str
-    file_type: str
-    document_type: DocumentType
+def apply_policy_change(state: dict, change) -> None:
+    """Apply one delta (a mapping, e.g. a row's `_mapping`) to a policy state"""
+    if change["change_type"] == EndorsementChangeType.ADDED.value:
+        if change["new_value"] not in state[COVERED_ENTITIES_FIELD]:
+            state[COVERED_ENTITIES_FIELD].append(change["new_value"])
+    elif change["change_type"] == EndorsementChangeType.REMOVED.value:
+        state[COVERED_ENTITIES_FIELD] = [
+            covered for covered in state[COVERED_ENTITIES_FIELD] if covered != change["old_value"]
+        ]
+    else:
+        state[change["field"]] = change["new_value"]
+
+
+async def policy_state_as_of(session: AsyncSession, policy_id: str, as_of: date) -> Optional[dict]:
+    """Rebuild a policy on `as_of`; None if the policy does not exist"""
+    result = await QUERIES.execute(
+        session, "policy_snapshots.latest", {"policy_id": policy_id, "as_of": as_of}
+    )
+    snapshot = result.first()
+    if snapshot is None:
+        # No structured endorsements yet: the policy is as written
+        result = await QUERIES.execute(session, "policies.by_id", {"id": policy_id})
+        row = result.first()
+        if row is None:
+            return None
+        return {
+            "state": policy_state(row),
+            "snapshot_date": None,
+            "changes_applied": 0,
+            "position": None,
+        }
 
+    result = await QUERIES.execute(
+        session,
+        "endorsement_changes.since",
+        {
+            "policy_id": policy_id,
+            "as_of": as_of,
+            "after_date": snapshot.effective_date,
+            "after_id": snapshot.change_id,
+        },
+    )
+    changes = result.fetchall()
+    state = snapshot.state
+    for change in changes:
+        apply_policy_change(state, change._mapping)
+    last = changes[-1] if changes else None
+    return {
+        "state": state,
+        "snapshot_date": None
+        if snapshot.effective_date == BASE_SNAPSHOT_DATE
+        else snapshot.effective_date,
+        "changes_applied": len(changes),
+        "position": (last.effective_date, last.id)
+        if last
+        else (snapshot.effective_date, snapshot.change_id),
+    }
+
+
+def normalize_policy_changes(changes: List[EndorsementChange], state: dict) -> List[dict]:
+    """Validate deltas against the state they apply to, recording old values.
+
+    Applies the deltas to `state` as it goes, so later ones in the same
+    endorsement see earlier ones.
+    """
+    normalized = []
+    for change in changes:
+        kind = change.change_type
+        if kind in (EndorsementChangeType.ADDED, EndorsementChangeType.REMOVED):
+            added = kind == EndorsementChangeType.ADDED
+            entity_id = change.new_value if added else change.old_value
+            if change.field != COVERED_ENTITIES_FIELD or entity_id is None:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"{kind.value} takes an entity id in "
+                    f"{'new_value' if added else 'old_value'} of {COVERED_ENTITIES_FIELD}",
+                )
+            entity_id = str(entity_id)
+            if (entity_id in state[COVERED_ENTITIES_FIELD]) == added:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Entity {entity_id} is {'already' if added else 'not'} covered",
+                )
+            delta = {
+                "old_value": None if added else entity_id,
+                "new_value": entity_id if added else None,
+            }
+        else:
+            if kind == EndorsementChangeType.STATUS_CHANGE:
+                adapter = POLICY_STATUS_ADAPTER if change.field == "status" else None
+            else:
+                adapter = POLICY_CHANGE_FIELDS.get(change.field)
+            if adapter is None:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"{kind.value} cannot be applied to {change.field}",
+                )
+            try:
+                new_value = adapter.dump_python(
+                    adapter.validate_python(change.new_value), mode="json"
+                )
+            except ValidationError as e:
+                raise HTTPException(
+                    status_code=422, detail=f"{change.field}: {e.errors()[0]['msg']}"
+                )
+            delta = {"old_value": state.get(change.field), "new_value": new_value}
+
+        delta.update(field=change.field, change_type=kind.value)
+        apply_policy_change(state, delta)
+        normalized.append(delta)
+    return normalized
+
+
+INSERT_POLICY_SNAPSHOT = text("""
+    INSERT INTO policy_snapshots (policy_id, effective_date, change_id, state)
+    VALUES (:policy_id, :effective_date, :change_id, CAST(:state AS jsonb))
+    ON CONFLICT DO NOTHING
+""")
+
+INSERT_ENDORSEMENT_CHANGE = text("""
+    INSERT INTO endorsement_changes (endorsement_id, policy_id, effective_date, field, change_type, old_value, new_value, applied_at)
+    VALUES (:endorsement_id, :policy_id, :effective_date, :field, :change_type, CAST(:old_value AS jsonb), CAST(:new_value AS jsonb), :applied_at)
+""")
+
+# A change dated before a snapshot invalidates it
+DELETE_LATER_POLICY_SNAPSHOTS = text("""
+    DELETE FROM policy_snapshots
+    WHERE policy_id = :policy_id AND effective_date > :effective_date
+""")
+
+COUNT_CHANGES_SINCE_SNAPSHOT = text("""
+    SELECT COUNT(*) FROM endorsement_changes
+    WHERE policy_id = :policy_id
+      AND (effective_date, id) > (
+          SELECT effective_date, change_id FROM policy_snapshots
+          WHERE policy_id = :policy_id
+          ORDER BY effective_date DESC, change_id DESC
+          LIMIT 1
+      )
+""")
+
+CLAIM_DUE_POLICY_CHANGES = text("""
+    UPDATE endorsement_changes SET applied_at = now()
+    WHERE policy_id = :policy_id AND applied_at IS NULL AND effective_date <= :today
+    RETURNING field
+""")
+
+
+async def store_policy_changes(
+    session: AsyncSession,
+    policy_id: str,
+    endorsement_id: Optional[str],
+    effective_date: date,
+    deltas: List[dict],
+    applied: bool = False,
+) -> None:
+    """Log normalized deltas, snapshotting every POLICY_SNAPSHOT_INTERVAL changes"""
+    params = {"policy_id": policy_id}
+    await session.execute(
+        INSERT_ENDORSEMENT_CHANGE,
+        [
+            {
+                **params,
+                "endorsement_id": endorsement_id,
+                "effective_date": effective_date,
+                "field": delta["field"],
+                "change_type": delta["change_type"],
+                "old_value": orjson.dumps(delta["old_value"]).decode(),
+                "new_value": orjson.dumps(delta["new_value"]).decode(),
+                "applied_at": datetime.now(timezone.utc) if applied else None,
+            }
+            for delta in deltas
+        ],
+    )
+
+    result = await session.execute(COUNT_CHANGES_SINCE_SNAPSHOT, params)
+    if result.scalar() >= POLICY_SNAPSHOT_INTERVAL:
+        latest = await policy_state_as_of(session, policy_id, date.max)
+        snapshot_date, change_id = latest["position"]
+        await session.execute(
+            INSERT_POLICY_SNAPSHOT,
+            {
+                **params,
+                "effective_date": snapshot_date,
+                "change_id": change_id,
+                "state": orjson.dumps(latest["state"]).decode(),
+            },
+        )
 
-class Document(DocumentBase):
-    model_config = ConfigDict(extra="ignore")
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    uploaded_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+async def record_endorsement_changes(
+    session: AsyncSession, endorsement: "PolicyEndorsement"
+) -> List[dict]:
+    """Validate and store an endorsement's deltas, maintaining the policy's snapshots"""
+    params = {"policy_id": endorsement.policy_id}
+    # Row lock: endorsements to one policy are recorded one at a time
+    result = await session.execute(
+        text("SELECT * FROM policies WHERE id = :policy_id FOR UPDATE"), params
+    )
+    policy = result.first()
+    if policy is None:
+        raise HTTPException(status_code=404, detail="Policy not found")
+
+    result = await session.execute(
+        text("SELECT 1 FROM policy_snapshots WHERE policy_id = :policy_id LIMIT 1"), params
+    )
+    if result.first() is None:
+        await session.execute(
+            INSERT_POLICY_SNAPSHOT,
+            {
+                **params,
+                "effective_date": BASE_SNAPSHOT_DATE,
+                "change_id": 0,
+                "state": orjson.dumps(policy_state(policy)).decode(),
+            },
+        )
+    else:
+        await session.execute(
+            DELETE_LATER_POLICY_SNAPSHOTS,
+            {**params, "effective_date": endorsement.effective_date},
+        )
 
-# Dashboard stats model
-class DashboardStats(BaseModel):
-    total_policies: int = 0
-    active_policies: int = 0
-    expired_policies: int = 0
-    total_premium: float = 0.0
-    total_entities: int = 0
-    recent_endorsements: int = 0
+    rebuilt = await policy_state_as_of(session, endorsement.policy_id, endorsement.effective_date)
+    deltas = normalize_policy_changes(endorsement.changes, rebuilt["state"])
+    await store_policy_changes(
+        session, endorsement.policy_id, endorsement.id, endorsement.effective_date, deltas
+    )
+    return deltas
+
+
+async def record_policy_edit(session: AsyncSession, before: dict, after: dict) -> None:
+    """Log a direct edit of a policy with change history as deltas effective today"""
+    params = {"policy_id": str(after["id"])}
+    result = await session.execute(
+        text("SELECT 1 FROM policy_snapshots WHERE policy_id = :policy_id LIMIT 1"), params
+    )
+    if result.first() is None:
+        # No history yet: the first endorsement snapshots the row as edited
+        return
+
+    today = date.today()
+    deltas = []
+    for field, adapter in (*POLICY_CHANGE_FIELDS.items(), ("status", POLICY_STATUS_ADAPTER)):
+        old_value = adapter.dump_python(adapter.validate_python(before[field]), mode="json")
+        new_value = adapter.dump_python(adapter.validate_python(after[field]), mode="json")
+        if old_value != new_value:
+            kind = EndorsementChangeType.STATUS_CHANGE if field == "status" else EndorsementChangeType.MODIFIED
+            deltas.append(
+                {"field": field, "change_type": kind.value, "old_value": old_value, "new_value": new_value}
+            )
+    if str(before["entity_id"]) != str(after["entity_id"]):
+        for kind, entity_id in (
+            (EndorsementChangeType.REMOVED, before["entity_id"]),
+            (EndorsementChangeType.ADDED, after["entity_id"]),
+        ):
+            added = kind == EndorsementChangeType.ADDED
+            deltas.append(
+                {
+                    "field": COVERED_ENTITIES_FIELD,
+                    "change_type": kind.value,
+                    "old_value": None if added else str(entity_id),
+                    "new_value": str(entity_id) if added else None,
+                }
+            )
+    if not deltas:
+        return
+
+    await session.execute(DELETE_LATER_POLICY_SNAPSHOTS, {**params, "effective_date": today})
+    # The row already holds the edit
+    await store_policy_changes(session, params["policy_id"], None, today, deltas, applied=True)
+
+
+async def apply_due_policy_changes(session: AsyncSession, policy_id: str):
+    """Write deltas now in effect to the live policies row; the caller holds its row lock.
+
+    Returns the updated row with its prior image as `audit_before`, or None if
+    nothing changed. Covered-entity sets live only in the change log.
+    """
+    today = date.today()
+    result = await session.execute(
+        CLAIM_DUE_POLICY_CHANGES, {"policy_id": policy_id, "today": today}
+    )
+    fields = {row.field for row in result.fetchall()}
+    fields &= {*POLICY_CHANGE_FIELDS, "status"}
+    if not fields:
+        return None
+
+    state = (await policy_state_as_of(session, policy_id, today))["state"]
+    values = {
+        field: POLICY_CHANGE_FIELDS[field].validate_python(state[field])
+        if field in POLICY_CHANGE_FIELDS
+        else state[field]
+        for field in sorted(fields)
+    }
+    assignments = ", ".join(f"{field} = :{field}" for field in values)
+    result = await session.execute(
+        text(f"""
+            UPDATE policies SET {assignments}, updated_at = :updated_at
+            FROM (SELECT * FROM policies WHERE id = :id) AS prior
+            WHERE policies.id = prior.id
+            RETURNING policies.*, to_jsonb(prior) AS audit_before
+        """),
+        {**values, "id": policy_id, "updated_at": datetime.now(timezone.utc)},
+    )
+    return result.first()
+
+
+async def audit_applied_policy_changes(row) -> None:
+    data = dict(row._mapping)
+    before = data.pop("audit_before")
+    invalidate_dashboard_stats()
+    await RESPONSE_CACHE.invalidate(f"policies:{data['id']}")
+    await AUDIT_LOG.record(
+        AuditAction.UPDATE,
+        "policies",
+        data["id"],
+        company_id=data["company_id"],
+        before=before,
+        after=data,
+    )
+
+
+async def run_due_policy_changes() -> int:
+    """Apply future-dated deltas that have come into effect; returns policies updated"""
+    updated = 0
+    while True:
+        async with db() as session:
+            result = await session.execute(
+                text("""
+                    SELECT id FROM policies
+                    WHERE id IN (
+                        SELECT policy_id FROM endorsement_changes
+                        WHERE applied_at IS NULL AND effective_date <= :today
+                    )
+                    LIMIT 1
+                    FOR UPDATE SKIP LOCKED
+                """),
+                {"today": date.today()},
+            )
+            policy_id = result.scalar()
+            if policy_id is None:
+                return updated
+            row = await apply_due_policy_changes(session, str(policy_id))
+            await session.commit()
+        if row is not None:
+            updated += 1
+            await audit_applied_policy_changes(row)
 
 
 # API Routes
@@ -334,46 +4845,71 @@ class DashboardStats(BaseModel):
 # Authentication routes
 @api_router.post("/auth/register", response_model=User)
 async def register(user_data: UserCreate):
+    # Reject duplicates before hashing: a bcrypt job takes 100-250 ms and a
+    # BCRYPT_MAX_PENDING slot that logins need
     async with db() as session:
-        # Check if user already exists
-        result = await session.execute(
-            text("SELECT 1 FROM users WHERE email = :email"), {"email": user_data.email}
+        result = await QUERIES.execute(
+            session, "users.email_exists", {"email": user_data.email}
         )
-        if result.first():
-            raise HTTPException(status_code=400, detail="User already exists")
+        exists = result.first()
+    if exists:
+        raise HTTPException(status_code=400, detail="User already exists")
 
-        # Hash password
-        password_hash = bcrypt.hashpw(
-            user_data.password.encode("utf-8"), bcrypt.gensalt()
-        ).decode("utf-8")
+    # Hashed with no connection checked out; it would sit idle meanwhile
+    password_hash = await hash_password(user_data.password)
 
-        # Insert user
+    async with db() as session:
+        # Insert user, unless a concurrent registration took the email
         user_obj = User(**user_data.model_dump(), password_hash=password_hash)
         insert_query = """
         INSERT INTO users (id, company_id, name, email, role, password_hash, created_at, updated_at)
-        VALUES (:id, :company_id, :name, :email, :role, :password_hash, :created_at, :updated_at)
+        SELECT :id, :company_id, :name, :email, :role, :password_hash, :created_at, :updated_at
+        WHERE NOT EXISTS (SELECT 1 FROM users WHERE email = :email)
         """
-        await session.execute(text(insert_query), user_obj.model_dump())
+        result = await session.execute(text(insert_query), user_obj.model_dump())
+        if result.rowcount == 0:
+            raise HTTPException(status_code=400, detail="User already exists")
         await session.commit()
+        await AUDIT_LOG.record(
+            AuditAction.CREATE,
+            "users",
+            user_obj.id,
+            after=user_obj.model_dump(exclude={"password_hash"}),
+        )
         return user_obj
 
 
 @api_router.post("/auth/login")
 async def login(email: str = Form(...), password: str = Form(...)):
     async with db() as session:
-        result = await session.execute(
-            text("SELECT * FROM users WHERE email = :email"), {"email": email}
-        )
+        result = await QUERIES.execute(session, "users.by_email", {"email": email})
         row = result.first()
-        if not row:
-            raise HTTPException(status_code=401, detail="Invalid credentials")
-        user = dict(row._mapping)
-        password_matches = bcrypt.checkpw(
-            password.encode("utf-8"), user["password_hash"].encode("utf-8")
-        )
-        if not password_matches:
-            raise HTTPException(status_code=401, detail="Invalid credentials")
-        return {"message": "Login successful", "user": user}
+    # The connection is back in the pool before the password check
+    if not row:
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+    user = dict(row._mapping)
+    password_matches = await verify_password(password, user["password_hash"])
+    if not password_matches:
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+    user.pop("password_hash")
+    return {
+        "message": "Login successful",
+        "user": user,
+        "access_token": create_access_token(user),
+        "token_type": "bearer",
+        "expires_in": ACCESS_TOKEN_TTL_MINUTES * 60,
+    }
+
+
+@api_router.get("/auth/me", response_model=Principal)
+async def get_me(principal: Principal = Depends(get_current_principal)):
+    return principal
+
+
+@api_router.post("/auth/logout")
+async def logout(principal: Principal = Depends(get_current_principal)):
+    await revoke_principal(principal)
+    return {"message": "Logged out"}
 
 
 # Company routes
@@ -386,33 +4922,63 @@ async def create_company(company_data: CompanyBase):
         VALUES (:id, :name, :parent_company_id, :created_at, :updated_at)
         """
         await session.execute(text(insert_query), company_obj.model_dump())
+        await link_company(session, company_obj.id, company_obj.parent_company_id)
         await session.commit()
+        await RESPONSE_CACHE.invalidate("companies")
+        await AUDIT_LOG.record(
+            AuditAction.CREATE,
+            "companies",
+            company_obj.id,
+            company_id=company_obj.id,
+            after=company_obj.model_dump(),
+        )
         return company_obj
 
 
 @api_router.get("/companies", response_model=List[Company])
-async def get_companies():
-    async with db() as session:
-        result = await session.execute(text("SELECT * FROM companies"))
-        companies = [dict(row._mapping) for row in result.fetchall()]
-        return companies
+async def get_companies(request: Request, response: Response):
+    async def load():
+        async with RESPONSE_CACHE.session() as session:
+            not_modified = await check_not_modified(session, request, response, ("companies",))
+            if not_modified:
+                return not_modified
+            result = await QUERIES.execute(session, "companies.list")
+            return cache_entry(result.fetchall(), response, Company)
+
+    return await RESPONSE_CACHE.fetch(request, ("companies",), load)
 
 
 @api_router.get("/companies/{company_id}", response_model=Company)
-async def get_company(company_id: str):
-    async with db() as session:
-        result = await session.execute(
-            text("SELECT * FROM companies WHERE id = :id"), {"id": company_id}
-        )
-        row = result.first()
-        if not row:
-            raise HTTPException(status_code=404, detail="Company not found")
-        return dict(row._mapping)
+async def get_company(company_id: str, request: Request, response: Response):
+    async def load():
+        async with RESPONSE_CACHE.session() as session:
+            not_modified = await check_not_modified(session, request, response, ("companies",))
+            if not_modified:
+                return not_modified
+            result = await QUERIES.execute(session, "companies.by_id", {"id": company_id})
+            row = result.first()
+            if not row:
+                raise HTTPException(status_code=404, detail="Company not found")
+            return cache_entry([row], response, Company, one=True)
+
+    return await RESPONSE_CACHE.fetch(request, (f"companies:{company_id}",), load)
 
 
 @api_router.put("/companies/{company_id}", response_model=Company)
 async def update_company(company_id: str, company_data: CompanyBase):
     async with db() as session:
+        current = await session.execute(
+            text("SELECT * FROM companies WHERE id = :id FOR UPDATE"),
+            {"id": company_id},
+        )
+        current_row = current.first()
+        if not current_row:
+            raise HTTPException(status_code=404, detail="Company not found")
+        parent_company_id = current_row.parent_company_id
+        current_parent = str(parent_company_id) if parent_company_id else None
+        if current_parent != (company_data.parent_company_id or None):
+            await move_company(session, company_id, company_data.parent_company_id)
+
         update_query = """
         UPDATE companies
         SET name = :name,
@@ -434,18 +5000,50 @@ async def update_company(company_id: str, company_data: CompanyBase):
         await session.commit()
         if not row:
             raise HTTPException(status_code=404, detail="Company not found")
+        await RESPONSE_CACHE.invalidate("companies", f"companies:{company_id}")
+        await AUDIT_LOG.record(
+            AuditAction.UPDATE,
+            "companies",
+            company_id,
+            company_id=company_id,
+            before=current_row._mapping,
+            after=row._mapping,
+        )
         return dict(row._mapping)
 
 
 @api_router.delete("/companies/{company_id}")
 async def delete_company(company_id: str):
     async with db() as session:
+        subsidiaries = await unlink_company(session, company_id)
         result = await session.execute(
-            text("DELETE FROM companies WHERE id = :id"), {"id": company_id}
+            text("DELETE FROM companies WHERE id = :id RETURNING *"), {"id": company_id}
         )
+        deleted = result.first()
         await session.commit()
-        if result.rowcount == 0:
+        if not deleted:
             raise HTTPException(status_code=404, detail="Company not found")
+        await RESPONSE_CACHE.invalidate(
+            "companies",
+            f"companies:{company_id}",
+            *(f"companies:{subsidiary}" for subsidiary in subsidiaries),
+        )
+        await AUDIT_LOG.record(
+            AuditAction.DELETE,
+            "companies",
+            company_id,
+            company_id=company_id,
+            before=deleted._mapping,
+        )
+        for subsidiary in subsidiaries:
+            await AUDIT_LOG.record(
+                AuditAction.UPDATE,
+                "companies",
+                subsidiary,
+                company_id=subsidiary,
+                before={"parent_company_id": company_id},
+                after={"parent_company_id": None},
+            )
         return {"message": "Company deleted"}
 
 
@@ -454,12 +5052,9 @@ async def delete_company(company_id: str):
 async def create_employee(employee_data: EmployeeBase):
     async with db() as session:
         # ✅ Check for duplicate employee code (UUID-safe)
-        result = await session.execute(
-            text("""
-                SELECT 1 FROM employees
-                WHERE employee_code = :employee_code
-                AND company_id = CAST(:company_id AS uuid)
-            """),
+        result = await QUERIES.execute(
+            session,
+            "employees.code_exists",
             {
                 "employee_code": employee_data.employee_code,
                 "company_id": str(employee_data.company_id),
@@ -542,6 +5137,15 @@ async def create_employee(employee_data: EmployeeBase):
             await session.execute(insert_employee, employee_obj)
             await session.execute(insert_entity, entity_obj)
             await session.commit()
+            invalidate_dashboard_stats()
+            await invalidate_entity_cache("employees", None, employee_data.company_id)
+            await AUDIT_LOG.record(
+                AuditAction.CREATE,
+                "employees",
+                employee_obj["id"],
+                company_id=employee_data.company_id,
+                after=employee_obj,
+            )
             return employee_obj
         except Exception as e:
             await session.rollback()
@@ -552,60 +5156,72 @@ async def create_employee(employee_data: EmployeeBase):
             )
 
 
-@api_router.get("/employees", response_model=List[Employee])
-async def get_employees(company_id: Optional[str] = Query(None)):
-    async with db() as session:
-        # ✅ Build query dynamically based on filter
-        if company_id:
-            query = text("""
-                SELECT * FROM employees 
-                WHERE company_id = CAST(:company_id AS uuid)
-                ORDER BY created_at DESC
-            """)
-            result = await session.execute(query, {"company_id": str(company_id)})
-        else:
-            result = await session.execute(
-                text("SELECT * FROM employees ORDER BY created_at DESC")
-            )
+@api_router.post("/employees/bulk", response_model=BulkImportReport)
+async def bulk_create_employees(request: Request, atomic: bool = Query(False)):
+    rows = await read_bulk_rows(request)
+    return await bulk_import("employees", rows, atomic)
 
-        rows = result.fetchall()
-        employees = []
 
-        for row in rows:
-            data = dict(row._mapping)
+@api_router.get("/employees", response_model=List[Employee])
+async def get_employees(
+    request: Request,
+    response: Response,
+    company_id: Optional[str] = Query(None),
+    include_descendants: bool = Query(False),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None),
+):
+    async with read_db() as session:
+        not_modified = await check_not_modified(
+            session, request, response, scoped_tables(("employees",), include_descendants)
+        )
+        if not_modified:
+            return not_modified
+        # ✅ Build query dynamically based on filter
+        query = "SELECT * FROM employees WHERE 1=1"
+        params = {}
 
-            # ✅ Convert UUIDs to strings for JSON serialization
-            for key, value in data.items():
-                if isinstance(value, uuid.UUID):
-                    data[key] = str(value)
+        if company_id:
+            query += f" AND {company_scope(include_descendants)}"
+            params["company_id"] = str(company_id)
 
-                elif isinstance(value, datetime):
-                    # Convert datetime to ISO format with timezone
-                    data[key] = value.isoformat()
+        query = apply_keyset_pagination(
+            query, params, limit, cursor, default_order="ORDER BY created_at DESC"
+        )
+        result = await QUERIES.execute(session, "employees.list", params, sql=query)
 
-                elif isinstance(value, str) and key in ["created_at", "updated_at"]:
-                    # Handle PostgreSQL timestamp strings (e.g., "2025-11-04 07:40:51.405604+00")
-                    val = value.replace(" ", "T").replace("+00", "+00:00")
-                    data[key] = val
+        rows = paginate_rows(result.fetchall(), limit, response)
+        if not rows:
+            raise HTTPException(status_code=404, detail="No employees found")
 
-            employees.append(data)
+        return rows_response(rows, response)
 
-        if not employees:
-            raise HTTPException(status_code=404, detail="No employees found")
 
-        return employees
+@api_router.get("/employees/export")
+async def export_employees(
+    format: ExportFormat = Query(ExportFormat.NDJSON),
+    company_id: Optional[str] = Query(None),
+    include_descendants: bool = Query(False),
+    status: Optional[EntityStatus] = Query(None),
+):
+    query, params = entity_export_query("employees", company_id, status, include_descendants)
+    return export_response(query, params, format, "employees")
 
 
 @api_router.get("/employees/{employee_id}", response_model=Employee)
-async def get_employee(employee_id: str):
-    async with db() as session:
-        result = await session.execute(
-            text("SELECT * FROM employees WHERE id = :id"), {"id": employee_id}
-        )
-        row = result.first()
-        if not row:
-            raise HTTPException(status_code=404, detail="Employee not found")
-        return dict(row._mapping)
+async def get_employee(employee_id: str, request: Request, response: Response):
+    async def load():
+        async with RESPONSE_CACHE.session() as session:
+            not_modified = await check_not_modified(session, request, response, ("employees",))
+            if not_modified:
+                return not_modified
+            result = await QUERIES.execute(session, "employees.by_id", {"id": employee_id})
+            row = result.first()
+            if not row:
+                raise HTTPException(status_code=404, detail="Employee not found")
+            return cache_entry([row], response, Employee, one=True)
+
+    return await RESPONSE_CACHE.fetch(request, (f"employees:{employee_id}",), load)
 
 
 @api_router.put("/employees/{employee_id}", response_model=Employee)
@@ -624,8 +5240,9 @@ async def update_employee(employee_id: str, employee_data: EmployeeBase):
                     department = :department,
                     position = :position,
                     updated_at = :updated_at
-                WHERE id = CAST(:id AS uuid)
-                RETURNING *
+                FROM (SELECT * FROM employees WHERE id = CAST(:id AS uuid) FOR UPDATE) AS prior
+                WHERE employees.id = prior.id
+                RETURNING employees.*, to_jsonb(prior) AS audit_before
             """)
 
             result = await session.execute(
@@ -658,9 +5275,10 @@ async def update_employee(employee_id: str, employee_data: EmployeeBase):
                     updated_at = :updated_at
                 WHERE entity_id = CAST(:eid AS uuid)
                 AND type = :type
+                RETURNING company_id
             """)
 
-            await session.execute(
+            entity_result = await session.execute(
                 update_entity_query,
                 {
                     "desc": f"Employee: {employee_data.name}",
@@ -670,16 +5288,27 @@ async def update_employee(employee_id: str, employee_data: EmployeeBase):
                 },
             )
 
+            entity_company_id = entity_result.scalar()
             await session.commit()
+            await invalidate_entity_cache("employees", employee_id, entity_company_id)
 
             # ✅ Normalize response data
             data = dict(row._mapping)
+            before = data.pop("audit_before")
             for key, value in data.items():
                 if isinstance(value, uuid.UUID):
                     data[key] = str(value)
                 elif isinstance(value, datetime):
                     data[key] = value.isoformat()
 
+            await AUDIT_LOG.record(
+                AuditAction.UPDATE,
+                "employees",
+                employee_id,
+                company_id=data["company_id"],
+                before=before,
+                after=data,
+            )
             return data
 
         except Exception as e:
@@ -692,16 +5321,29 @@ async def update_employee(employee_id: str, employee_data: EmployeeBase):
 async def delete_employee(employee_id: str):
     async with db() as session:
         # Delete related entity record first
-        await session.execute(
-            text("DELETE FROM entities WHERE entity_id = :eid AND type = :type"),
+        entity_result = await session.execute(
+            text(
+                "DELETE FROM entities WHERE entity_id = :eid AND type = :type RETURNING company_id"
+            ),
             {"eid": employee_id, "type": EntityType.EMPLOYEE.value},
         )
         result = await session.execute(
-            text("DELETE FROM employees WHERE id = :id"), {"id": employee_id}
+            text("DELETE FROM employees WHERE id = :id RETURNING *"), {"id": employee_id}
         )
+        deleted = result.first()
+        entity_company_id = entity_result.scalar()
         await session.commit()
-        if result.rowcount == 0:
+        invalidate_dashboard_stats()
+        await invalidate_entity_cache("employees", employee_id, entity_company_id)
+        if not deleted:
             raise HTTPException(status_code=404, detail="Employee not found")
+        await AUDIT_LOG.record(
+            AuditAction.DELETE,
+            "employees",
+            employee_id,
+            company_id=deleted.company_id,
+            before=deleted._mapping,
+        )
         return {"message": "Employee deleted"}
 
 
@@ -709,10 +5351,9 @@ async def delete_employee(employee_id: str):
 @api_router.post("/students", response_model=Student)
 async def create_student(student_data: StudentBase):
     async with db() as session:
-        result = await session.execute(
-            text(
-                "SELECT 1 FROM students WHERE student_id = :student_id AND company_id = :company_id"
-            ),
+        result = await QUERIES.execute(
+            session,
+            "students.student_id_exists",
             {
                 "student_id": student_data.student_id,
                 "company_id": student_data.company_id,
@@ -741,59 +5382,82 @@ async def create_student(student_data: StudentBase):
         """
         await session.execute(text(insert_entity), entity_obj.model_dump())
         await session.commit()
+        invalidate_dashboard_stats()
+        await invalidate_entity_cache("students", None, student_data.company_id)
+        await AUDIT_LOG.record(
+            AuditAction.CREATE,
+            "students",
+            student_obj.id,
+            company_id=student_data.company_id,
+            after=student_obj.model_dump(),
+        )
         return student_obj
 
 
+@api_router.post("/students/bulk", response_model=BulkImportReport)
+async def bulk_create_students(request: Request, atomic: bool = Query(False)):
+    rows = await read_bulk_rows(request)
+    return await bulk_import("students", rows, atomic)
+
+
 @api_router.get("/students", response_model=List[Student])
-async def get_students(company_id: Optional[str] = Query(None)):
-    async with db() as session:
+async def get_students(
+    request: Request,
+    response: Response,
+    company_id: Optional[str] = Query(None),
+    include_descendants: bool = Query(False),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None),
+):
+    async with read_db() as session:
+        not_modified = await check_not_modified(
+            session, request, response, scoped_tables(("students",), include_descendants)
+        )
+        if not_modified:
+            return not_modified
         # ✅ Fetch students based on company_id (if provided)
-        if company_id:
-            query = text("""
-                SELECT * FROM students 
-                WHERE company_id = CAST(:company_id AS uuid)
-                ORDER BY created_at DESC
-            """)
-            result = await session.execute(query, {"company_id": str(company_id)})
-        else:
-            result = await session.execute(text("SELECT * FROM students ORDER BY created_at DESC"))
+        query = "SELECT * FROM students WHERE 1=1"
+        params = {}
 
-        rows = result.fetchall()
-        students = []
+        if company_id:
+            query += f" AND {company_scope(include_descendants)}"
+            params["company_id"] = str(company_id)
 
-        for row in rows:
-            data = dict(row._mapping)
+        query = apply_keyset_pagination(
+            query, params, limit, cursor, default_order="ORDER BY created_at DESC"
+        )
+        result = await QUERIES.execute(session, "students.list", params, sql=query)
 
-            # ✅ Normalize UUIDs and timestamps
-            for key, value in data.items():
-                if isinstance(value, uuid.UUID):
-                    data[key] = str(value)
-                elif isinstance(value, datetime):
-                    data[key] = value.isoformat()
-                elif isinstance(value, str) and key in ["created_at", "updated_at"]:
-                    # Convert PostgreSQL string timestamps to valid ISO 8601 format
-                    if " " in value:
-                        value = value.replace(" ", "T")
-                    if value.endswith("+00"):
-                        value = value.replace("+00", "+00:00")
-                    data[key] = value
+        rows = paginate_rows(result.fetchall(), limit, response)
+        return rows_response(rows, response)
 
-            students.append(data)
 
-        return students
 
+@api_router.get("/students/export")
+async def export_students(
+    format: ExportFormat = Query(ExportFormat.NDJSON),
+    company_id: Optional[str] = Query(None),
+    include_descendants: bool = Query(False),
+    status: Optional[EntityStatus] = Query(None),
+):
+    query, params = entity_export_query("students", company_id, status, include_descendants)
+    return export_response(query, params, format, "students")
 
 
 @api_router.get("/students/{student_id}", response_model=Student)
-async def get_student(student_id: str):
-    async with db() as session:
-        result = await session.execute(
-            text("SELECT * FROM students WHERE id = :id"), {"id": student_id}
-        )
-        row = result.first()
-        if not row:
-            raise HTTPException(status_code=404, detail="Student not found")
-        return dict(row._mapping)
+async def get_student(student_id: str, request: Request, response: Response):
+    async def load():
+        async with RESPONSE_CACHE.session() as session:
+            not_modified = await check_not_modified(session, request, response, ("students",))
+            if not_modified:
+                return not_modified
+            result = await QUERIES.execute(session, "students.by_id", {"id": student_id})
+            row = result.first()
+            if not row:
+                raise HTTPException(status_code=404, detail="Student not found")
+            return cache_entry([row], response, Student, one=True)
+
+    return await RESPONSE_CACHE.fetch(request, (f"students:{student_id}",), load)
 
 
 @api_router.put("/students/{student_id}", response_model=Student)
@@ -812,8 +5476,9 @@ async def update_student(student_id: str, student_data: StudentBase):
                     course = :course,
                     year_of_study = :year_of_study,
                     updated_at = :updated_at
-                WHERE id = CAST(:id AS uuid)
-                RETURNING *
+                FROM (SELECT * FROM students WHERE id = CAST(:id AS uuid) FOR UPDATE) AS prior
+                WHERE students.id = prior.id
+                RETURNING students.*, to_jsonb(prior) AS audit_before
             """)
 
             result = await session.execute(
@@ -846,9 +5511,10 @@ async def update_student(student_id: str, student_data: StudentBase):
                     updated_at = :updated_at
                 WHERE entity_id = CAST(:eid AS uuid)
                 AND type = :type
+                RETURNING company_id
             """)
 
-            await session.execute(
+            entity_result = await session.execute(
                 update_entity_query,
                 {
                     "desc": f"Student: {student_data.name}",
@@ -858,16 +5524,27 @@ async def update_student(student_id: str, student_data: StudentBase):
                 },
             )
 
+            entity_company_id = entity_result.scalar()
             await session.commit()
+            await invalidate_entity_cache("students", student_id, entity_company_id)
 
             # ✅ Normalize response data
             data = dict(row._mapping)
+            before = data.pop("audit_before")
             for key, value in data.items():
                 if isinstance(value, uuid.UUID):
                     data[key] = str(value)
                 elif isinstance(value, datetime):
                     data[key] = value.isoformat()
 
+            await AUDIT_LOG.record(
+                AuditAction.UPDATE,
+                "students",
+                student_id,
+                company_id=data["company_id"],
+                before=before,
+                after=data,
+            )
             return data
 
         except Exception as e:
@@ -879,16 +5556,29 @@ async def update_student(student_id: str, student_data: StudentBase):
 @api_router.delete("/students/{student_id}")
 async def delete_student(student_id: str):
     async with db() as session:
-        await session.execute(
-            text("DELETE FROM entities WHERE entity_id = :eid AND type = :type"),
+        entity_result = await session.execute(
+            text(
+                "DELETE FROM entities WHERE entity_id = :eid AND type = :type RETURNING company_id"
+            ),
             {"eid": student_id, "type": EntityType.STUDENT.value},
         )
         result = await session.execute(
-            text("DELETE FROM students WHERE id = :id"), {"id": student_id}
+            text("DELETE FROM students WHERE id = :id RETURNING *"), {"id": student_id}
         )
+        deleted = result.first()
+        entity_company_id = entity_result.scalar()
         await session.commit()
-        if result.rowcount == 0:
+        invalidate_dashboard_stats()
+        await invalidate_entity_cache("students", student_id, entity_company_id)
+        if not deleted:
             raise HTTPException(status_code=404, detail="Student not found")
+        await AUDIT_LOG.record(
+            AuditAction.DELETE,
+            "students",
+            student_id,
+            company_id=deleted.company_id,
+            before=deleted._mapping,
+        )
         return {"message": "Student deleted"}
 
 
@@ -896,9 +5586,8 @@ async def delete_student(student_id: str):
 async def create_vessel(vessel_data: VesselBase):
     async with db() as session:
         # 🟢 Check for duplicate IMO number
-        result = await session.execute(
-            text("SELECT 1 FROM vessels WHERE imo_number = :imo_number"),
-            {"imo_number": vessel_data.imo_number},
+        result = await QUERIES.execute(
+            session, "vessels.imo_exists", {"imo_number": vessel_data.imo_number}
         )
         if result.first():
             raise HTTPException(status_code=400, detail="IMO number already exists")
@@ -963,6 +5652,15 @@ async def create_vessel(vessel_data: VesselBase):
             await session.execute(insert_vessel, vessel_obj)
             await session.execute(insert_entity, entity_obj)
             await session.commit()
+            invalidate_dashboard_stats()
+            await invalidate_entity_cache("vessels", None, vessel_data.company_id)
+            await AUDIT_LOG.record(
+                AuditAction.CREATE,
+                "vessels",
+                vessel_obj["id"],
+                company_id=vessel_data.company_id,
+                after=vessel_obj,
+            )
 
             return vessel_obj
 
@@ -974,42 +5672,65 @@ async def create_vessel(vessel_data: VesselBase):
             )
 
 
+@api_router.post("/vessels/bulk", response_model=BulkImportReport)
+async def bulk_create_vessels(request: Request, atomic: bool = Query(False)):
+    rows = await read_bulk_rows(request)
+    return await bulk_import("vessels", rows, atomic)
+
+
 @api_router.get("/vessels", response_model=List[Vessel])
-async def get_vessels(company_id: Optional[str] = Query(None)):
-    async with db() as session:
-        query = "SELECT * FROM vessels"
+async def get_vessels(
+    request: Request,
+    response: Response,
+    company_id: Optional[str] = Query(None),
+    include_descendants: bool = Query(False),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None),
+):
+    async with read_db() as session:
+        not_modified = await check_not_modified(
+            session, request, response, scoped_tables(("vessels",), include_descendants)
+        )
+        if not_modified:
+            return not_modified
+        query = "SELECT * FROM vessels WHERE 1=1"
         params = {}
 
         if company_id:
-            query += " WHERE company_id = :company_id"
+            query += f" AND {company_scope(include_descendants)}"
             params["company_id"] = company_id
 
-        result = await session.execute(text(query), params)
-        rows = result.fetchall()
+        query = apply_keyset_pagination(query, params, limit, cursor)
+        result = await QUERIES.execute(session, "vessels.list", params, sql=query)
+        rows = paginate_rows(result.fetchall(), limit, response)
+        return rows_response(rows, response)
 
-        vessels = []
-        for row in rows:
-            data = dict(row._mapping)
-            # 🧠 Convert UUIDs to strings so Pydantic doesn’t break
-            if isinstance(data.get("id"), uuid.UUID):
-                data["id"] = str(data["id"])
-            if isinstance(data.get("company_id"), uuid.UUID):
-                data["company_id"] = str(data["company_id"])
-            vessels.append(data)
 
-        return vessels
+@api_router.get("/vessels/export")
+async def export_vessels(
+    format: ExportFormat = Query(ExportFormat.NDJSON),
+    company_id: Optional[str] = Query(None),
+    include_descendants: bool = Query(False),
+    status: Optional[EntityStatus] = Query(None),
+):
+    query, params = entity_export_query("vessels", company_id, status, include_descendants)
+    return export_response(query, params, format, "vessels")
 
 
 @api_router.get("/vessels/{vessel_id}", response_model=Vessel)
-async def get_vessel(vessel_id: str):
-    async with db() as session:
-        result = await session.execute(
-            text("SELECT * FROM vessels WHERE id = :id"), {"id": vessel_id}
-        )
-        row = result.first()
-        if not row:
-            raise HTTPException(status_code=404, detail="Vessel not found")
-        return dict(row._mapping)
+async def get_vessel(vessel_id: str, request: Request, response: Response):
+    async def load():
+        async with RESPONSE_CACHE.session() as session:
+            not_modified = await check_not_modified(session, request, response, ("vessels",))
+            if not_modified:
+                return not_modified
+            result = await QUERIES.execute(session, "vessels.by_id", {"id": vessel_id})
+            row = result.first()
+            if not row:
+                raise HTTPException(status_code=404, detail="Vessel not found")
+            return cache_entry([row], response, Vessel, one=True)
+
+    return await RESPONSE_CACHE.fetch(request, (f"vessels:{vessel_id}",), load)
 
 
 @api_router.put("/vessels/{vessel_id}", response_model=Vessel)
@@ -1028,8 +5749,9 @@ async def update_vessel(vessel_id: str, vessel_data: VesselBase):
                     vessel_type = :vessel_type,
                     flag = :flag,
                     updated_at = :updated_at
-                WHERE id = CAST(:id AS uuid)
-                RETURNING *
+                FROM (SELECT * FROM vessels WHERE id = CAST(:id AS uuid) FOR UPDATE) AS prior
+                WHERE vessels.id = prior.id
+                RETURNING vessels.*, to_jsonb(prior) AS audit_before
             """)
 
             result = await session.execute(
@@ -1062,9 +5784,10 @@ async def update_vessel(vessel_id: str, vessel_data: VesselBase):
                     updated_at = :updated_at
                 WHERE entity_id = CAST(:eid AS uuid)
                 AND type = :type
+                RETURNING company_id
             """)
 
-            await session.execute(
+            entity_result = await session.execute(
                 update_entity_query,
                 {
                     "desc": f"Vessel: {vessel_data.vessel_name}",
@@ -1074,16 +5797,27 @@ async def update_vessel(vessel_id: str, vessel_data: VesselBase):
                 },
             )
 
+            entity_company_id = entity_result.scalar()
             await session.commit()
+            await invalidate_entity_cache("vessels", vessel_id, entity_company_id)
 
             # ✅ Normalize response data
             data = dict(row._mapping)
+            before = data.pop("audit_before")
             for key, value in data.items():
                 if isinstance(value, uuid.UUID):
                     data[key] = str(value)
                 elif isinstance(value, datetime):
                     data[key] = value.isoformat()
 
+            await AUDIT_LOG.record(
+                AuditAction.UPDATE,
+                "vessels",
+                vessel_id,
+                company_id=data["company_id"],
+                before=before,
+                after=data,
+            )
             return data
 
         except Exception as e:
@@ -1096,16 +5830,29 @@ async def update_vessel(vessel_id: str, vessel_data: VesselBase):
 @api_router.delete("/vessels/{vessel_id}")
 async def delete_vessel(vessel_id: str):
     async with db() as session:
-        await session.execute(
-            text("DELETE FROM entities WHERE entity_id = :eid AND type = :type"),
+        entity_result = await session.execute(
+            text(
+                "DELETE FROM entities WHERE entity_id = :eid AND type = :type RETURNING company_id"
+            ),
             {"eid": vessel_id, "type": EntityType.SHIP.value},
         )
         result = await session.execute(
-            text("DELETE FROM vessels WHERE id = :id"), {"id": vessel_id}
+            text("DELETE FROM vessels WHERE id = :id RETURNING *"), {"id": vessel_id}
         )
+        deleted = result.first()
+        entity_company_id = entity_result.scalar()
         await session.commit()
-        if result.rowcount == 0:
+        invalidate_dashboard_stats()
+        await invalidate_entity_cache("vessels", vessel_id, entity_company_id)
+        if not deleted:
             raise HTTPException(status_code=404, detail="Vessel not found")
+        await AUDIT_LOG.record(
+            AuditAction.DELETE,
+            "vessels",
+            vessel_id,
+            company_id=deleted.company_id,
+            before=deleted._mapping,
+        )
         return {"message": "Vessel deleted"}
 
 
@@ -1113,10 +5860,9 @@ async def delete_vessel(vessel_id: str):
 @api_router.post("/vehicles", response_model=Vehicle)
 async def create_vehicle(vehicle_data: VehicleBase):
     async with db() as session:
-        result = await session.execute(
-            text(
-                "SELECT 1 FROM vehicles WHERE registration_number = :registration_number"
-            ),
+        result = await QUERIES.execute(
+            session,
+            "vehicles.registration_exists",
             {"registration_number": vehicle_data.registration_number},
         )
         if result.first():
@@ -1144,59 +5890,82 @@ async def create_vehicle(vehicle_data: VehicleBase):
         """
         await session.execute(text(insert_entity), entity_obj.model_dump())
         await session.commit()
+        invalidate_dashboard_stats()
+        await invalidate_entity_cache("vehicles", None, vehicle_data.company_id)
+        await AUDIT_LOG.record(
+            AuditAction.CREATE,
+            "vehicles",
+            vehicle_obj.id,
+            company_id=vehicle_data.company_id,
+            after=vehicle_obj.model_dump(),
+        )
         return vehicle_obj
 
 
+@api_router.post("/vehicles/bulk", response_model=BulkImportReport)
+async def bulk_create_vehicles(request: Request, atomic: bool = Query(False)):
+    rows = await read_bulk_rows(request)
+    return await bulk_import("vehicles", rows, atomic)
+
+
 @api_router.get("/vehicles", response_model=List[Vehicle])
-async def get_vehicles(company_id: Optional[str] = Query(None)):
-    async with db() as session:
+async def get_vehicles(
+    request: Request,
+    response: Response,
+    company_id: Optional[str] = Query(None),
+    include_descendants: bool = Query(False),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None),
+):
+    async with read_db() as session:
+        not_modified = await check_not_modified(
+            session, request, response, scoped_tables(("vehicles",), include_descendants)
+        )
+        if not_modified:
+            return not_modified
         # ✅ Build query dynamically
-        if company_id:
-            query = text("""
-                SELECT * FROM vehicles
-                WHERE company_id = CAST(:company_id AS uuid)
-                ORDER BY created_at DESC
-            """)
-            result = await session.execute(query, {"company_id": str(company_id)})
-        else:
-            result = await session.execute(text("SELECT * FROM vehicles ORDER BY created_at DESC"))
+        query = "SELECT * FROM vehicles WHERE 1=1"
+        params = {}
 
-        rows = result.fetchall()
-        vehicles = []
+        if company_id:
+            query += f" AND {company_scope(include_descendants)}"
+            params["company_id"] = str(company_id)
 
-        # ✅ Normalize UUID and datetime fields
-        for row in rows:
-            data = dict(row._mapping)
+        query = apply_keyset_pagination(
+            query, params, limit, cursor, default_order="ORDER BY created_at DESC"
+        )
+        result = await QUERIES.execute(session, "vehicles.list", params, sql=query)
 
-            for key, value in data.items():
-                if isinstance(value, uuid.UUID):
-                    data[key] = str(value)
-                elif isinstance(value, datetime):
-                    data[key] = value.isoformat()
-                elif isinstance(value, str) and key in ["created_at", "updated_at"]:
-                    # Fix non-ISO PostgreSQL timestamps
-                    if " " in value:
-                        value = value.replace(" ", "T")
-                    if value.endswith("+00"):
-                        value = value.replace("+00", "+00:00")
-                    data[key] = value
+        rows = paginate_rows(result.fetchall(), limit, response)
+        return rows_response(rows, response)
 
-            vehicles.append(data)
 
-        return vehicles
 
+@api_router.get("/vehicles/export")
+async def export_vehicles(
+    format: ExportFormat = Query(ExportFormat.NDJSON),
+    company_id: Optional[str] = Query(None),
+    include_descendants: bool = Query(False),
+    status: Optional[EntityStatus] = Query(None),
+):
+    query, params = entity_export_query("vehicles", company_id, status, include_descendants)
+    return export_response(query, params, format, "vehicles")
 
 
 @api_router.get("/vehicles/{vehicle_id}", response_model=Vehicle)
-async def get_vehicle(vehicle_id: str):
-    async with db() as session:
-        result = await session.execute(
-            text("SELECT * FROM vehicles WHERE id = :id"), {"id": vehicle_id}
-        )
-        row = result.first()
-        if not row:
-            raise HTTPException(status_code=404, detail="Vehicle not found")
-        return dict(row._mapping)
+async def get_vehicle(vehicle_id: str, request: Request, response: Response):
+    async def load():
+        async with RESPONSE_CACHE.session() as session:
+            not_modified = await check_not_modified(session, request, response, ("vehicles",))
+            if not_modified:
+                return not_modified
+            result = await QUERIES.execute(session, "vehicles.by_id", {"id": vehicle_id})
+            row = result.first()
+            if not row:
+                raise HTTPException(status_code=404, detail="Vehicle not found")
+            return cache_entry([row], response, Vehicle, one=True)
+
+    return await RESPONSE_CACHE.fetch(request, (f"vehicles:{vehicle_id}",), load)
 
 
 @api_router.put("/vehicles/{vehicle_id}", response_model=Vehicle)
@@ -1215,8 +5984,9 @@ async def update_vehicle(vehicle_id: str, vehicle_data: VehicleBase):
                     year = :year,
                     status = :status,
                     updated_at = :updated_at
-                WHERE id = CAST(:id AS uuid)
-                RETURNING *
+                FROM (SELECT * FROM vehicles WHERE id = CAST(:id AS uuid) FOR UPDATE) AS prior
+                WHERE vehicles.id = prior.id
+                RETURNING vehicles.*, to_jsonb(prior) AS audit_before
             """)
 
             result = await session.execute(
@@ -1249,9 +6019,10 @@ async def update_vehicle(vehicle_id: str, vehicle_data: VehicleBase):
                     updated_at = :updated_at
                 WHERE entity_id = CAST(:eid AS uuid)
                 AND type = :type
+                RETURNING company_id
             """)
 
-            await session.execute(
+            entity_result = await session.execute(
                 update_entity_query,
                 {
                     "desc": f"Vehicle: {vehicle_data.make} {vehicle_data.model}",
@@ -1261,16 +6032,27 @@ async def update_vehicle(vehicle_id: str, vehicle_data: VehicleBase):
                 },
             )
 
+            entity_company_id = entity_result.scalar()
             await session.commit()
+            await invalidate_entity_cache("vehicles", vehicle_id, entity_company_id)
 
             # ✅ Normalize response data
             data = dict(row._mapping)
+            before = data.pop("audit_before")
             for key, value in data.items():
                 if isinstance(value, uuid.UUID):
                     data[key] = str(value)
                 elif isinstance(value, datetime):
                     data[key] = value.isoformat()
 
+            await AUDIT_LOG.record(
+                AuditAction.UPDATE,
+                "vehicles",
+                vehicle_id,
+                company_id=data["company_id"],
+                before=before,
+                after=data,
+            )
             return data
 
         except Exception as e:
@@ -1283,55 +6065,84 @@ async def update_vehicle(vehicle_id: str, vehicle_data: VehicleBase):
 @api_router.delete("/vehicles/{vehicle_id}")
 async def delete_vehicle(vehicle_id: str):
     async with db() as session:
-        await session.execute(
-            text("DELETE FROM entities WHERE entity_id = :eid AND type = :type"),
+        entity_result = await session.execute(
+            text(
+                "DELETE FROM entities WHERE entity_id = :eid AND type = :type RETURNING company_id"
+            ),
             {"eid": vehicle_id, "type": EntityType.VEHICLE.value},
         )
         result = await session.execute(
-            text("DELETE FROM vehicles WHERE id = :id"), {"id": vehicle_id}
+            text("DELETE FROM vehicles WHERE id = :id RETURNING *"), {"id": vehicle_id}
         )
+        deleted = result.first()
+        entity_company_id = entity_result.scalar()
         await session.commit()
-        if result.rowcount == 0:
+        invalidate_dashboard_stats()
+        await invalidate_entity_cache("vehicles", vehicle_id, entity_company_id)
+        if not deleted:
             raise HTTPException(status_code=404, detail="Vehicle not found")
+        await AUDIT_LOG.record(
+            AuditAction.DELETE,
+            "vehicles",
+            vehicle_id,
+            company_id=deleted.company_id,
+            before=deleted._mapping,
+        )
         return {"message": "Vehicle deleted"}
 
 
 # Entity routes
 @api_router.get("/entities", response_model=List[Entity])
 async def get_entities(
+    request: Request,
+    response: Response,
     company_id: Optional[str] = Query(None),
+    include_descendants: bool = Query(False),
     entity_type: Optional[EntityType] = Query(None),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None),
+    expand: Optional[ExpandOption] = Query(None),
 ):
-    async with db() as session:
-        # ✅ Base query
-        query = "SELECT * FROM entities WHERE 1=1"
-        params = {}
-
-        # ✅ Optional filters
-        if company_id:
-            query += " AND company_id = CAST(:company_id AS uuid)"
-            params["company_id"] = company_id
-        if entity_type:
-            query += " AND type = :type"
-            params["type"] = (
-                entity_type.value if isinstance(entity_type, Enum) else entity_type
-            )
+    namespaces = (f"entities:{company_id}",) if company_id else ("entities",)
+    if company_id and include_descendants:
+        # Any company in the group may change, as may the group itself
+        namespaces = ("entities", "companies")
+    # Expanded responses also change with the subtype tables
+    tables = ("entities", *ENTITY_TABLES.values()) if expand else ("entities",)
+    tables = scoped_tables(tables, include_descendants)
+
+    async def load():
+        async with RESPONSE_CACHE.session() as session:
+            not_modified = await check_not_modified(session, request, response, tables)
+            if not_modified:
+                return not_modified
+            # ✅ Base query
+            query = "SELECT * FROM entities WHERE 1=1"
+            params = {}
+
+            # ✅ Optional filters
+            if company_id:
+                query += f" AND {company_scope(include_descendants)}"
+                params["company_id"] = company_id
+            if entity_type:
+                query += " AND type = :type"
+                params["type"] = (
+                    entity_type.value if isinstance(entity_type, Enum) else entity_type
+                )
 
-        # ✅ Execute query
-        result = await session.execute(text(query), params)
-        rows = result.fetchall()
+            # ✅ Execute query
+            query = apply_keyset_pagination(query, params, limit, cursor)
+            result = await QUERIES.execute(session, "entities.list", params, sql=query)
+            rows = paginate_rows(result.fetchall(), limit, response)
+            if not expand:
+                return cache_entry(rows, response, Entity)
 
-        entities = []
-        for row in rows:
-            data = dict(row._mapping)
-            for key, value in data.items():
-                if isinstance(value, uuid.UUID):
-                    data[key] = str(value)
-                elif isinstance(value, datetime):
-                    data[key] = value.isoformat()
-            entities.append(data)
+            # ✅ One query per entity type instead of one request per row
+            entities = row_serializer(result.keys()).to_dicts(rows) if rows else []
+            await attach_entity_details(session, entities)
+            return expanded_body(entities), dict(response.headers)
 
-        return entities
+    return await RESPONSE_CACHE.fetch(request, namespaces, load)
 
 
 
@@ -1340,11 +6151,9 @@ async def get_entities(
 async def create_policy(policy_data: InsurancePolicyBase):
     async with db() as session:
         # ✅ Check duplicate policy number (optional: per entity)
-        result = await session.execute(
-            text("""
-                SELECT 1 FROM policies 
-                WHERE policy_number = :policy_number AND entity_id = :entity_id
-            """),
+        result = await QUERIES.execute(
+            session,
+            "policies.number_exists_for_entity",
             {
                 "policy_number": policy_data.policy_number,
                 "entity_id": policy_data.entity_id,
@@ -1396,18 +6205,35 @@ async def create_policy(policy_data: InsurancePolicyBase):
         result = await session.execute(text(insert_query), policy_obj)
         row = result.first()
         await session.commit()
+        invalidate_dashboard_stats()
+        await AUDIT_LOG.record(
+            AuditAction.CREATE, "policies", row.id, company_id=row.company_id, after=row._mapping
+        )
 
         return dict(row._mapping)
 
 
 @api_router.get("/policies", response_model=List[InsurancePolicy])
 async def get_policies(
+    request: Request,
+    response: Response,
     company_id: Optional[str] = Query(None),
+    include_descendants: bool = Query(False),
     entity_id: Optional[str] = Query(None),
     status: Optional[PolicyStatus] = Query(None),
     insurance_type: Optional[InsuranceType] = Query(None),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None),
+    expand: Optional[ExpandOption] = Query(None),
 ):
-    async with db() as session:
+    tables = scoped_tables(("policies",), include_descendants)
+    if expand:
+        tables += ("entities", *ENTITY_TABLES.values())
+
+    async with read_db() as session:
+        not_modified = await check_not_modified(session, request, response, tables)
+        if not_modified:
+            return not_modified
         query = """
         SELECT * FROM policies
         WHERE 1=1
@@ -1415,7 +6241,7 @@ async def get_policies(
         params = {}
 
         if company_id:
-            query += " AND company_id = CAST(:company_id AS uuid)"
+            query += f" AND {company_scope(include_descendants)}"
             params["company_id"] = company_id
 
         if entity_id:
@@ -1435,52 +6261,236 @@ async def get_policies(
             )
 
         # Execute query
-        result = await session.execute(text(query), params)
-        rows = result.fetchall()
-
-        # Normalize UUIDs and datetimes
-        policies = []
-        for row in rows:
-            record = dict(row._mapping)
-            for key, value in record.items():
-                if isinstance(value, uuid.UUID):
-                    record[key] = str(value)
-                elif isinstance(value, datetime):
-                    record[key] = value.isoformat()
-            policies.append(record)
+        query = apply_keyset_pagination(query, params, limit, cursor)
+        result = await QUERIES.execute(session, "policies.list", params, sql=query)
+        rows = paginate_rows(result.fetchall(), limit, response)
+        if not expand:
+            return rows_response(rows, response)
+
+        # ✅ Entities in one query, then one query per entity type
+        policies = row_serializer(result.keys()).to_dicts(rows) if rows else []
+        await attach_policy_entities(session, policies)
+        return Response(
+            expanded_body(policies), media_type="application/json", headers=dict(response.headers)
+        )
 
-        return policies
 
 
+@api_router.post("/policies/bulk/status", response_model=PolicyBulkResult)
+async def bulk_update_policy_status(update: PolicyBulkStatusUpdate):
+    params = {"status": update.status.value, "updated_at": datetime.now(timezone.utc)}
+    where, failures = policy_selection_sql(update, params)
 
-@api_router.get("/policies/{policy_id}", response_model=InsurancePolicy)
-async def get_policy(policy_id: str):
     async with db() as session:
+        # ✅ One set-based UPDATE for the whole selection
         result = await session.execute(
-            text("SELECT * FROM policies WHERE id = :id"), {"id": policy_id}
+            text(f"""
+                UPDATE policies SET status = :status, updated_at = :updated_at
+                FROM (SELECT id, status FROM policies WHERE {where} FOR UPDATE) AS prior
+                WHERE policies.id = prior.id
+                RETURNING policies.id, policies.company_id, prior.status AS prior_status
+            """),
+            params,
         )
-        row = result.first()
-        if not row:
-            raise HTTPException(status_code=404, detail="Policy not found")
-        return dict(row._mapping)
+        rows = result.fetchall()
+        updated = {str(row.id) for row in rows}
+        await session.commit()
+
+    if updated:
+        invalidate_dashboard_stats()
+        await RESPONSE_CACHE.invalidate(*(f"policies:{policy_id}" for policy_id in updated))
+    for row in rows:
+        await AUDIT_LOG.record(
+            AuditAction.UPDATE,
+            "policies",
+            row.id,
+            company_id=row.company_id,
+            before={"status": row.prior_status},
+            after={"status": update.status.value},
+        )
+    failures += missing_policy_failures(update, params, updated)
+    return PolicyBulkResult(matched=len(updated), succeeded=len(updated), failures=failures)
+
+
+@api_router.post("/policies/bulk/renew", response_model=PolicyBulkResult)
+async def bulk_renew_policies(renewal: PolicyRenewalRequest):
+    now = datetime.now(timezone.utc)
+    params = {
+        "start_date": renewal.start_date,
+        "pct": renewal.premium_adjustment_percent,
+        "created_by": renewal.created_by,
+        "now": now,
+    }
+    where, failures = policy_selection_sql(renewal, params, alias="s")
+
+    # The new term has the same length as the old one and starts the day after
+    # it ends (or at start_date). Renewal numbers are the original number plus
+    # the new start date, so re-running a renewal cannot clone a policy twice.
+    candidates_sql = f"""
+        WITH source AS (
+            SELECT s.*, COALESCE(CAST(:start_date AS date), s.end_date + 1) AS new_start
+            FROM policies s
+            WHERE {where}
+        ),
+        candidates AS (
+            SELECT source.*,
+                   source.policy_number || '-R' || to_char(new_start, 'YYYYMMDD') AS new_number
+            FROM source
+        )
+    """
+
+    async with db() as session:
+        try:
+            result = await session.execute(
+                text(candidates_sql + """
+                    SELECT c.id, c.new_number, EXISTS (
+                        SELECT 1 FROM policies p WHERE p.policy_number = c.new_number
+                    ) AS already_renewed
+                    FROM candidates c
+                """),
+                params,
+            )
+            candidates = result.fetchall()
+
+            # ✅ Clone every remaining policy in one INSERT ... SELECT; new ids are
+            # drawn up front so each clone maps back to its source policy
+            result = await session.execute(
+                text(candidates_sql + """,
+                    planned AS (
+                        SELECT c.*, gen_random_uuid() AS new_id
+                        FROM candidates c
+                        WHERE NOT EXISTS (
+                            SELECT 1 FROM policies p WHERE p.policy_number = c.new_number
+                        )
+                    ),
+                    inserted AS (
+                        INSERT INTO policies (
+                            id, entity_id, company_id, policy_number, insurance_type, provider,
+                            start_date, end_date, sum_insured, premium_amount,
+                            status, created_by, created_at, updated_at
+                        )
+                        SELECT c.new_id, c.entity_id, c.company_id, c.new_number,
+                               c.insurance_type, c.provider,
+                               c.new_start, c.new_start + (c.end_date - c.start_date),
+                               c.sum_insured,
+                               ROUND(
+                                   CAST(c.premium_amount AS numeric)
+                                   * (1 + CAST(:pct AS numeric) / 100),
+                                   2
+                               ),
+                               'ACTIVE', :created_by, :now, :now
+                        FROM planned c
+                        RETURNING *
+                    )
+                    SELECT planned.id AS source_id, inserted.*
+                    FROM inserted JOIN planned ON planned.new_id = inserted.id
+                """),
+                params,
+            )
+            created_rows = result.fetchall()
+            created = {str(row.source_id): str(row.id) for row in created_rows}
+            await session.commit()
+        except Exception:
+            await session.rollback()
+            logging.getLogger(__name__).exception("Bulk policy renewal failed")
+            raise HTTPException(status_code=500, detail="Failed to renew policies")
+
+    renewed = {}
+    for row in candidates:
+        if row.already_renewed:
+            failures.append(
+                PolicyBulkFailure(policy_id=str(row.id), error="Renewal already exists")
+            )
+        elif str(row.id) in created:
+            renewed[str(row.id)] = created[str(row.id)]
+    failures += missing_policy_failures(renewal, params, {str(row.id) for row in candidates})
+
+    if renewed:
+        invalidate_dashboard_stats()
+    for row in created_rows:
+        data = dict(row._mapping)
+        del data["source_id"]
+        await AUDIT_LOG.record(
+            AuditAction.CREATE, "policies", row.id, company_id=row.company_id, after=data
+        )
+    return PolicyBulkResult(
+        matched=len(candidates), succeeded=len(renewed), failures=failures, renewed=renewed
+    )
+
+
+@api_router.get("/policies/export")
+async def export_policies(
+    format: ExportFormat = Query(ExportFormat.NDJSON),
+    entity_id: Optional[str] = Query(None),
+    status: Optional[PolicyStatus] = Query(None),
+    insurance_type: Optional[InsuranceType] = Query(None),
+):
+    query = "SELECT * FROM policies WHERE 1=1"
+    params = {}
+
+    if entity_id:
+        query += " AND entity_id = CAST(:entity_id AS uuid)"
+        params["entity_id"] = entity_id
+
+    if status:
+        query += " AND status = :status"
+        params["status"] = status.value if isinstance(status, Enum) else status
+
+    if insurance_type:
+        query += " AND insurance_type = :insurance_type"
+        params["insurance_type"] = (
+            insurance_type.value if isinstance(insurance_type, Enum) else insurance_type
+        )
+
+    return export_response(query, params, format, "policies")
+
+
+@api_router.get("/policies/{policy_id}", response_model=InsurancePolicy)
+async def get_policy(policy_id: str, request: Request, response: Response):
+    async def load():
+        async with RESPONSE_CACHE.session() as session:
+            not_modified = await check_not_modified(session, request, response, ("policies",))
+            if not_modified:
+                return not_modified
+            result = await QUERIES.execute(session, "policies.by_id", {"id": policy_id})
+            row = result.first()
+            if not row:
+                raise HTTPException(status_code=404, detail="Policy not found")
+            return cache_entry([row], response, InsurancePolicy, one=True)
+
+    return await RESPONSE_CACHE.fetch(request, (f"policies:{policy_id}",), load)
 
 
 @api_router.put("/policies/{policy_id}/status")
 async def update_policy_status(policy_id: str, status: PolicyStatus):
     async with db() as session:
         result = await session.execute(
-            text(
-                "UPDATE policies SET status = :status, updated_at = :updated_at WHERE id = :id"
-            ),
+            text("""
+                UPDATE policies SET status = :status, updated_at = :updated_at
+                FROM (SELECT id, status FROM policies WHERE id = :id FOR UPDATE) AS prior
+                WHERE policies.id = prior.id
+                RETURNING policies.company_id, prior.status AS prior_status
+            """),
             {
                 "status": status,
                 "updated_at": datetime.now(timezone.utc),
                 "id": policy_id,
             },
         )
+        row = result.first()
         await session.commit()
-        if result.rowcount == 0:
+        invalidate_dashboard_stats()
+        await RESPONSE_CACHE.invalidate(f"policies:{policy_id}")
+        if not row:
             raise HTTPException(status_code=404, detail="Policy not found")
+        await AUDIT_LOG.record(
+            AuditAction.UPDATE,
+            "policies",
+            policy_id,
+            company_id=row.company_id,
+            before={"status": row.prior_status},
+            after={"status": status.value},
+        )
         return {"message": "Policy status updated"}
 
 
@@ -1488,17 +6498,16 @@ async def update_policy_status(policy_id: str, status: PolicyStatus):
 async def update_policy(policy_id: str, policy_data: InsurancePolicyBase):
     async with db() as session:
         # Ensure policy number uniqueness if changed
-        current = await session.execute(
-            text("SELECT policy_number FROM policies WHERE id = :id"), {"id": policy_id}
+        current = await QUERIES.execute(
+            session, "policies.number_by_id", {"id": policy_id}
         )
         current_row = current.first()
         if not current_row:
             raise HTTPException(status_code=404, detail="Policy not found")
         current_number = current_row[0]
         if current_number != policy_data.policy_number:
-            dupe = await session.execute(
-                text("SELECT 1 FROM policies WHERE policy_number = :num"),
-                {"num": policy_data.policy_number},
+            dupe = await QUERIES.execute(
+                session, "policies.number_exists", {"num": policy_data.policy_number}
             )
             if dupe.first():
                 raise HTTPException(
@@ -1518,8 +6527,9 @@ async def update_policy(policy_id: str, policy_data: InsurancePolicyBase):
             status = :status,
             created_by = :created_by,
             updated_at = :updated_at
-        WHERE id = :id
-        RETURNING *
+        FROM (SELECT * FROM policies WHERE id = :id FOR UPDATE) AS prior
+        WHERE policies.id = prior.id
+        RETURNING policies.*, to_jsonb(prior) AS audit_before
         """
         result = await session.execute(
             text(update_query),
@@ -1530,60 +6540,80 @@ async def update_policy(policy_id: str, policy_data: InsurancePolicyBase):
             },
         )
         row = result.first()
+        if row:
+            # Keep the change history replayable past this edit
+            await record_policy_edit(session, row.audit_before, row._mapping)
         await session.commit()
+        invalidate_dashboard_stats()
+        await RESPONSE_CACHE.invalidate(f"policies:{policy_id}")
         if not row:
             raise HTTPException(status_code=404, detail="Policy not found")
-        return dict(row._mapping)
+        data = dict(row._mapping)
+        before = data.pop("audit_before")
+        await AUDIT_LOG.record(
+            AuditAction.UPDATE,
+            "policies",
+            policy_id,
+            company_id=data["company_id"],
+            before=before,
+            after=data,
+        )
+        return data
 
 
 @api_router.delete("/policies/{policy_id}")
 async def delete_policy(policy_id: str):
     async with db() as session:
         # Delete endorsements and documents referencing the policy (if such tables exist)
-        await session.execute(
-            text("DELETE FROM endorsements WHERE policy_id = :pid"), {"pid": policy_id}
-        )
+        for table in ("endorsement_changes", "policy_snapshots", "endorsements"):
+            await session.execute(
+                text(f"DELETE FROM {table} WHERE policy_id = :pid"), {"pid": policy_id}
+            )
         await session.execute(
             text("DELETE FROM documents WHERE policy_id = :pid"), {"pid": policy_id}
         )
         result = await session.execute(
-            text("DELETE FROM policies WHERE id = :id"), {"id": policy_id}
+            text("DELETE FROM policies WHERE id = :id RETURNING *"), {"id": policy_id}
         )
+        deleted = result.first()
         await session.commit()
-        if result.rowcount == 0:
+        invalidate_dashboard_stats()
+        await RESPONSE_CACHE.invalidate(f"policies:{policy_id}")
+        if not deleted:
             raise HTTPException(status_code=404, detail="Policy not found")
-        return {"message": "Policy deleted"}
+    await AUDIT_LOG.record(
+        AuditAction.DELETE,
+        "policies",
+        policy_id,
+        company_id=deleted.company_id,
+        before=deleted._mapping,
+    )
+    await collect_document_blobs()
+    return {"message": "Policy deleted"}
 
 
 @api_router.get("/policies/expiring", response_model=List[InsurancePolicy])
-async def get_expiring_policies(days: int = Query(30, ge=1, le=365)):
-    async with db() as session:
+async def get_expiring_policies(
+    response: Response, days: int = Query(30, ge=1, le=365)
+):
+    async with read_db() as session:
         today = date.today()
         until = today + timedelta(days=days)
-        query = text(
-            """
-            SELECT * FROM policies
-            WHERE status = 'ACTIVE'
-              AND end_date >= :today
-              AND end_date <= :until
-            ORDER BY end_date ASC
-            """
-        )
-        result = await session.execute(
-            query, {"today": today.isoformat(), "until": until.isoformat()}
+        result = await QUERIES.execute(
+            session,
+            "policies.expiring",
+            {"today": today.isoformat(), "until": until.isoformat()},
         )
-        rows = [dict(row._mapping) for row in result.fetchall()]
-        return rows
+        return rows_response(result.fetchall(), response)
 
 
 # Endorsement routes
 @api_router.post("/endorsements", response_model=PolicyEndorsement)
 async def create_endorsement(endorsement_data: PolicyEndorsementBase):
     async with db() as session:
-        result = await session.execute(
-            text(
-                "SELECT 1 FROM endorsements WHERE endorsement_number = :endorsement_number"
-            ),
+        result = await QUERIES.execute(
+            session,
+            "endorsements.number_exists",
             {"endorsement_number": endorsement_data.endorsement_number},
         )
         if result.first():
@@ -1593,120 +6623,516 @@ async def create_endorsement(endorsement_data: PolicyEndorsementBase):
 
         endorsement_obj = PolicyEndorsement(**endorsement_data.model_dump())
         insert_query = """
-        INSERT INTO endorsements (id, policy_id, endorsement_number, description, effective_date, created_by, created_at, updated_at)
-        VALUES (:id, :policy_id, :endorsement_number, :description, :effective_date, :created_by, :created_at, :updated_at)
+        INSERT INTO endorsements (id, policy_id, endorsement_number, description, effective_date, premium_adjustment, created_by, created_at, updated_at)
+        VALUES (:id, :policy_id, :endorsement_number, :description, :effective_date, :premium_adjustment, :created_by, :created_at, :updated_at)
         """
         await session.execute(text(insert_query), endorsement_obj.model_dump())
+        applied = None
+        if endorsement_obj.changes:
+            endorsement_obj.changes = [
+                EndorsementChange(**delta)
+                for delta in await record_endorsement_changes(session, endorsement_obj)
+            ]
+            # Changes already in effect go straight to the policy
+            applied = await apply_due_policy_changes(session, endorsement_obj.policy_id)
         await session.commit()
+        invalidate_dashboard_stats()
+        if applied is not None:
+            await audit_applied_policy_changes(applied)
+        await AUDIT_LOG.record(
+            AuditAction.CREATE,
+            "endorsements",
+            endorsement_obj.id,
+            after=endorsement_obj.model_dump(),
+        )
         return endorsement_obj
 
 
 @api_router.get("/endorsements", response_model=List[PolicyEndorsement])
-async def get_endorsements(policy_id: Optional[str] = Query(None)):
-    async with db() as session:
+async def get_endorsements(
+    request: Request,
+    response: Response,
+    policy_id: Optional[str] = Query(None),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None),
+):
+    async with read_db() as session:
+        not_modified = await check_not_modified(session, request, response, ("endorsements",))
+        if not_modified:
+            return not_modified
+        query = "SELECT * FROM endorsements WHERE 1=1"
+        params = {}
+
         if policy_id:
-            result = await session.execute(
-                text("SELECT * FROM endorsements WHERE policy_id = :policy_id"),
-                {"policy_id": policy_id},
+            query += " AND policy_id = :policy_id"
+            params["policy_id"] = policy_id
+
+        query = apply_keyset_pagination(query, params, limit, cursor)
+        result = await QUERIES.execute(session, "endorsements.list", params, sql=query)
+        rows = paginate_rows(result.fetchall(), limit, response)
+        return rows_response(rows, response)
+
+
+# Document routes
+@api_router.post("/documents", response_model=Document)
+async def upload_document(request: Request):
+    upload = await receive_document_upload(request)
+    temp_path = upload["temp_path"]
+    key = upload["sha256"]
+    try:
+        fields = {name: value for name, value in upload["fields"].items() if value != ""}
+        try:
+            document = Document(
+                **{
+                    **fields,
+                    "file_name": upload["file_name"],
+                    "file_path": DOCUMENT_STORE.locator(key),
+                    "file_type": upload["content_type"],
+                    "content_hash": key,
+                    "size_bytes": upload["size"],
+                }
+            )
+        except ValidationError as e:
+            raise HTTPException(
+                status_code=422,
+                detail=[f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors()],
             )
-        else:
-            result = await session.execute(text("SELECT * FROM endorsements"))
-        endorsements = [dict(row._mapping) for row in result.fetchall()]
-        return endorsements
-
 
-# Dashboard stats
-@api_router.get("/dashboard/stats", response_model=DashboardStats)
-async def get_dashboard_stats():
+        async with db() as session:
+            stored = False
+            try:
+                result = await session.execute(
+                    text(UPSERT_DOCUMENT_BLOB),
+                    {
+                        "sha256": key,
+                        "size_bytes": upload["size"],
+                        "storage_key": document.file_path,
+                        "content_type": upload["content_type"],
+                    },
+                )
+                # ✅ Identical content is stored once
+                if result.scalar():
+                    await DOCUMENT_STORE.put(temp_path, key, upload["content_type"])
+                    stored = True
+                await session.execute(
+                    text("""
+                        INSERT INTO documents (id, policy_id, endorsement_id, uploaded_by, file_name, file_path, file_type, document_type, content_hash, size_bytes, uploaded_at)
+                        VALUES (:id, :policy_id, :endorsement_id, :uploaded_by, :file_name, :file_path, :file_type, :document_type, :content_hash, :size_bytes, :uploaded_at)
+                    """),
+                    document.model_dump(),
+                )
+                await session.commit()
+                await AUDIT_LOG.record(
+                    AuditAction.CREATE, "documents", document.id, after=document.model_dump()
+                )
+                return document
+            except Exception:
+                await session.rollback()
+                if stored:
+                    await DOCUMENT_STORE.delete(key)
+                logging.getLogger(__name__).exception("Storing document %s failed", document.id)
+                raise HTTPException(status_code=500, detail="Failed to store document")
+    finally:
+        await asyncio.to_thread(temp_path.unlink, missing_ok=True)
+
+
+@api_router.get("/documents/{document_id}/content")
+async def get_document_content(document_id: str, request: Request):
+    async with read_db() as session:
+        result = await QUERIES.execute(session, "documents.content", {"id": document_id})
+        row = result.first()
+    if not row or not row.content_hash:
+        raise HTTPException(status_code=404, detail="Document not found")
+
+    # The hash is a strong validator, and a document's content never changes
+    etag = f'"{row.content_hash}"'
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=31536000, immutable"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    headers["Accept-Ranges"] = "bytes"
+    headers["Content-Disposition"] = f"inline; filename*=UTF-8''{quote(row.file_name)}"
+    media_type = row.file_type or "application/octet-stream"
+    byte_range = None
+    if request.headers.get("if-range", etag) == etag:
+        byte_range = parse_byte_range(request.headers.get("range"), row.size_bytes)
+
+    path = DOCUMENT_STORE.path(row.content_hash)
+    if byte_range is None and path is not None:
+        # Sent via http.response.pathsend (zero-copy) where the server supports it
+        return FileResponse(path, media_type=media_type, headers=headers)
+
+    start, end = byte_range or (0, row.size_bytes - 1)
+    headers["Content-Length"] = str(end - start + 1)
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end}/{row.size_bytes}"
+    return StreamingResponse(
+        DOCUMENT_STORE.read(row.content_hash, start, end),
+        status_code=206 if byte_range else 200,
+        media_type=media_type,
+        headers=headers,
+    )
+
+
+@api_router.delete("/documents/{document_id}")
+async def delete_document(document_id: str):
     async with db() as session:
-        result_total_policies = await session.execute(
-            text("SELECT COUNT(*) FROM policies")
+        result = await session.execute(
+            text("DELETE FROM documents WHERE id = :id RETURNING *"), {"id": document_id}
         )
-        total_policies = result_total_policies.scalar()
-
-        result_active = await session.execute(
-            text("SELECT COUNT(*) FROM policies WHERE status = 'ACTIVE'")
+        deleted = result.first()
+        await session.commit()
+        if not deleted:
+            raise HTTPException(status_code=404, detail="Document not found")
+    await AUDIT_LOG.record(
+        AuditAction.DELETE, "documents", document_id, before=deleted._mapping
+    )
+    await collect_document_blobs()
+    return {"message": "Document deleted"}
+
+
+# Invoice routes
+@api_router.post("/invoices/runs", dependencies=[Depends(require_admin)])
+async def start_invoice_run(run_request: InvoiceRunRequest, response: Response):
+    period_start = run_request.period_start
+    period_end = run_request.period_end
+    if period_end is None:
+        next_month = (period_start.replace(day=28) + timedelta(days=4)).replace(day=1)
+        period_end = next_month - timedelta(days=1)
+    if period_start.day != 1 or (period_end + timedelta(days=1)).day != 1:
+        raise HTTPException(
+            status_code=400, detail="Billing periods must span whole calendar months"
         )
-        active_policies = result_active.scalar()
+    if period_end < period_start:
+        raise HTTPException(status_code=400, detail="period_end is before period_start")
+    invoice_date = run_request.invoice_date or period_start
 
-        result_expired = await session.execute(
-            text("SELECT COUNT(*) FROM policies WHERE status = 'EXPIRED'")
+    async with db() as session:
+        # ✅ One run per scope and period: repeating the request returns (or resumes) it
+        result = await session.execute(
+            text("""
+                INSERT INTO invoice_runs (id, scope, company_id, include_descendants, period_start, period_end, invoice_date, due_date)
+                VALUES (:id, :scope, :company_id, :include_descendants, :period_start, :period_end, :invoice_date, :due_date)
+                ON CONFLICT (scope, period_start, period_end) DO UPDATE SET scope = EXCLUDED.scope
+                RETURNING *
+            """),
+            {
+                "id": str(uuid.uuid4()),
+                "scope": invoice_scope(run_request.company_id, run_request.include_descendants),
+                "company_id": run_request.company_id,
+                "include_descendants": run_request.include_descendants,
+                "period_start": period_start,
+                "period_end": period_end,
+                "invoice_date": invoice_date,
+                "due_date": invoice_date + timedelta(days=run_request.due_days),
+            },
         )
-        expired_policies = result_expired.scalar()
+        run = result.first()
+        await session.commit()
+
+    run_id = str(run.id)
+    await AUDIT_LOG.record(
+        AuditAction.CREATE, "invoice_runs", run_id, company_id=run.company_id, after=run._mapping
+    )
+    if run.status != InvoiceRunStatus.COMPLETED.value and run_id not in invoice_run_tasks:
+        invoice_run_tasks[run_id] = asyncio.create_task(invoice_run_job(run_id))
+        response.status_code = 202
+    return invoice_run_report(run)
+
 
-        result_premium = await session.execute(
-            text("SELECT SUM(premium_amount) FROM policies WHERE status = 'ACTIVE'")
+@api_router.get("/invoices/runs/{run_id}", dependencies=[Depends(require_admin)])
+async def get_invoice_run(run_id: str):
+    async with db() as session:
+        result = await session.execute(
+            text("SELECT * FROM invoice_runs WHERE id = :id"), {"id": run_id}
         )
-        total_premium = result_premium.scalar() or 0.0
+        run = result.first()
+    if not run:
+        raise HTTPException(status_code=404, detail="Invoice run not found")
+    return invoice_run_report(run)
 
-        result_entities = await session.execute(text("SELECT COUNT(*) FROM entities"))
-        total_entities = result_entities.scalar()
 
-        thirty_days_ago = datetime.now(timezone.utc) - timedelta(days=30)
-        result_endorsements = await session.execute(
-            text("SELECT COUNT(*) FROM endorsements WHERE created_at >= :date"),
-            {"date": thirty_days_ago.isoformat()},  # ✅ pass as string
+@api_router.get("/invoices", response_model=List[Invoice])
+async def get_invoices(
+    request: Request,
+    response: Response,
+    company_id: Optional[str] = Query(None),
+    policy_id: Optional[str] = Query(None),
+    run_id: Optional[str] = Query(None),
+    period_start: Optional[date] = Query(None),
+    status: Optional[InvoiceStatus] = Query(None),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None),
+):
+    async with read_db() as session:
+        not_modified = await check_not_modified(session, request, response, ("invoices",))
+        if not_modified:
+            return not_modified
+        query = "SELECT * FROM invoices WHERE 1=1"
+        params = {}
+        for column, value in (
+            ("company_id", company_id),
+            ("policy_id", policy_id),
+            ("run_id", run_id),
+            ("period_start", period_start),
+            ("status", status.value if status else None),
+        ):
+            if value is not None:
+                query += f" AND {column} = :{column}"
+                params[column] = value
+
+        query = apply_keyset_pagination(query, params, limit, cursor)
+        result = await QUERIES.execute(session, "invoices.list", params, sql=query)
+        rows = paginate_rows(result.fetchall(), limit, response)
+        return rows_response(rows, response)
+
+
+@api_router.get("/policies/{policy_id}/as-of")
+async def get_policy_as_of(
+    policy_id: str,
+    request: Request,
+    response: Response,
+    as_of: date = Query(..., alias="date"),
+):
+    async with read_db() as session:
+        not_modified = await check_not_modified(
+            session, request, response, ("policies", "endorsements")
         )
-        recent_endorsements = result_endorsements.scalar()
+        if not_modified:
+            return not_modified
+        rebuilt = await policy_state_as_of(session, policy_id, as_of)
+    if rebuilt is None:
+        raise HTTPException(status_code=404, detail="Policy not found")
+    return {
+        "policy_id": policy_id,
+        "as_of": as_of,
+        "state": rebuilt["state"],
+        "snapshot_date": rebuilt["snapshot_date"],
+        "changes_applied": rebuilt["changes_applied"],
+    }
+
+
+# Dashboard stats
+@api_router.get("/dashboard/stats", response_model=DashboardStats)
+async def get_dashboard_stats(
+    request: Request,
+    response: Response,
+    company_id: Optional[str] = Query(None),
+    include_descendants: bool = Query(False),
+):
+    now = datetime.now(timezone.utc)
+    params = {"since": dashboard_window_start(now)}
+    name = "dashboard.stats"
+    if company_id:
+        name = "dashboard.stats_by_company"
+        if include_descendants:
+            name = "dashboard.stats_by_company_group"
+        params["company_id"] = company_id
+    tables = scoped_tables(("policies", "entities", "endorsements"), include_descendants)
+    cache_key = (company_id, include_descendants)
+
+    async with read_db() as session:
+        # The window starts at midnight, so the date pins it
+        not_modified = await check_not_modified(session, request, response, tables, now.date())
+        if not_modified:
+            return not_modified
+
+        # A snapshot is reusable while the tables are unchanged, including by
+        # writes from other workers that never reach invalidate_dashboard_stats
+        etag = response.headers["ETag"]
+        cached = _dashboard_stats_cache.get(cache_key)
+        if cached and cached[1] == etag and time.monotonic() - cached[0] < DASHBOARD_STATS_TTL:
+            return cached[2]
+
+        result = await QUERIES.execute(session, name, params)
+        row = result.first()
+
+    stats = DashboardStats(**dict(row._mapping))
+    _dashboard_stats_cache[cache_key] = (time.monotonic(), etag, stats)
+    return stats
 
-        return DashboardStats(
-            total_policies=total_policies,
-            active_policies=active_policies,
-            expired_policies=expired_policies,
-            total_premium=total_premium,
-            total_entities=total_entities,
-            recent_endorsements=recent_endorsements,
+
+# Change feed
+@api_router.get("/events")
+async def stream_events(company_id: Optional[str] = Query(None)):
+    if not EVENTS_ENABLED:
+        raise HTTPException(status_code=503, detail="Change feed is disabled")
+    if company_id is not None:
+        try:
+            company_id = str(uuid.UUID(company_id))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid company_id")
+    if CHANGE_FEED.subscriber_count >= EVENTS_MAX_SUBSCRIBERS:
+        raise HTTPException(status_code=503, detail="Too many event subscribers")
+    return StreamingResponse(
+        CHANGE_FEED.stream(company_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@api_router.get("/analytics/portfolio")
+async def get_portfolio_analytics(
+    request: Request,
+    response: Response,
+    company_id: Optional[str] = Query(None),
+    include_descendants: bool = Query(False),
+    status: Optional[PolicyStatus] = Query(None),
+    bins: int = Query(20, ge=1, le=200),
+):
+    params = {}
+    if company_id:
+        params["company_id"] = company_id
+    if status:
+        params["status"] = status.value
+    cache_key = (company_id, include_descendants, status, bins)
+
+    async with read_db() as session:
+        not_modified = await check_not_modified(
+            session, request, response, scoped_tables(("policies",), include_descendants)
         )
+        if not_modified:
+            return not_modified
+
+        # ✅ Reuse the last result while the policies table is unchanged
+        etag = response.headers["ETag"]
+        cached = _portfolio_cache.get(cache_key)
+        if cached and cached[0] == etag:
+            _portfolio_cache.move_to_end(cache_key)
+            body = cached[1]
+        else:
+            # ✅ One query, columns as arrays
+            result = await QUERIES.execute(
+                session,
+                "analytics.portfolio_columns",
+                params,
+                sql=portfolio_columns_sql(company_id, include_descendants, status),
+            )
+            columns = dict(result.first()._mapping)
+            portfolio = await asyncio.to_thread(compute_portfolio, columns, bins)
+            body = orjson.dumps(portfolio, option=orjson.OPT_SERIALIZE_NUMPY)
+            _portfolio_cache[cache_key] = (etag, body)
+            if len(_portfolio_cache) > PORTFOLIO_CACHE_SIZE:
+                _portfolio_cache.popitem(last=False)
+
+    return Response(body, media_type="application/json", headers=dict(response.headers))
+
+
+@api_router.get("/finance/earned-premium")
+async def get_earned_premium(
+    request: Request,
+    response: Response,
+    as_of: Optional[date] = Query(None),
+    company_id: Optional[str] = Query(None),
+    include_descendants: bool = Query(False),
+):
+    snapshot = await earned_premium_snapshot(
+        request, response, as_of, company_id, include_descendants
+    )
+    if isinstance(snapshot, Response):
+        return snapshot
+    body = {key: value for key, value in snapshot.items() if key != "rows"}
+    return Response(
+        orjson.dumps(body, option=orjson.OPT_SERIALIZE_NUMPY),
+        media_type="application/json",
+        headers=dict(response.headers),
+    )
+
+
+@api_router.get("/finance/earned-premium/policies")
+async def export_earned_premium(
+    request: Request,
+    response: Response,
+    as_of: Optional[date] = Query(None),
+    company_id: Optional[str] = Query(None),
+    include_descendants: bool = Query(False),
+    format: ExportFormat = Query(ExportFormat.NDJSON),
+):
+    snapshot = await earned_premium_snapshot(
+        request, response, as_of, company_id, include_descendants
+    )
+    if isinstance(snapshot, Response):
+        return snapshot
+    media_type = "text/csv" if format == ExportFormat.CSV else "application/x-ndjson"
+    filename = f"earned-premium-{snapshot['as_of'].isoformat()}.{format.value}"
+    return StreamingResponse(
+        stream_earned_premium(snapshot, format),
+        media_type=media_type,
+        headers={
+            **response.headers,
+            "Content-Disposition": f'attachment; filename="{filename}"',
+        },
+    )
 
 
 # Search endpoint
+SEARCH_ENTITY_TABLES = {
+    "EMPLOYEE": "employees",
+    "STUDENT": "students",
+    "VESSEL": "vessels",
+    "VEHICLE": "vehicles",
+}
+
+
+async def run_search_query(name: str, params: dict) -> List[dict]:
+    # Each sub-search checks out its own pooled connection
+    async with read_db() as session:
+        result = await QUERIES.execute(session, name, params)
+        return [dict(row._mapping) for row in result.fetchall()]
+
+
 @api_router.get("/search")
 async def search(q: str = Query(...), entity_type: Optional[str] = Query(None)):
-    async with db() as session:
-        results = {"policies": [], "entities": [], "endorsements": []}
-
-        # Policies
-        policy_query = "SELECT * FROM policies WHERE policy_number ILIKE :q OR provider ILIKE :q LIMIT 10"
-        policy_rows = await session.execute(text(policy_query), {"q": f"%{q}%"})
-        results["policies"] = [dict(row._mapping) for row in policy_rows.fetchall()]
-
-        # Entities
-        if entity_type:
-            etype = entity_type.upper()
-            if etype == "EMPLOYEE":
-                query = "SELECT * FROM employees WHERE name ILIKE :q OR employee_code ILIKE :q LIMIT 10"
-            elif etype == "STUDENT":
-                query = "SELECT * FROM students WHERE name ILIKE :q OR student_id ILIKE :q LIMIT 10"
-            elif etype == "VESSEL":
-                query = "SELECT * FROM vessels WHERE vessel_name ILIKE :q OR imo_number ILIKE :q LIMIT 10"
-            elif etype == "VEHICLE":
-                query = "SELECT * FROM vehicles WHERE registration_number ILIKE :q OR make ILIKE :q OR model ILIKE :q LIMIT 10"
-            else:
-                query = None
-            if query:
-                entity_rows = await session.execute(text(query), {"q": f"%{q}%"})
-                results["entities"] = [
-                    dict(row._mapping) for row in entity_rows.fetchall()
-                ]
-
-        # Endorsements
-        endorsement_query = "SELECT * FROM endorsements WHERE endorsement_number ILIKE :q OR description ILIKE :q LIMIT 10"
-        endorsement_rows = await session.execute(
-            text(endorsement_query), {"q": f"%{q}%"}
-        )
-        results["endorsements"] = [
-            dict(row._mapping) for row in endorsement_rows.fetchall()
-        ]
+    params = {"term": q, "pattern": f"%{q}%"}
+    searches = {"policies": "search.policies", "endorsements": "search.endorsements"}
+
+    table = SEARCH_ENTITY_TABLES.get(entity_type.upper()) if entity_type else None
+    if table:
+        searches["entities"] = f"search.{table}"
 
-        return results
+    # ✅ Fan out concurrently: latency is bounded by the slowest sub-query
+    found = await asyncio.gather(
+        *(run_search_query(name, params) for name in searches.values())
+    )
+    return {"policies": [], "entities": [], "endorsements": [], **dict(zip(searches, found))}
 
 
 # Root endpoint
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # === Startup logic (if any) ===
+    if APPLY_SCHEMA_MIGRATIONS:
+        await apply_schema_migrations()
+    else:
+        await check_schema_migrations()
+    await warm_up_pool()
+    if READ_REPLICAS.replicas:
+        await READ_REPLICAS.check_all()
+        for replica in READ_REPLICAS.replicas:
+            await warm_up_pool(replica["session"])
+    if AUDIT_LOG_ENABLED:
+        AUDIT_LOG.start()
+    background_jobs = []
+    if POLICY_EXPIRY_ENABLED:
+        background_jobs.append(asyncio.create_task(policy_expiry_loop()))
+    if READ_REPLICAS.replicas:
+        background_jobs.append(asyncio.create_task(READ_REPLICAS.health_loop()))
+    background_jobs.append(asyncio.create_task(table_version_fold_loop()))
+    background_jobs.append(asyncio.create_task(revoked_token_sync_loop()))
+    if EVENTS_ENABLED:
+        background_jobs.extend(CHANGE_FEED.start())
     yield
     # === Shutdown logic ===
+    # Cancelled invoice runs resume from their cursor when started again
+    background_jobs.extend(invoice_run_tasks.values())
+    for job in background_jobs:
+        job.cancel()
+    await asyncio.gather(*background_jobs, return_exceptions=True)
+    # Jobs are stopped first, so any events they recorded are flushed too
+    await AUDIT_LOG.stop()
+    password_pool.shutdown(wait=False, cancel_futures=True)
+    if RESPONSE_CACHE.backend is not None:
+        await RESPONSE_CACHE.backend.close()
     client.close()
 
 
@@ -1725,6 +7151,109 @@ async def health_check():
     return {"status": "healthy", "timestamp": datetime.now(timezone.utc).isoformat()}
 
 
+@api_router.get("/health/ready")
+async def readiness_check(response: Response):
+    pool = pool_status()
+    database = {"reachable": False, "latency_ms": None}
+
+    # A saturated worker would only queue the probe behind real traffic
+    if not pool["saturated"]:
+        async def probe():
+            async with engine.connect() as conn:
+                await conn.execute(text("SELECT 1"))
+
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(probe(), DB_READY_TIMEOUT)
+            database = {
+                "reachable": True,
+                "latency_ms": round((time.perf_counter() - started) * 1000, 2),
+            }
+        except Exception as e:
+            database["error"] = str(e) or type(e).__name__
+
+    ready = database["reachable"] and not pool["saturated"]
+    if not ready:
+        response.status_code = 503
+    return {
+        "status": "ready" if ready else "unavailable",
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "pool": pool,
+        "database": database,
+        # Unhealthy replicas fail over to the primary, so they don't affect readiness
+        "replicas": READ_REPLICAS.status(),
+        "read_routing": READ_REPLICAS.stats,
+    }
+
+
+# Admin routes
+@api_router.get("/admin/query-metrics", dependencies=[Depends(require_admin)])
+async def get_query_metrics():
+    return {
+        "slow_query_threshold_ms": SLOW_QUERY_THRESHOLD_MS,
+        **QUERY_METRICS.summary(),
+    }
+
+
+@api_router.put("/admin/sql-echo", dependencies=[Depends(require_admin)])
+async def set_sql_echo(enabled: bool):
+    for echo_engine in (engine, *replica_engines):
+        echo_engine.echo = enabled
+    return {"sql_echo": engine.echo}
+
+
+@api_router.get("/admin/jobs/policy-expiry", dependencies=[Depends(require_admin)])
+async def get_policy_expiry_status():
+    return {
+        "enabled": POLICY_EXPIRY_ENABLED,
+        "interval_seconds": POLICY_EXPIRY_INTERVAL_SECONDS,
+        "batch_size": POLICY_EXPIRY_BATCH_SIZE,
+        **policy_expiry_status,
+    }
+
+
+@api_router.post("/admin/jobs/policy-expiry/run", dependencies=[Depends(require_admin)])
+async def trigger_policy_expiry():
+    run = await run_policy_expiry()
+    if run is None:
+        raise HTTPException(status_code=409, detail="Policy expiry is already running")
+    return run
+
+
+@api_router.get("/admin/cache", dependencies=[Depends(require_admin)])
+async def get_cache_stats():
+    return {"ttl_seconds": RESPONSE_CACHE_TTL, **(await RESPONSE_CACHE.stats())}
+
+
+@api_router.get("/admin/audit", dependencies=[Depends(require_admin)])
+async def get_audit_log_status():
+    return {
+        "enabled": AUDIT_LOG_ENABLED,
+        "batch_size": AUDIT_BATCH_SIZE,
+        "flush_interval_ms": AUDIT_FLUSH_INTERVAL_MS,
+        **AUDIT_LOG.status(),
+    }
+
+
+@api_router.get("/admin/events", dependencies=[Depends(require_admin)])
+async def get_change_feed_status():
+    return {
+        "enabled": EVENTS_ENABLED,
+        "subscriber_buffer": EVENTS_SUBSCRIBER_BUFFER,
+        "max_subscribers": EVENTS_MAX_SUBSCRIBERS,
+        "dashboard_debounce_ms": EVENTS_DASHBOARD_DEBOUNCE_MS,
+        **CHANGE_FEED.status(),
+    }
+
+
+@api_router.get("/admin/query-stats", dependencies=[Depends(require_admin)])
+async def get_query_stats():
+    return {
+        "prepared_statement_cache_size": PREPARED_STATEMENT_CACHE_SIZE,
+        "statements": QUERIES.stats,
+    }
+
+
 # Include your API router
 app.include_router(api_router)
 
@@ -1735,10 +7264,30 @@ app.add_middleware(
     allow_origins=os.environ.get("CORS_ORIGINS", "*").split(","),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER, READ_PRIMARY_HEADER],
 )
 
+# Route reads to the primary right after a client's own writes
+app.add_middleware(ReadYourWritesMiddleware)
+
+# Actor for audit events recorded by write handlers
+app.add_middleware(AuditActorMiddleware)
+
+# Publish a write's table versions before its response goes out
+app.add_middleware(TableVersionMiddleware)
+
+# Per-request SQL timing and the slow-query log
+app.add_middleware(QueryInstrumentationMiddleware)
+
 # Logging configuration
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
 )
 logger = logging.getLogger(__name__)
+
+
+if __name__ == "__main__":
+    # Deploy step: python server.py migrate
+    if sys.argv[1:] != ["migrate"]:
+        sys.exit("usage: python server.py migrate")
+    asyncio.run(apply_schema_migrations())
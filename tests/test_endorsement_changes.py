@@ -0,0 +1,334 @@
+"""Endorsement change log: delta validation and policy state replay."""
+
+import uuid
+from datetime import date, datetime, timedelta, timezone
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import text
+
+import server
+from server import EndorsementChange, EndorsementChangeType
+
+pytestmark = pytest.mark.anyio
+
+TODAY = date.today()
+
+
+def change(field, change_type, new_value=None, old_value=None):
+    return EndorsementChange(
+        field=field, change_type=change_type, new_value=new_value, old_value=old_value
+    )
+
+
+def written_state(**fields):
+    state = {
+        "premium_amount": 1200.0,
+        "sum_insured": 50000.0,
+        "provider": "Acme",
+        "status": "ACTIVE",
+        "entities": ["e-1"],
+    }
+    state.update(fields)
+    return state
+
+
+async def insert_policy(session, premium_amount=1200.0, **fields) -> str:
+    now = datetime.now(timezone.utc)
+    policy = {
+        "id": str(uuid.uuid4()),
+        "entity_id": str(uuid.uuid4()),
+        "company_id": str(uuid.uuid4()),
+        "policy_number": f"TEST-{uuid.uuid4().hex[:12]}",
+        "insurance_type": "HEALTH",
+        "provider": "Acme",
+        "start_date": TODAY - timedelta(days=365),
+        "end_date": TODAY + timedelta(days=365),
+        "sum_insured": 50000.0,
+        "premium_amount": premium_amount,
+        "status": "ACTIVE",
+        "created_by": str(uuid.uuid4()),
+        "created_at": now,
+        "updated_at": now,
+        **fields,
+    }
+    columns = ", ".join(policy)
+    values = ", ".join(f":{column}" for column in policy)
+    await session.execute(text(f"INSERT INTO policies ({columns}) VALUES ({values})"), policy)
+    return policy["id"]
+
+
+async def endorse(policy_id: str, effective_date: date, *changes: EndorsementChange):
+    return await server.create_endorsement(
+        server.PolicyEndorsementBase(
+            policy_id=policy_id,
+            endorsement_number=f"END-{uuid.uuid4().hex[:12]}",
+            description="test",
+            effective_date=effective_date,
+            created_by=str(uuid.uuid4()),
+            changes=list(changes),
+        )
+    )
+
+
+def modify_premium(amount: float) -> EndorsementChange:
+    return change("premium_amount", EndorsementChangeType.MODIFIED, amount)
+
+
+async def state_on(policy_id: str, as_of: date) -> dict:
+    async with server.db() as session:
+        return await server.policy_state_as_of(session, policy_id, as_of)
+
+
+async def snapshot_dates(policy_id: str) -> list:
+    async with server.db() as session:
+        result = await session.execute(
+            text("""
+                SELECT effective_date FROM policy_snapshots
+                WHERE policy_id = :policy_id ORDER BY effective_date, change_id
+            """),
+            {"policy_id": policy_id},
+        )
+        return [row.effective_date for row in result.fetchall()]
+
+
+async def policy_row(policy_id: str):
+    async with server.db() as session:
+        result = await session.execute(
+            text("SELECT * FROM policies WHERE id = :id"), {"id": policy_id}
+        )
+        return result.first()
+
+
+# normalize_policy_changes / apply_policy_change
+
+
+def test_normalize_records_old_values_and_chains_changes():
+    state = written_state()
+    deltas = server.normalize_policy_changes(
+        [modify_premium(1300), modify_premium(1450.5)], state
+    )
+    assert [(d["old_value"], d["new_value"]) for d in deltas] == [(1200.0, 1300.0), (1300.0, 1450.5)]
+    assert state["premium_amount"] == 1450.5
+
+
+def test_normalize_ignores_client_old_values():
+    deltas = server.normalize_policy_changes(
+        [change("provider", EndorsementChangeType.MODIFIED, "Zen", old_value="Other")],
+        written_state(),
+    )
+    assert deltas == [
+        {"field": "provider", "change_type": "MODIFIED", "old_value": "Acme", "new_value": "Zen"}
+    ]
+
+
+def test_normalize_covered_entities():
+    state = written_state()
+    deltas = server.normalize_policy_changes(
+        [
+            change("entities", EndorsementChangeType.ADDED, "e-2"),
+            change("entities", EndorsementChangeType.REMOVED, old_value="e-1"),
+        ],
+        state,
+    )
+    assert [(d["old_value"], d["new_value"]) for d in deltas] == [(None, "e-2"), ("e-1", None)]
+    assert state["entities"] == ["e-2"]
+
+
+@pytest.mark.parametrize(
+    "bad, status_code",
+    [
+        (change("entities", EndorsementChangeType.ADDED, "e-1"), 400),
+        (change("entities", EndorsementChangeType.REMOVED, old_value="e-9"), 400),
+        (change("provider", EndorsementChangeType.ADDED, "e-2"), 400),
+        (change("status", EndorsementChangeType.MODIFIED, "EXPIRED"), 400),
+        (change("premium_amount", EndorsementChangeType.STATUS_CHANGE, "EXPIRED"), 400),
+        (change("status", EndorsementChangeType.STATUS_CHANGE, "LAPSED"), 422),
+        (change("premium_amount", EndorsementChangeType.MODIFIED, "a lot"), 422),
+    ],
+)
+def test_normalize_rejects_invalid_changes(bad, status_code):
+    with pytest.raises(HTTPException) as exc_info:
+        server.normalize_policy_changes([bad], written_state())
+    assert exc_info.value.status_code == status_code
+
+
+def test_apply_policy_change_entities_are_a_set():
+    state = written_state()
+    server.apply_policy_change(state, {"field": "entities", "change_type": "ADDED", "new_value": "e-1"})
+    assert state["entities"] == ["e-1"]
+    server.apply_policy_change(state, {"field": "entities", "change_type": "REMOVED", "old_value": "e-1"})
+    assert state["entities"] == []
+
+
+# policy_state_as_of over the stored log
+
+
+async def test_state_without_history_is_the_policy_row(database):
+    async with database() as session:
+        policy_id = await insert_policy(session)
+        await session.commit()
+    rebuilt = await state_on(policy_id, TODAY)
+    assert rebuilt["state"]["premium_amount"] == 1200.0
+    assert rebuilt["snapshot_date"] is None
+    assert await state_on(str(uuid.uuid4()), TODAY) is None
+
+
+async def test_state_rebuilt_across_snapshots(database, monkeypatch):
+    monkeypatch.setattr(server, "POLICY_SNAPSHOT_INTERVAL", 2)
+    async with database() as session:
+        policy_id = await insert_policy(session)
+        await session.commit()
+
+    dates = [TODAY - timedelta(days=60 - 10 * i) for i in range(6)]
+    for i, effective_date in enumerate(dates):
+        await endorse(policy_id, effective_date, modify_premium(1300 + 100 * i))
+
+    # The written state, then one snapshot every two changes
+    assert await snapshot_dates(policy_id) == [
+        server.BASE_SNAPSHOT_DATE, dates[1], dates[3], dates[5]
+    ]
+    assert (await state_on(policy_id, dates[0] - timedelta(days=1)))["state"]["premium_amount"] == 1200.0
+    for i, effective_date in enumerate(dates):
+        rebuilt = await state_on(policy_id, effective_date)
+        assert rebuilt["state"]["premium_amount"] == 1300 + 100 * i
+        assert rebuilt["changes_applied"] < server.POLICY_SNAPSHOT_INTERVAL
+    assert (await state_on(policy_id, dates[4]))["snapshot_date"] == dates[3]
+    # All in effect: the row carries the latest
+    assert float((await policy_row(policy_id)).premium_amount) == 1800.0
+
+
+async def test_backdated_endorsement_drops_later_snapshots(database, monkeypatch):
+    monkeypatch.setattr(server, "POLICY_SNAPSHOT_INTERVAL", 2)
+    async with database() as session:
+        policy_id = await insert_policy(session)
+        await session.commit()
+
+    dates = [TODAY - timedelta(days=40 - 10 * i) for i in range(4)]
+    for i, effective_date in enumerate(dates):
+        await endorse(policy_id, effective_date, modify_premium(1300 + 100 * i))
+    assert await snapshot_dates(policy_id) == [server.BASE_SNAPSHOT_DATE, dates[1], dates[3]]
+
+    backdated = dates[0] + timedelta(days=5)
+    endorsement = await endorse(
+        policy_id,
+        backdated,
+        change("sum_insured", EndorsementChangeType.MODIFIED, 75000),
+        change("entities", EndorsementChangeType.ADDED, "e-2"),
+    )
+    # Old values come from the state on the backdated date, not the row today
+    assert endorsement.changes[0].old_value == 50000.0
+    # Snapshots after it are dropped, and the next is taken at the latest change
+    assert await snapshot_dates(policy_id) == [server.BASE_SNAPSHOT_DATE, dates[3]]
+
+    before = (await state_on(policy_id, dates[0]))["state"]
+    assert (before["sum_insured"], before["premium_amount"]) == (50000.0, 1300.0)
+    latest = (await state_on(policy_id, TODAY))["state"]
+    assert (latest["sum_insured"], latest["premium_amount"]) == (75000.0, 1600.0)
+    assert "e-2" in latest["entities"]
+
+    # A backdated change to a field later endorsements also set is overridden from their date
+    await endorse(policy_id, dates[1] + timedelta(days=5), modify_premium(999))
+    assert (await state_on(policy_id, dates[1] + timedelta(days=5)))["state"]["premium_amount"] == 999.0
+    assert (await state_on(policy_id, dates[2]))["state"]["premium_amount"] == 1500.0
+    assert float((await policy_row(policy_id)).premium_amount) == 1600.0
+
+
+async def test_put_edit_is_logged_as_changes_effective_today(database):
+    async with database() as session:
+        policy_id = await insert_policy(session)
+        await session.commit()
+    await endorse(policy_id, TODAY - timedelta(days=30), modify_premium(1300))
+    await endorse(policy_id, TODAY + timedelta(days=30), modify_premium(1500))
+
+    row = await policy_row(policy_id)
+    edit = server.InsurancePolicyBase(
+        entity_id=str(row.entity_id),
+        policy_number=row.policy_number,
+        insurance_type=row.insurance_type,
+        provider="Zen",
+        start_date=row.start_date,
+        end_date=row.end_date,
+        sum_insured=float(row.sum_insured),
+        premium_amount=1400,
+        status="UNDER_REVIEW",
+        created_by=str(row.created_by),
+    )
+    await server.update_policy(policy_id, edit)
+
+    async with database() as session:
+        result = await session.execute(
+            text("""
+                SELECT field, change_type, old_value, new_value, applied_at
+                FROM endorsement_changes
+                WHERE policy_id = :policy_id AND endorsement_id IS NULL
+                ORDER BY field
+            """),
+            {"policy_id": policy_id},
+        )
+        edits = result.fetchall()
+    assert [(e.field, e.change_type, e.old_value, e.new_value) for e in edits] == [
+        ("premium_amount", "MODIFIED", 1300.0, 1400.0),
+        ("provider", "MODIFIED", "Acme", "Zen"),
+        ("status", "STATUS_CHANGE", "ACTIVE", "UNDER_REVIEW"),
+    ]
+    # The row already holds the edit
+    assert all(e.applied_at is not None for e in edits)
+
+    yesterday = (await state_on(policy_id, TODAY - timedelta(days=1)))["state"]
+    assert (yesterday["premium_amount"], yesterday["provider"]) == (1300.0, "Acme")
+    today = (await state_on(policy_id, TODAY))["state"]
+    assert (today["premium_amount"], today["provider"], today["status"]) == (1400.0, "Zen", "UNDER_REVIEW")
+    # The future endorsement still applies on top of the edit
+    later = (await state_on(policy_id, TODAY + timedelta(days=30)))["state"]
+    assert (later["premium_amount"], later["provider"]) == (1500.0, "Zen")
+
+
+async def test_put_edit_without_history_logs_nothing(database):
+    async with database() as session:
+        policy_id = await insert_policy(session)
+        await session.commit()
+    row = await policy_row(policy_id)
+    edit = server.InsurancePolicyBase(
+        **{
+            **{field: row._mapping[field] for field in server.InsurancePolicyBase.model_fields},
+            "entity_id": str(row.entity_id),
+            "created_by": str(row.created_by),
+            "premium_amount": 1250,
+        }
+    )
+    await server.update_policy(policy_id, edit)
+    async with database() as session:
+        result = await session.execute(
+            text("SELECT COUNT(*) FROM endorsement_changes WHERE policy_id = :policy_id"),
+            {"policy_id": policy_id},
+        )
+        assert result.scalar() == 0
+
+
+async def test_future_changes_applied_once_due(database):
+    async with database() as session:
+        policy_id = await insert_policy(session)
+        await session.commit()
+    await endorse(policy_id, TODAY + timedelta(days=10), modify_premium(1300))
+    assert float((await policy_row(policy_id)).premium_amount) == 1200.0
+
+    # Let the date come
+    async with database() as session:
+        await session.execute(
+            text("UPDATE endorsement_changes SET effective_date = :today WHERE policy_id = :policy_id"),
+            {"policy_id": policy_id, "today": TODAY},
+        )
+        await session.commit()
+    assert await server.run_due_policy_changes() >= 1
+    assert float((await policy_row(policy_id)).premium_amount) == 1300.0
+
+    async with database() as session:
+        result = await session.execute(
+            text("""
+                SELECT COUNT(*) FROM endorsement_changes
+                WHERE policy_id = :policy_id AND applied_at IS NULL
+            """),
+            {"policy_id": policy_id},
+        )
+        assert result.scalar() == 0
@@ -0,0 +1,151 @@
+"""Invoice runs: instalment amounts and claims across overlapping periods."""
+
+import uuid
+from datetime import date, datetime, timezone
+from decimal import Decimal
+
+import pytest
+from sqlalchemy import text
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def insert_policy(session, company_id: str, start_date: date, end_date: date, premium_amount) -> str:
+    now = datetime.now(timezone.utc)
+    policy_id = str(uuid.uuid4())
+    await session.execute(
+        text("""
+            INSERT INTO policies (id, entity_id, company_id, policy_number, insurance_type, provider, start_date, end_date, sum_insured, premium_amount, status, created_by, created_at, updated_at)
+            VALUES (:id, :entity_id, :company_id, :policy_number, 'HEALTH', 'Acme', :start_date, :end_date, 50000, :premium_amount, 'ACTIVE', :created_by, :now, :now)
+        """),
+        {
+            "id": policy_id,
+            "entity_id": str(uuid.uuid4()),
+            "company_id": company_id,
+            "policy_number": f"TEST-{uuid.uuid4().hex[:12]}",
+            "start_date": start_date,
+            "end_date": end_date,
+            "premium_amount": premium_amount,
+            "created_by": str(uuid.uuid4()),
+            "now": now,
+        },
+    )
+    return policy_id
+
+
+async def invoice(company_id: str, period_start: date, period_end: date) -> dict:
+    """Create and run a company's invoice run for whole months"""
+    run_id = str(uuid.uuid4())
+    async with server.db() as session:
+        await session.execute(
+            text("""
+                INSERT INTO invoice_runs (id, scope, company_id, period_start, period_end, invoice_date, due_date)
+                VALUES (:id, :scope, :company_id, :period_start, :period_end, :period_start, :period_end)
+            """),
+            {
+                "id": run_id,
+                "scope": server.invoice_scope(company_id, False),
+                "company_id": company_id,
+                "period_start": period_start,
+                "period_end": period_end,
+            },
+        )
+        await session.commit()
+    return await server.run_invoicing(run_id)
+
+
+async def policy_invoices(policy_id: str) -> list:
+    async with server.db() as session:
+        result = await session.execute(
+            text("""
+                SELECT i.period_start, i.instalment_from, i.instalment_to, i.instalments, i.amount,
+                       ARRAY(SELECT instalment FROM invoice_instalments c
+                             WHERE c.invoice_id = i.id ORDER BY instalment) AS billed
+                FROM invoices i
+                WHERE policy_id = :policy_id
+                ORDER BY period_start
+            """),
+            {"policy_id": policy_id},
+        )
+        return result.fetchall()
+
+
+@pytest.fixture
+def company_id():
+    # One company per test keeps its runs from billing other tests' policies
+    return str(uuid.uuid4())
+
+
+async def test_last_instalment_absorbs_rounding(database, company_id):
+    async with database() as session:
+        policy_id = await insert_policy(session, company_id, date(2025, 1, 1), date(2025, 4, 1), 100)
+        await session.commit()
+
+    for period_start, period_end in (
+        (date(2025, 1, 1), date(2025, 1, 31)),
+        (date(2025, 2, 1), date(2025, 2, 28)),
+        (date(2025, 3, 1), date(2025, 3, 31)),
+    ):
+        run = await invoice(company_id, period_start, period_end)
+        assert (run["status"], run["invoices_created"]) == ("COMPLETED", 1)
+
+    invoices = await policy_invoices(policy_id)
+    assert [(i.instalment_from, i.instalments, i.amount) for i in invoices] == [
+        (1, 3, Decimal("33.33")),
+        (2, 3, Decimal("33.33")),
+        (3, 3, Decimal("33.34")),
+    ]
+    assert sum(i.amount for i in invoices) == Decimal("100.00")
+
+
+async def test_rounding_over_a_part_month_term(database, company_id):
+    async with database() as session:
+        # Twelve instalments of 83.33; the twelfth takes the remaining 0.04
+        policy_id = await insert_policy(session, company_id, date(2025, 2, 15), date(2026, 2, 15), 1000)
+        await session.commit()
+
+    await invoice(company_id, date(2025, 1, 1), date(2025, 12, 31))
+    await invoice(company_id, date(2026, 1, 1), date(2026, 3, 31))
+
+    invoices = await policy_invoices(policy_id)
+    assert [(i.billed, i.amount) for i in invoices] == [
+        (list(range(1, 12)), Decimal("916.63")),
+        ([12], Decimal("83.37")),
+    ]
+    assert sum(i.amount for i in invoices) == Decimal("1000.00")
+
+
+async def test_quarter_then_month_bills_each_instalment_once(database, company_id):
+    async with database() as session:
+        policy_id = await insert_policy(session, company_id, date(2025, 1, 1), date(2026, 1, 1), 1000)
+        await session.commit()
+
+    quarter = await invoice(company_id, date(2025, 1, 1), date(2025, 3, 31))
+    assert (quarter["invoices_created"], quarter["total_amount"]) == (1, Decimal("249.99"))
+    # February is inside the quarter already billed
+    february = await invoice(company_id, date(2025, 2, 1), date(2025, 2, 28))
+    assert (february["status"], february["policies_processed"]) == ("COMPLETED", 1)
+    assert (february["invoices_created"], february["total_amount"]) == (0, Decimal("0"))
+
+    invoices = await policy_invoices(policy_id)
+    assert [(i.period_start, i.billed, i.amount) for i in invoices] == [
+        (date(2025, 1, 1), [1, 2, 3], Decimal("249.99")),
+    ]
+
+
+async def test_month_then_quarter_bills_the_rest(database, company_id):
+    async with database() as session:
+        policy_id = await insert_policy(session, company_id, date(2025, 1, 1), date(2025, 4, 1), 100)
+        await session.commit()
+
+    await invoice(company_id, date(2025, 2, 1), date(2025, 2, 28))
+    await invoice(company_id, date(2025, 1, 1), date(2025, 3, 31))
+
+    invoices = await policy_invoices(policy_id)
+    assert [(i.period_start, i.billed, i.amount) for i in invoices] == [
+        (date(2025, 1, 1), [1, 3], Decimal("66.67")),
+        (date(2025, 2, 1), [2], Decimal("33.33")),
+    ]
+    assert sum(i.amount for i in invoices) == Decimal("100.00")